@@ -1,10 +1,23 @@
 from django.contrib import admin
-from django.contrib.admin.widgets import FilteredSelectMultiple
-from .models import Shop, Category, Product, ProductImage
-from django.db.models import ImageField, Q
+from django.contrib.admin.widgets import AutocompleteSelectMultiple
+from .models import (Shop, Category, CategoryClosure, Product, ProductImage, BackgroundJob, ViewStats,
+	RequestProfile, get_parent_category_choices, delete_shops, main_image_name, renumber_product_images)
+from django.db.models import ImageField, Subquery, OuterRef
+from django.db.models.functions import Upper
 from django import forms
 from admin_numeric_filter.admin import RangeNumericFilter, NumericFilterModelAdmin
-from .widgets import ImageWidget, FilteredSelectMultipleWithReadonlyMode
+from .widgets import ImageWidget, AutocompleteSelectMultipleWithReadonlyMode
+from .thumbnails import thumbnail_url
+from .permissions import ShopAccess
+from .importing import ProductImporter, iter_rows, detect_format
+from .exporting import export_lines, CONTENT_TYPES
+from .pagination import KeysetPaginationMixin
+from .search import search_products
+from .jobs import exceeds_threshold, enqueue, run_action, cancel_jobs
+from .instrumentation import percentile, merge_histograms, merge_slow_queries
+from .profiling import stats_summary, SORT_KEYS
+from .routers import read_database
+from .pooling import pool_metrics
 from django.utils.html import format_html
 from django.urls import path, reverse
 from django.template.response import TemplateResponse
@@ -14,17 +27,52 @@ from django.contrib.admin.options import (
 	flatten_fieldsets, all_valid, IS_POPUP_VAR, TO_FIELD_VAR, 
 	helpers, _
 )
-from django.conf import settings
 from django.forms.models import BaseInlineFormSet
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
 from django.template.defaultfilters import truncatechars
+from django.core.paginator import Paginator
+from django.http import (StreamingHttpResponse, HttpResponseRedirect, HttpResponse, HttpResponseBadRequest, JsonResponse,
+	HttpResponseNotAllowed)
+from django.utils import timezone
+from datetime import timedelta
+import os
 
 # Register your models here.
 admin.site.site_header = 'Администрация'
 admin.site.site_title = 'Администрация'
 
 
+def background_job_message(job):
+	return format_html("Объектов слишком много, создано фоновое задание <a href='{}'>{}</a>.",
+		reverse('admin:core_backgroundjob_change', args=(job.pk,)), job)
+
+
+#Страница подтверждения массового удаления с общим числом удаляемых объектов
+#вместо дерева всех связанных объектов
+def render_delete_confirmation(model_admin, request, title, counts, action=None):
+	context = model_admin.admin_site.each_context(request)
+	context.update({
+		'opts': model_admin.model._meta,
+		'title': title,
+		'counts': counts,
+		'action': action,
+		'select_across': request.POST.get('select_across', '0'),
+		'selected': request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+	})
+	return TemplateResponse(request, 'admin/bulk_delete_confirmation.html', context)
+
+
+#Кол-во продуктов queryset и связанных с ними объектов
+def product_delete_counts(queryset):
+	ids = queryset.order_by().values('id')
+	return (
+		('Продуктов', queryset.count()),
+		('Фото продуктов', ProductImage.objects.filter(product__in=ids).count()),
+		('Связей продуктов с категориями', Product.categories.through.objects.filter(product__in=ids).count()),
+	)
+
+
 class ManagedShopsInlineAdmin(admin.TabularInline):
 	model = Shop.product_managers.through
 	extra = 0
@@ -54,18 +102,19 @@ class ShortDescriptionListFieldMixin:
 
 @admin.register(Shop)
 class ShopAdmin(admin.ModelAdmin, ShortDescriptionListFieldMixin):
-	list_display = ('title','image','id', 'short_description')
+	list_display = ('title','image','id', 'product_count', 'active_product_count', 'short_description')
 	search_fields = ('title',)
 	ordering = ('title',)
 	readonly_fields = ('id',)
 	formfield_overrides = {ImageField: {'widget': ImageWidget}}
 	filter_horizontal = ('product_managers',)
+	actions = ('delete_selected_shops',)
 
 	def image(self, instance):
 		url = instance.imageUrl
 		if url:
-			return format_html("<img src='{}/{}' width=100 height=100 style='object-fit:contain' />",
-				settings.MEDIA_URL, url)
+			return format_html("<img src='{}' width=100 height=100 style='object-fit:contain' />",
+				thumbnail_url(url, 100))
 		else:
 			return format_html("<img alt='—' />")
 
@@ -78,15 +127,51 @@ class ShopAdmin(admin.ModelAdmin, ShortDescriptionListFieldMixin):
 			return ('id', 'title', 'description', 'imageUrl')
 
 	def get_queryset(self, request):
-		if request.user.is_superuser:
-			return super().get_queryset(request)
+		return ShopAccess.for_request(request).filter_shops(super().get_queryset(request))
+
+	def get_actions(self, request):
+		actions = super().get_actions(request)
+		actions.pop('delete_selected', None)
+		return actions
+
+	#Удаляет магазины со всеми продуктами: в запросе или, если продуктов больше порога,
+	#фоновым заданием, которое удаляет магазин вместе с его последним продуктом
+	def delete_shops(self, request, queryset):
+		shop_ids = list(queryset.values_list('id', flat=True))
+		products = Product.objects.filter(shop_id__in=shop_ids)
+		if exceeds_threshold(products):
+			job = enqueue('delete_shops', products, 'Удалить магазины', user=request.user, shops=shop_ids,
+				user_id=request.user.pk)
+			self.message_user(request, background_job_message(job))
 		else:
-			return request.user.managed_shops.order_by(*self.ordering)
+			self.message_user(request, f'Удалено магазинов: {delete_shops(queryset, user_id=request.user.pk)}')
+
+	def shop_delete_counts(self, queryset):
+		return (('Магазинов', queryset.count()),) + product_delete_counts(
+			Product.objects.filter(shop__in=queryset.order_by().values('id')))
+
+	@admin.action(description='Удалить выбранные магазины', permissions=('delete',))
+	def delete_selected_shops(self, request, queryset):
+		if 'apply' in request.POST:
+			self.delete_shops(request, queryset)
+			return None
+		return render_delete_confirmation(self, request, 'Удалить магазины', self.shop_delete_counts(queryset),
+			action='delete_selected_shops')
+
+	def delete_view(self, request, object_id, extra_context=None):
+		obj = self.get_object(request, unquote(object_id))
+		if obj is None or not self.has_delete_permission(request, obj):
+			return super().delete_view(request, object_id, extra_context)
+		queryset = Shop.objects.filter(pk=obj.pk)
+		if request.method == 'POST' and 'apply' in request.POST:
+			self.delete_shops(request, queryset)
+			return HttpResponseRedirect(reverse('admin:core_shop_changelist'))
+		return render_delete_confirmation(self, request, f'Удалить магазин "{obj}"', self.shop_delete_counts(queryset))
 
 	def can_access_object(self, request, obj):
 		if obj is None:
 			return True
-		return request.user.managed_shops.filter(id=obj.id).exists()
+		return ShopAccess.for_request(request).has_shop(obj.id)
 
 	def has_view_permission(self, request, obj=None):
 		if request.user.is_superuser:
@@ -98,37 +183,68 @@ class ShopAdmin(admin.ModelAdmin, ShortDescriptionListFieldMixin):
 				return False
 
 
+class SubcategoriesFilter(admin.SimpleListFilter):
+	title = 'Учитывать подкатегории'
+	parameter_name = 'subcategories'
+
+	@classmethod
+	def is_enabled(cls, request):
+		return request.GET.get(cls.parameter_name) == '1'
+
+	def lookups(self, request, model_admin):
+		return (('1', 'Да'),)
+
+	def choices(self, changelist):
+		yield {
+			'selected': self.value() is None,
+			'query_string': changelist.get_query_string(remove=[self.parameter_name]),
+			'display': 'Нет',
+		}
+		yield {
+			'selected': self.value() == '1',
+			'query_string': changelist.get_query_string({self.parameter_name: '1'}),
+			'display': 'Да',
+		}
+
+	def queryset(self, request, queryset):
+		return queryset
+
+
 class ParentCategoryFilter(admin.SimpleListFilter):
 	title = 'Род. категория'
 	parameter_name = 'parents__id'
 
 	def lookups(self, request, model_admin):
-		objs = Category.objects.filter(from_category__isnull=False).only('title').distinct().order_by('title')
-		return [(o.pk, o.title) for o in objs]
+		return get_parent_category_choices()
 
 	def queryset(self, request, queryset):
 		value = self.value()
 		if value is not None:
+			if SubcategoriesFilter.is_enabled(request):
+				return queryset.filter(ancestor_links__ancestor_id=value, ancestor_links__depth__gt=0)
 			return queryset.filter(parents__id=self.value())
 		return queryset
 
 
+class CategoryChoiceField(forms.ModelMultipleChoiceField):
+	#Варианты подгружает виджет автодополнения, запрос к БД выполняется
+	#только для выбранных значений и их проверки
+	def __init__(self, queryset=None, **kwargs):
+		super().__init__(Category.objects.all() if queryset is None else queryset, **kwargs)
+
+	def set_exclude(self, pks):
+		self.queryset = Category.objects.exclude(pk__in=pks)
+
+
 class CategoryAdminForm(forms.ModelForm):
-	parents = forms.ModelMultipleChoiceField(label='Родительские категории',
-				queryset = Category.objects.only('title').order_by('title'),
+	parents = CategoryChoiceField(label='Родительские категории',
 				required=False,
-				widget=FilteredSelectMultiple(
-						verbose_name='Родительские категории',
-						is_stacked=False
-					))
+				widget=AutocompleteSelectMultiple(Category._meta.get_field('parents'), admin.site))
 
-	children = forms.ModelMultipleChoiceField(label='Дочерние категории',
-				queryset=Category.objects.only('title').order_by('title'),
+	children = CategoryChoiceField(label='Дочерние категории',
 				required=False,
-				widget=FilteredSelectMultipleWithReadonlyMode(
-						verbose_name='Дочерние категории',
-						is_stacked=False
-					)
+				widget=AutocompleteSelectMultipleWithReadonlyMode(
+						Category._meta.get_field('parents'), admin.site)
 				)
 
 	class Meta:
@@ -139,14 +255,12 @@ class CategoryAdminForm(forms.ModelForm):
 		super(CategoryAdminForm, self).__init__(*args, **kwargs)
 		instance = kwargs.get("instance")
 		if instance and instance.pk:
-			self.fields['parents'].queryset=Category.objects.filter(
-						~(Q(pk=instance.pk)|Q(pk__in=instance.category_set.values('id')))
-						).only('title').order_by('title')
-			self.fields['parents'].initial=instance.parents.all()
-			self.fields['children'].queryset=Category.objects.filter(
-							~(Q(pk=instance.pk)|Q(pk__in=instance.parents.values('id')))
-					).only('title').order_by('title')
-			self.fields['children'].initial=instance.category_set.all()
+			parents = list(instance.parents.only('title').order_by('title'))
+			children = list(instance.category_set.only('title').order_by('title'))
+			self.fields['parents'].set_exclude([instance.pk] + [c.pk for c in children])
+			self.fields['parents'].initial=parents
+			self.fields['children'].set_exclude([instance.pk] + [c.pk for c in parents])
+			self.fields['children'].initial=children
 			self.fields['children'].widget.attrs['readonly']=True
 
 	def save(self, commit=True):
@@ -171,19 +285,30 @@ class CategoryAdminForm(forms.ModelForm):
 
 
 @admin.register(Category)
-class CategoryAdmin(admin.ModelAdmin, ShortDescriptionListFieldMixin):
-	list_display = ('title','id', 'short_description', 'category_actions')
+class CategoryAdmin(KeysetPaginationMixin, admin.ModelAdmin, ShortDescriptionListFieldMixin):
+	list_display = ('title','id', 'product_count', 'active_product_count', 'short_description', 'category_actions')
 	search_fields = ('products__id', 'title')
-	list_filter = (ParentCategoryFilter,)
+	list_filter = (ParentCategoryFilter, SubcategoriesFilter)
 	ordering = ('title',)
 	readonly_fields = ('id',)
 	form = CategoryAdminForm
 
 	change_form_template = 'admin/category_change_form.html'
+	paths_per_page = 100
 
 	def get_fields(self, request, obj=None):
 		return ('id', 'title', 'description', 'parents', 'children')
 
+	def get_search_results(self, request, queryset, search_term):
+		#Автодополнение ищет только по названию (триграммный индекс по UPPER(title))
+		if request.resolver_match.url_name == 'autocomplete':
+			search_term = search_term.strip()
+			if search_term:
+				queryset = queryset.alias(title_upper=Upper('title')).filter(
+					title_upper__contains=search_term.upper())
+			return queryset, False
+		return super().get_search_results(request, queryset, search_term)
+
 	def get_urls(self):
 		urls = super().get_urls()
 		custom_urls = [
@@ -206,11 +331,19 @@ class CategoryAdmin(admin.ModelAdmin, ShortDescriptionListFieldMixin):
 
 	def process_paths(self, request, category_id, *args, **kwargs):
 		obj = self.get_object(request, category_id)
+		if obj is None:
+			return self._get_obj_does_not_exist_redirect(request, self.model._meta, str(category_id))
+		paths = obj.get_paths()
+		if request.GET.get('format') == 'txt':
+			response = StreamingHttpResponse((p+'\n' for p in paths),
+				content_type='text/plain; charset=utf-8')
+			response['Content-Disposition'] = f'attachment; filename="category_{obj.pk}_paths.txt"'
+			return response
 		context = self.admin_site.each_context(request)
 		context['opts'] = self.model._meta
-		paths = list(obj.get_all_paths())
-		context['paths'] = paths
-		context['title'] = f'Пути к категории {obj.title} ({len(paths)})'        
+		page = Paginator(paths, self.paths_per_page).get_page(request.GET.get('p'))
+		context['paths'] = page
+		context['title'] = f'Пути к категории {obj.title} ({len(paths)})'
 		return TemplateResponse(
 			request,
 			'admin/category_paths.html',
@@ -344,9 +477,9 @@ class ShopFilter(admin.SimpleListFilter):
 	parameter_name = 'shop__id'
 
 	def lookups(self, request, model_admin):
-		objs = Shop.objects if request.user.is_superuser else request.user.managed_shops
-		objs = objs.filter(products__isnull=False).only('title').distinct().order_by('title')
-		return [(o.pk, o.title) for o in objs]
+		objs = ShopAccess.for_request(request).filter_shops(Shop.objects.all())
+		objs = objs.filter(product_count__gt=0).only('title', 'product_count').order_by('title')
+		return [(o.pk, f'{o.title} ({o.product_count})') for o in objs]
 
 	def queryset(self, request, queryset):
 		value = self.value()
@@ -360,15 +493,23 @@ class CategoryFilter(admin.SimpleListFilter):
 	parameter_name = 'categories__id'
 
 	def lookups(self, request, model_admin):
-		filters = {'products__isnull': False}
-		if not request.user.is_superuser:
-			filters['products__shop__id__in']=request.user.managed_shops.values_list('id', flat=True)
-		objs = Category.objects.filter(**filters).only('title').distinct().order_by('title')
+		access = ShopAccess.for_request(request)
+		if access.is_superuser:
+			objs = Category.objects.filter(product_count__gt=0).only('title', 'product_count').order_by('title')
+			return [(o.pk, f'{o.title} ({o.product_count})') for o in objs]
+		#Полусоединение по таблице связей вместо JOIN с продуктами и DISTINCT
+		objs = Category.objects.filter(pk__in=Product.categories.through.objects.filter(
+			product__shop_id__in=access.shop_ids).values('category_id'))
+		objs = objs.only('title').order_by('title')
 		return [(o.pk, o.title) for o in objs]
 
 	def queryset(self, request, queryset):
 		value = self.value()
 		if value is not None:
+			if SubcategoriesFilter.is_enabled(request):
+				descendants = CategoryClosure.objects.filter(ancestor_id=value).values('descendant_id')
+				return queryset.filter(pk__in=Product.categories.through.objects.filter(
+					category_id__in=descendants).values('product_id'))
 			return queryset.filter(categories__id=self.value())
 		return queryset
 
@@ -376,7 +517,7 @@ class CategoryFilter(admin.SimpleListFilter):
 class OtherProductImagesInlineFormSet(BaseInlineFormSet):
 	def get_queryset(self):
 		qs = super(OtherProductImagesInlineFormSet, self).get_queryset()
-		return qs.only('image').order_by('id')[1:]
+		return qs.only('image', 'product', 'position').filter(position__gt=0).order_by('position')
 
 
 class ProductImagesInlineAdmin(admin.TabularInline):
@@ -386,6 +527,18 @@ class ProductImagesInlineAdmin(admin.TabularInline):
 	classes = ('collapse',)
 	formfield_overrides = {ImageField: {'widget': ImageWidget}}
 	verbose_name_plural = 'ДРУГИЕ ФОТО'
+	fields = ('image', 'make_main')
+	readonly_fields = ('make_main',)
+
+	#Кнопка отправляет отдельную форму перестановки фото (admin/product_change_form.html),
+	#несохраненные изменения продукта при этом не отправляются
+	def make_main(self, instance):
+		if instance.pk is None:
+			return ''
+		return format_html("<button type='submit' name='order' value='{}' form='product-images-reorder-form'"
+			" class='button'>{}</button>", instance.pk, 'Сделать основным')
+
+	make_main.short_description = 'Основное фото'
 
 
 class MainProductImageWidget(ImageWidget):
@@ -405,59 +558,135 @@ class ProductAdminForm(forms.ModelForm):
 		super(ProductAdminForm, self).__init__(*args, **kwargs)
 		instance = kwargs.get("instance")
 		if instance and instance.pk:
-			f = instance.images.only('image').first()
-			if f:
-				self.fields['main_image'].initial = f.image
+			name = main_image_name(instance.pk)
+			if name:
+				self.fields['main_image'].initial = ProductImage(product=instance, image=name).image
 		else:
 			self.fields['shop'].initial = self.fields['shop'].queryset.first()
 
 
+class ProductImportForm(forms.Form):
+	file = forms.FileField(label='Файл')
+	format = forms.ChoiceField(label='Формат', required=False,
+		choices=(('', 'По расширению файла'), ('csv', 'CSV'), ('jsonl', 'JSONL')))
+
+
+class ProductCategoriesForm(forms.Form):
+	categories = CategoryChoiceField(label='Категории',
+				widget=AutocompleteSelectMultiple(Product._meta.get_field('categories'), admin.site))
+
+
 class MyNumericRangeFilter(RangeNumericFilter):
 	template = 'admin/filter_numeric_range.html'
 
 
 @admin.register(Product)
-class ProductAdmin(NumericFilterModelAdmin, ShortDescriptionListFieldMixin):
-	list_display = ('title','main_image', 'id', 'amount', 'price', 'active', 'shop_id', 'short_description')
+class ProductAdmin(KeysetPaginationMixin, NumericFilterModelAdmin, ShortDescriptionListFieldMixin):
+	list_display = ('title','main_image', 'id', 'amount', 'price', 'active', 'shop_title', 'short_description')
+	list_select_related = ('shop',)
 	fieldsets = ((None, {'fields':('id', 'shop', 'title', 'description', 'active', 'amount', 'price')}),
 		('КАТЕГОРИИ', {'fields': ('categories',), 'classes': ('collapse',)}),
 		('ОСНОВНОЕ ФОТО', {'fields': ('main_image',)}),
 		)
 	search_fields = ('id', 'title')
 	list_filter = ('active',('price',MyNumericRangeFilter), 
-		ShopFilter, CategoryFilter)
+		ShopFilter, CategoryFilter, SubcategoriesFilter)
 	readonly_fields = ('id',)
-	filter_horizontal = ('categories',)
+	autocomplete_fields = ('shop', 'categories')
 	form = ProductAdminForm
 	inlines = (ProductImagesInlineAdmin,)
-	actions = ('make_active', 'make_inactive')
+	actions = ('make_active', 'make_inactive', 'add_categories', 'remove_categories', 'replace_categories',
+		'delete_products', 'export_csv', 'export_jsonl')
 	list_per_page = 50
+	import_errors_limit = 100
+	change_list_template = 'admin/product_change_list.html'
+	change_form_template = 'admin/product_change_form.html'
 
 	class Media:
 		css = {'all': ('css/productlist.css',)}
 
 	def main_image(self, instance):
-		url = instance.images.only('image').first()
+		url = instance.main_image_path
 		if url:
-			return format_html("<img src='{}{}' width=100 height=100 style='object-fit:contain' />",
-				settings.MEDIA_URL, url.image)
+			return format_html("<img src='{}' width=100 height=100 style='object-fit:contain' />",
+				thumbnail_url(url, 100))
 		else:
 			return format_html("<img alt='—' />")
 
 	main_image.short_description = 'Фото'
 
-	def formfield_for_manytomany(self, db_field, request, **kwargs):
-		if db_field.name == "categories":
-			kwargs["queryset"] = Category.objects.only('title').order_by('title')
-		return super().formfield_for_manytomany(db_field, request, **kwargs)
+	def shop_title(self, instance):
+		return instance.shop.title
+
+	shop_title.short_description = 'Магазин'
+	shop_title.admin_order_field = 'shop__title'
+
+	def get_urls(self):
+		urls = super().get_urls()
+		custom_urls = [
+			path(
+				'import/',
+				self.admin_site.admin_view(self.process_import),
+				name='product-import',
+			),
+			path(
+				'<path:object_id>/images/reorder/',
+				self.admin_site.admin_view(self.process_images_reorder),
+				name='product-images-reorder',
+			),
+		]
+		return custom_urls + urls
+
+	#Перестановка фото продукта: order - id фото в новом порядке (списком или через запятую),
+	#первое становится основным, не указанные фото идут следом в прежнем порядке
+	def process_images_reorder(self, request, object_id, *args, **kwargs):
+		if request.method != 'POST':
+			return HttpResponseNotAllowed(['POST'])
+		obj = self.get_object(request, unquote(object_id))
+		if obj is None:
+			return self._get_obj_does_not_exist_redirect(request, self.model._meta, str(object_id))
+		if not self.has_change_permission(request, obj):
+			raise PermissionDenied
+		try:
+			order = [int(pk) for value in request.POST.getlist('order') for pk in value.split(',') if pk.strip()]
+		except ValueError:
+			return HttpResponseBadRequest('Неверный порядок фото')
+		with transaction.atomic():
+			changed = renumber_product_images((obj.pk,), order)
+		self.message_user(request, f'Изменен порядок фото: {changed}')
+		return HttpResponseRedirect(reverse('admin:core_product_change', args=(obj.pk,)))
+
+	def process_import(self, request, *args, **kwargs):
+		if not self.has_add_permission(request):
+			raise PermissionDenied
+		context = self.admin_site.each_context(request)
+		context['opts'] = self.model._meta
+		context['title'] = 'Импорт продуктов'
+		if request.method == 'POST':
+			form = ProductImportForm(request.POST, request.FILES)
+			if form.is_valid():
+				f = form.cleaned_data['file']
+				errors = []
+				def on_error(line, messages):
+					if len(errors) < self.import_errors_limit:
+						errors.append((line, ' '.join(messages)))
+				importer = ProductImporter(on_error=on_error,
+					shops=ShopAccess.for_request(request).filter_shops(Shop.objects.all()))
+				context['created'], context['failed'] = importer.run(
+					iter_rows(f.file, form.cleaned_data['format'] or detect_format(f.name)))
+				context['errors'] = errors
+		else:
+			form = ProductImportForm()
+		context['form'] = form
+		return TemplateResponse(
+			request,
+			'admin/product_import.html',
+			context,
+		)
 
 	def formfield_for_foreignkey(self, db_field, request, **kwargs):
 		if db_field.name == 'shop':
-			qs = None
-			if not request.user.is_superuser:
-				qs = request.user.managed_shops
-			else:
-				qs = Shop.objects
+			qs = ShopAccess.for_request(request).filter_shops(Shop.objects.all())
 			kwargs['queryset']=qs.only('title').order_by('title')
 		return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
@@ -465,7 +694,7 @@ class ProductAdmin(NumericFilterModelAdmin, ShortDescriptionListFieldMixin):
 		main_image = form.fields['main_image']
 		new_image = form.cleaned_data.get('main_image')
 		if main_image.has_changed(main_image.initial, new_image):
-			fi = form.instance.images.first()
+			fi = form.instance.images.filter(position=0).first()
 			if new_image:
 				if fi:
 					fi.image = new_image
@@ -479,16 +708,17 @@ class ProductAdmin(NumericFilterModelAdmin, ShortDescriptionListFieldMixin):
 		super(ProductAdmin, self).save_formset(request, form, formset, change)
 
 	def get_queryset(self, request):
-		qs = super().get_queryset(request)
-		if request.user.is_superuser:
-			return qs
-		else:
-			return qs.filter(shop__id__in=request.user.managed_shops.values_list('id', flat=True))
+		qs = super().get_queryset(request).defer('search_vector').annotate(main_image_path=Subquery(
+			ProductImage.objects.filter(product=OuterRef('pk'), position=0).values('image')[:1]))
+		return ShopAccess.for_request(request).filter_shops(qs, 'shop_id')
+
+	def get_search_results(self, request, queryset, search_term):
+		return search_products(queryset, search_term), False
 
 	def can_access_object(self, request, obj):
 		if obj is None:
 			return True
-		return request.user.managed_shops.filter(id=obj.shop_id).exists()
+		return ShopAccess.for_request(request).has_shop(obj.shop_id)
 
 	def has_view_permission(self, request, obj=None):
 		if request.user.is_superuser:
@@ -517,10 +747,288 @@ class ProductAdmin(NumericFilterModelAdmin, ShortDescriptionListFieldMixin):
 			else:
 				return False
 
+	#Выполняет массовое действие в запросе или, если продуктов больше порога,
+	#ставит фоновое задание для команды runjobs
+	def run_bulk_action(self, request, queryset, description, action, message, **params):
+		if exceeds_threshold(queryset):
+			job = enqueue(action, queryset, description, user=request.user, **params)
+			self.message_user(request, background_job_message(job))
+		else:
+			self.message_user(request, message.format(run_action(action, queryset, **params)))
+
 	@admin.action(description='Сделать активными')
 	def make_active(self, request, queryset):
-		queryset.update(active=True)
+		self.run_bulk_action(request, queryset, 'Сделать активными', 'set_active',
+			'Изменено продуктов: {}', active=True)
 
 	@admin.action(description='Сделать неактивными')
 	def make_inactive(self, request, queryset):
-		queryset.update(active=False)
+		self.run_bulk_action(request, queryset, 'Сделать неактивными', 'set_active',
+			'Изменено продуктов: {}', active=False)
+
+	#Промежуточная страница выбора категорий для действий над категориями продуктов.
+	#Изменения выполняются несколькими запросами к таблице связей для всего queryset
+	def change_categories(self, request, queryset, title, action, message, required=True):
+		form = ProductCategoriesForm(request.POST if 'apply' in request.POST else None)
+		form.fields['categories'].required = required
+		if form.is_bound:
+			if form.is_valid():
+				self.run_bulk_action(request, queryset, title, action, message,
+					categories=[c.pk for c in form.cleaned_data['categories']])
+				return None
+		context = self.admin_site.each_context(request)
+		context.update({
+			'opts': self.model._meta,
+			'title': title,
+			'form': form,
+			'media': self.media + form.media,
+			'count': queryset.count(),
+			'action': request.POST['action'],
+			'select_across': request.POST.get('select_across', '0'),
+			'selected': request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+		})
+		return TemplateResponse(request, 'admin/product_categories_action.html', context)
+
+	@admin.action(description='Добавить категории', permissions=('change',))
+	def add_categories(self, request, queryset):
+		return self.change_categories(request, queryset, 'Добавить категории', 'add_categories',
+			'Добавлено связей с категориями: {}')
+
+	@admin.action(description='Удалить категории', permissions=('change',))
+	def remove_categories(self, request, queryset):
+		return self.change_categories(request, queryset, 'Удалить категории', 'remove_categories',
+			'Удалено связей с категориями: {}')
+
+	@admin.action(description='Заменить категории', permissions=('change',))
+	def replace_categories(self, request, queryset):
+		return self.change_categories(request, queryset, 'Заменить категории', 'replace_categories',
+			'Изменено связей с категориями: {}', required=False)
+
+	def get_actions(self, request):
+		actions = super().get_actions(request)
+		#Стандартное удаление строит дерево всех фото и удаляет их по одному
+		actions.pop('delete_selected', None)
+		return actions
+
+	@admin.action(description='Удалить выбранные продукты', permissions=('delete',))
+	def delete_products(self, request, queryset):
+		if 'apply' in request.POST:
+			self.run_bulk_action(request, queryset, 'Удалить продукты', 'delete_products', 'Удалено продуктов: {}',
+				user_id=request.user.pk)
+			return None
+		return render_delete_confirmation(self, request, 'Удалить продукты', product_delete_counts(queryset),
+			action='delete_products')
+
+	def export(self, queryset, fmt):
+		response = StreamingHttpResponse(export_lines(queryset, fmt), content_type=CONTENT_TYPES[fmt])
+		response['Content-Disposition'] = f'attachment; filename="products.{fmt}"'
+		return response
+
+	@admin.action(description='Экспорт в CSV')
+	def export_csv(self, request, queryset):
+		return self.export(queryset.using(read_database(request)), 'csv')
+
+	@admin.action(description='Экспорт в JSONL')
+	def export_jsonl(self, request, queryset):
+		return self.export(queryset.using(read_database(request)), 'jsonl')
+
+
+@admin.register(BackgroundJob)
+class BackgroundJobAdmin(admin.ModelAdmin):
+	list_display = ('__str__', 'status', 'progress', 'user', 'created_at', 'finished_at')
+	list_filter = ('status',)
+	fields = ('id', 'description', 'status', 'progress', 'user', 'created_at', 'started_at',
+		'finished_at', 'error')
+	readonly_fields = fields
+	actions = ('cancel_selected',)
+	change_form_template = 'admin/background_job_change_form.html'
+
+	def progress(self, instance):
+		if not instance.total:
+			return f'{instance.processed}'
+		return f'{instance.processed} / {instance.total} ({100*instance.processed//instance.total}%)'
+
+	progress.short_description = 'Прогресс'
+
+	def get_urls(self):
+		urls = super().get_urls()
+		custom_urls = [
+			path(
+				'<path:job_id>/cancel/',
+				self.admin_site.admin_view(self.process_cancel),
+				name='background-job-cancel',
+			),
+		]
+		return custom_urls + urls
+
+	def process_cancel(self, request, job_id, *args, **kwargs):
+		obj = self.get_object(request, unquote(job_id))
+		if obj is None:
+			return self._get_obj_does_not_exist_redirect(request, self.model._meta, str(job_id))
+		if request.method == 'POST' and cancel_jobs(BackgroundJob.objects.filter(pk=obj.pk)):
+			self.message_user(request, f'Задание {obj} отменено.')
+		return HttpResponseRedirect(reverse('admin:core_backgroundjob_change', args=(obj.pk,)))
+
+	@admin.action(description='Отменить задания')
+	def cancel_selected(self, request, queryset):
+		self.message_user(request, f'Отменено заданий: {cancel_jobs(queryset)}')
+
+	def get_queryset(self, request):
+		qs = super().get_queryset(request).select_related('user')
+		if request.user.is_superuser:
+			return qs
+		return qs.filter(user=request.user)
+
+	#Задания видны создавшему их пользователю, изменять их можно только отменой
+	def has_view_permission(self, request, obj=None):
+		return request.user.is_superuser or obj is None or obj.user_id == request.user.id
+
+	def has_add_permission(self, request):
+		return False
+
+	def has_change_permission(self, request, obj=None):
+		return False
+
+
+@admin.register(ViewStats)
+class ViewStatsAdmin(admin.ModelAdmin):
+	#Одна страница с таблицей по представлениям за последние hours часов
+	periods = (1, 24, 24*7)
+	slow_queries_limit = 5
+
+	def has_module_permission(self, request):
+		return request.user.is_superuser
+
+	def has_view_permission(self, request, obj=None):
+		return request.user.is_superuser
+
+	def has_add_permission(self, request):
+		return False
+
+	def has_change_permission(self, request, obj=None):
+		return False
+
+	def has_delete_permission(self, request, obj=None):
+		return request.user.is_superuser
+
+	def get_urls(self):
+		info = self.model._meta.app_label, self.model._meta.model_name
+		return [
+			path('', self.admin_site.admin_view(self.changelist_view), name='%s_%s_changelist' % info),
+			path('pools/', self.admin_site.admin_view(self.pools_view), name='connection-pools'),
+		]
+
+	#Счетчики пулов соединений процесса, обработавшего запрос, для сбора мониторингом
+	def pools_view(self, request):
+		if not self.has_view_permission(request):
+			raise PermissionDenied
+		return JsonResponse({'pid': os.getpid(), 'pools': pool_metrics()})
+
+	def changelist_view(self, request, extra_context=None):
+		if not self.has_view_permission(request):
+			raise PermissionDenied
+		try:
+			hours = int(request.GET.get('hours', 24))
+		except ValueError:
+			hours = 24
+		if request.method == 'POST' and 'clear' in request.POST:
+			ViewStats.objects.all().delete()
+			return HttpResponseRedirect(request.get_full_path())
+		since = timezone.now() - timedelta(hours=hours)
+		views = {}
+		for row in ViewStats.objects.filter(period__gt=since - timedelta(hours=1)).order_by('period'):
+			v = views.setdefault(row.view_name, {'view_name': row.view_name, 'requests': 0, 'errors': 0,
+				'total_ms': 0, 'max_ms': 0, 'histogram': [], 'queries': 0, 'max_queries': 0,
+				'query_ms': 0, 'slow_queries': []})
+			for field in ('requests', 'errors', 'total_ms', 'queries', 'query_ms'):
+				v[field] += getattr(row, field)
+			v['max_ms'] = max(v['max_ms'], row.max_ms)
+			v['max_queries'] = max(v['max_queries'], row.max_queries)
+			v['histogram'] = merge_histograms(v['histogram'], row.histogram)
+			v['slow_queries'] = merge_slow_queries(v['slow_queries'], row.slow_queries, self.slow_queries_limit)
+		rows = []
+		for v in views.values():
+			n = v['requests'] or 1
+			rows.append(dict(v, p50=percentile(v['histogram'], 50), p95=percentile(v['histogram'], 95),
+				p99=percentile(v['histogram'], 99), avg_queries=round(v['queries']/n, 1),
+				avg_query_ms=round(v['query_ms']/n, 1), total_s=round(v['total_ms']/1000, 1)))
+		rows.sort(key=lambda r: -r['total_ms'])
+		context = self.admin_site.each_context(request)
+		context.update({
+			'opts': self.model._meta,
+			'title': f'Статистика представлений за {hours} ч.',
+			'rows': rows,
+			'hours': hours,
+			'periods': self.periods,
+			'pid': os.getpid(),
+			'pools': pool_metrics(),
+		})
+		return TemplateResponse(request, 'admin/view_stats.html', context)
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+	list_display = ('created_at', 'method', 'path', 'view_name', 'status', 'duration', 'query_count', 'db_time')
+	list_filter = ('view_name',)
+	fields = ('id', 'user', 'created_at', 'method', 'path', 'view_name', 'status', 'duration_ms',
+		'query_count', 'query_ms')
+	readonly_fields = fields
+	change_form_template = 'admin/request_profile_change_form.html'
+
+	def duration(self, instance):
+		return f'{instance.duration_ms:.1f} мс'
+
+	duration.short_description = 'Время'
+	duration.admin_order_field = 'duration_ms'
+
+	def db_time(self, instance):
+		return f'{instance.query_ms:.1f} мс'
+
+	db_time.short_description = 'Время БД'
+	db_time.admin_order_field = 'query_ms'
+
+	def get_queryset(self, request):
+		return super().get_queryset(request).defer('stats', 'queries')
+
+	def get_urls(self):
+		urls = super().get_urls()
+		custom_urls = [
+			path(
+				'<path:profile_id>/download/',
+				self.admin_site.admin_view(self.process_download),
+				name='request-profile-download',
+			),
+		]
+		return custom_urls + urls
+
+	def process_download(self, request, profile_id, *args, **kwargs):
+		obj = self.get_object(request, unquote(profile_id))
+		if obj is None:
+			return self._get_obj_does_not_exist_redirect(request, self.model._meta, str(profile_id))
+		response = HttpResponse(bytes(obj.stats), content_type='application/octet-stream')
+		response['Content-Disposition'] = f'attachment; filename="profile_{obj.pk}.prof"'
+		return response
+
+	def change_view(self, request, object_id, form_url='', extra_context=None):
+		obj = self.get_object(request, unquote(object_id))
+		if obj is not None:
+			sort = request.GET.get('sort')
+			sort = sort if sort in SORT_KEYS else SORT_KEYS[0]
+			extra_context = dict(extra_context or {}, sort=sort, sort_keys=SORT_KEYS,
+				summary=stats_summary(obj.stats, sort), queries=obj.queries)
+		return super().change_view(request, object_id, form_url, extra_context)
+
+	def has_module_permission(self, request):
+		return request.user.is_superuser
+
+	def has_view_permission(self, request, obj=None):
+		return request.user.is_superuser
+
+	def has_add_permission(self, request):
+		return False
+
+	def has_change_permission(self, request, obj=None):
+		return False
+
+	def has_delete_permission(self, request, obj=None):
+		return request.user.is_superuser
@@ -0,0 +1,38 @@
+from django.db.backends.postgresql import base, creation
+from django.utils.asyncio import async_unsafe
+from core.pooling import get_pool, close_pools
+
+# Бэкенд PostgreSQL с пулом соединений (core.pooling). Настройки пула - в ключе POOL
+# псевдонима в DATABASES, CONN_MAX_AGE должен оставаться 0: соединение возвращается
+# в пул в конце каждого запроса.
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+	#Удаление и копирование базы требуют закрыть все соединения с ней, в том числе свободные в пуле
+	def _destroy_test_db(self, test_database_name, verbosity):
+		close_pools(test_database_name)
+		super()._destroy_test_db(test_database_name, verbosity)
+
+	def _clone_test_db(self, suffix, verbosity, keepdb=False):
+		close_pools(self.connection.settings_dict['NAME'])
+		super()._clone_test_db(suffix, verbosity, keepdb)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+	creation_class = DatabaseCreation
+
+	@async_unsafe
+	def get_new_connection(self, conn_params):
+		self.pool = get_pool(self.alias, conn_params, self.settings_dict.get('POOL', {}))
+		connection = self.pool.checkout(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+		#Для соединения из пула уровень изоляции задан при открытии
+		self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+		return connection
+
+	def _close(self):
+		if self.connection is not None:
+			with self.wrap_database_errors:
+				#Закрытое внутри atomic соединение остается у обертки, в пул его возвращать нельзя
+				if self.in_atomic_block:
+					self.connection.close()
+				self.pool.checkin(self.connection)
@@ -0,0 +1,155 @@
+import statistics
+import time
+import django
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from .models import Shop, Category, CategoryClosure, Product, ProductImage, check_category_edges
+
+# Набор сценариев для замера админки на текущих данных: время, кол-во и время
+# запросов к БД. Изменяющие данные сценарии выполняются в откатываемой транзакции.
+# Отчет - словарь, пригодный для сохранения в JSON и сравнения запусков.
+
+
+class Benchmark:
+	repeat = 5
+
+	def __init__(self, username=None, repeat=None, log=print):
+		self.repeat = repeat or self.repeat
+		self.log = log
+		if username:
+			self.user = User.objects.get(username=username)
+		else:
+			self.user = User.objects.filter(is_superuser=True, is_active=True).order_by('pk').first()
+			if self.user is None:
+				self.user = User.objects.create_superuser('benchmark', 'benchmark@example.com', None)
+		self.client = Client()
+		self.client.force_login(self.user)
+
+	def request(self, method, url, data=None):
+		response = getattr(self.client, method)(url, data or {})
+		if response.streaming:
+			size = sum(len(chunk) for chunk in response.streaming_content)
+		else:
+			size = len(response.content)
+		return {'status': response.status_code, 'bytes': size}
+
+	def get(self, url, data=None):
+		return lambda: self.request('get', url, data)
+
+	def post(self, url, data=None):
+		return lambda: self.request('post', url, data)
+
+	def check_edges(self, edges):
+		def run():
+			try:
+				check_category_edges(edges)
+			except ValidationError as e:
+				return {'errors': len(e.messages)}
+			return {'errors': 0}
+		return run
+
+	#Сценарии: (название, функция, откатывать ли изменения)
+	def scenarios(self):
+		products = '/admin/core/product/'
+		yield 'product_changelist', self.get(products), False
+		yield 'product_changelist_active', self.get(products, {'active__exact': '1'}), False
+		yield 'product_changelist_price', self.get(products, {'price_from': '100', 'price_to': '1000'}), False
+		product = Product.objects.order_by('-pk').first()
+		if product is not None:
+			yield 'product_changelist_shop', self.get(products, {'shop__id': product.shop_id}), False
+			word = product.title.split()[0]
+			yield 'product_changelist_search', self.get(products, {'q': word}), False
+			yield 'product_changelist_search_id', self.get(products, {'q': str(product.pk)}), False
+			yield 'product_change_form', self.get(f'{products}{product.pk}/change/'), False
+			yield 'bulk_make_inactive', self.post(products + f'?shop__id={product.shop_id}',
+				{'action': 'make_inactive', 'select_across': '1', 'index': '0',
+				'_selected_action': [product.pk]}), True
+		deepest = CategoryClosure.objects.order_by('-depth', 'pk').first()
+		if deepest is not None:
+			leaf, root = deepest.descendant_id, deepest.ancestor_id
+			yield 'product_changelist_category', self.get(products, {'categories__id': leaf}), False
+			yield 'product_changelist_subcategories', self.get(products,
+				{'categories__id': root, 'subcategories': '1'}), False
+			if product is not None:
+				yield 'bulk_add_categories', self.post(products + f'?shop__id={product.shop_id}',
+					{'action': 'add_categories', 'select_across': '1', 'apply': '1',
+					'_selected_action': [product.pk], 'categories': [leaf]}), True
+			category = Category.objects.get(pk=leaf)
+			yield 'category_change_form', self.get(f'/admin/core/category/{leaf}/change/'), False
+			yield 'category_change_form_save', self.post(f'/admin/core/category/{leaf}/change/', {
+				'title': category.title,
+				'description': category.description or '',
+				'parents': list(category.parents.values_list('pk', flat=True)),
+				'children': list(category.category_set.values_list('pk', flat=True)),
+			}), True
+			yield 'category_paths', self.get(f'/admin/core/category/{leaf}/paths/'), False
+			yield 'category_paths_txt', self.get(f'/admin/core/category/{leaf}/paths/', {'format': 'txt'}), False
+			yield 'category_cycle_check', self.check_edges([(root, leaf)]), False
+			yield 'category_edge_check', self.check_edges([(leaf, root)]), False
+		yield 'category_autocomplete', self.get('/admin/autocomplete/', {'term': 'а',
+			'app_label': 'core', 'model_name': 'product', 'field_name': 'categories'}), False
+
+	def measure(self, func, rollback):
+		times, query_counts, query_times = [], [], []
+		for i in range(self.repeat):
+			with CaptureQueriesContext(connection) as ctx:
+				start = time.perf_counter()
+				if rollback:
+					with transaction.atomic():
+						result = func()
+						transaction.set_rollback(True)
+				else:
+					result = func()
+				times.append((time.perf_counter() - start) * 1000)
+			query_counts.append(len(ctx.captured_queries))
+			query_times.append(sum(float(q['time']) for q in ctx.captured_queries) * 1000)
+		return dict(result,
+			min_ms=round(min(times), 2),
+			median_ms=round(statistics.median(times), 2),
+			max_ms=round(max(times), 2),
+			queries=max(query_counts),
+			query_ms=round(statistics.median(query_times), 2))
+
+	def run(self, only=None):
+		setup_test_environment()
+		try:
+			report = {
+				'created_at': timezone.now().isoformat(),
+				'django': django.get_version(),
+				'database': connection.vendor,
+				'user': self.user.username,
+				'repeat': self.repeat,
+				'data': {
+					'shops': Shop.objects.count(),
+					'categories': Category.objects.count(),
+					'category_depth': CategoryClosure.objects.order_by('-depth').values_list(
+						'depth', flat=True).first() or 0,
+					'products': Product.objects.count(),
+					'product_images': ProductImage.objects.count(),
+				},
+				'scenarios': {},
+			}
+			for name, func, rollback in self.scenarios():
+				if only and name not in only:
+					continue
+				report['scenarios'][name] = result = self.measure(func, rollback)
+				self.log(f"{name}: {result['median_ms']} мс, запросов {result['queries']}")
+			return report
+		finally:
+			teardown_test_environment()
+
+
+#Сравнивает медианное время и кол-во запросов сценариев двух отчетов
+def compare_reports(old, new):
+	rows = []
+	for name, result in new['scenarios'].items():
+		before = old['scenarios'].get(name)
+		if before is None:
+			continue
+		ratio = result['median_ms'] / before['median_ms'] if before['median_ms'] else None
+		rows.append((name, before['median_ms'], result['median_ms'], ratio, before['queries'], result['queries']))
+	return rows
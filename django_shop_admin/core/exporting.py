@@ -0,0 +1,67 @@
+import csv
+import json
+from collections import defaultdict
+from django.core.files.storage import default_storage
+from .models import Product, ProductImage
+
+# Потоковый экспорт продуктов в CSV/JSONL. Формат совместим с импортом,
+# дополнительно выгружаются идентификатор и URL фото.
+
+FIELDS = ('id', 'title', 'description', 'amount', 'price', 'active', 'shop', 'categories', 'images')
+
+CONTENT_TYPES = {
+	'csv': 'text/csv; charset=utf-8',
+	'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+
+#Перебирает продукты порциями по возрастанию id (keyset), каждая порция -
+#отдельный короткий запрос, поэтому выборка не держится в памяти целиком
+def iter_products(queryset, chunk_size=1000):
+	#Связанные данные читаются из той же базы, что и продукты
+	db = queryset.db
+	queryset = queryset.order_by('id').values_list(
+		'id', 'title', 'description', 'amount', 'price', 'active', 'shop__title')
+	last = 0
+	while True:
+		rows = list(queryset.filter(id__gt=last)[:chunk_size])
+		if not rows:
+			return
+		ids = [r[0] for r in rows]
+		categories = defaultdict(list)
+		for product_id, title in Product.categories.through.objects.using(db).filter(product_id__in=ids
+				).order_by('category__title').values_list('product_id', 'category__title'):
+			categories[product_id].append(title)
+		images = defaultdict(list)
+		for product_id, name in ProductImage.objects.using(db).filter(product_id__in=ids
+				).order_by('product_id', 'position').values_list('product_id', 'image'):
+			images[product_id].append(default_storage.url(name))
+		for r in rows:
+			yield dict(zip(FIELDS, r), categories=categories[r[0]], images=images[r[0]])
+		last = ids[-1]
+
+
+class Echo:
+	def write(self, value):
+		return value
+
+
+def csv_lines(products):
+	writer = csv.writer(Echo())
+	yield writer.writerow(FIELDS)
+	for p in products:
+		yield writer.writerow([
+			*(p[f] for f in FIELDS[:-2]),
+			'|'.join(p['categories']),
+			'|'.join(p['images']),
+		])
+
+
+def jsonl_lines(products):
+	for p in products:
+		yield json.dumps(p, ensure_ascii=False, default=str) + '\n'
+
+
+def export_lines(queryset, fmt):
+	products = iter_products(queryset)
+	return csv_lines(products) if fmt == 'csv' else jsonl_lines(products)
@@ -0,0 +1,127 @@
+import io
+import random
+from decimal import Decimal
+from django.contrib.auth.models import User, Group, Permission
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image
+from .models import (Shop, Category, CategoryParent, Product, ProductImage, rebuild_category_closure,
+	recount_product_counters, recount_stored_files, shop_image_path_handler, product_image_path_handler,
+	process_category_choices_change)
+from .permissions import groups_dict
+
+# Генерация синтетических данных для воспроизведения нагрузки локально:
+# магазины, ациклический граф категорий заданной глубины, продукты с фото
+# и менеджеры продуктов. Все объекты вставляются пакетами bulk_create.
+
+WORDS = ('Молоко', 'Хлеб', 'Сыр', 'Масло', 'Чай', 'Кофе', 'Сахар', 'Соль', 'Рис', 'Гречка',
+	'Яблоко', 'Груша', 'Сок', 'Вода', 'Мед', 'Орех', 'Шоколад', 'Печенье', 'Йогурт', 'Кефир')
+
+ADJECTIVES = ('свежий', 'домашний', 'отборный', 'фермерский', 'классический', 'легкий',
+	'натуральный', 'деревенский', 'органический', 'премиум')
+
+
+def _batches(items, size):
+	batch = []
+	for item in items:
+		batch.append(item)
+		if len(batch) >= size:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+
+def _image_content(rnd, size=64):
+	buf = io.BytesIO()
+	Image.new('RGB', (size, size), tuple(rnd.randrange(256) for i in range(3))).save(buf, 'JPEG')
+	return buf.getvalue()
+
+
+class DataGenerator:
+	batch_size = 1000
+
+	def __init__(self, prefix='Тест', seed=None, batch_size=None, log=print):
+		self.prefix = prefix
+		self.random = random.Random(seed)
+		self.batch_size = batch_size or self.batch_size
+		self.log = log
+
+	def shops(self, count):
+		shops = [Shop(title=f'{self.prefix} магазин {i}', description=f'Магазин {i}') for i in range(count)]
+		#Файлы без ссылок не должны попасть под фоновую очистку до вставки магазинов
+		with transaction.atomic():
+			for shop in shops:
+				shop.imageUrl = default_storage.save(shop_image_path_handler(shop, 'image.jpg'),
+					ContentFile(_image_content(self.random, 300)))
+			Shop.objects.bulk_create(shops, batch_size=self.batch_size)
+			recount_stored_files()
+		self.log(f'Магазинов: {len(shops)}')
+		return [s.pk for s in shops]
+
+	#Категории распределяются по уровням 0..depth-1, у категории уровня l > 0
+	#от 1 до fan_in родителей с меньших уровней, поэтому граф без циклов
+	def categories(self, count, depth, fan_in):
+		categories = Category.objects.bulk_create(
+			(Category(title=f'{self.prefix} категория {i}') for i in range(count)),
+			batch_size=self.batch_size)
+		ids = [c.pk for c in categories]
+		depth = max(1, min(depth, len(ids)))
+		levels = [ids[i::depth] for i in range(depth)]
+		edges = set()
+		for level in range(1, depth):
+			lower = [pk for l in levels[:level] for pk in l]
+			for pk in levels[level]:
+				parents = self.random.sample(levels[level-1], 1)
+				parents += self.random.sample(lower, min(self.random.randint(0, fan_in-1), len(lower)))
+				edges.update((pk, p) for p in parents)
+		CategoryParent.objects.bulk_create(
+			(CategoryParent(from_category_id=c, to_category_id=p) for c, p in edges),
+			batch_size=self.batch_size)
+		rebuild_category_closure()
+		process_category_choices_change(Category)
+		self.log(f'Категорий: {len(ids)}, связей: {len(edges)}, уровней: {depth}')
+		return ids
+
+	def products(self, count, shop_ids, category_ids, categories_per_product=3, images=1):
+		through = Product.categories.through
+		created = 0
+		for batch in _batches(range(count), self.batch_size):
+			with transaction.atomic():
+				products = Product.objects.bulk_create(Product(
+					title=f'{self.random.choice(WORDS)} {self.random.choice(ADJECTIVES)} {i}',
+					description=f'{self.random.choice(ADJECTIVES)} {self.random.choice(WORDS).lower()}',
+					amount=self.random.randint(0, 1000),
+					price=Decimal(self.random.randint(100, 1000000)) / 100,
+					active=self.random.random() < 0.8,
+					shop_id=self.random.choice(shop_ids),
+				) for i in batch)
+				if category_ids:
+					through.objects.bulk_create((through(product_id=p.pk, category_id=c) for p in products
+						for c in self.random.sample(category_ids,
+							min(self.random.randint(0, categories_per_product), len(category_ids)))),
+						ignore_conflicts=True)
+				images_batch = [ProductImage(product=p, position=i) for p in products for i in range(images)]
+				for image in images_batch:
+					image.image = default_storage.save(product_image_path_handler(image, 'image.jpg'),
+						ContentFile(_image_content(self.random)))
+				ProductImage.objects.bulk_create(images_batch)
+			created += len(products)
+			self.log(f'Продуктов: {created}/{count}')
+		recount_product_counters()
+		recount_stored_files()
+		return created
+
+	def managers(self, count, shop_ids, shops_per_manager=3):
+		group = Group.objects.get_or_create(name='product managers')[0]
+		group.permissions.set(Permission.objects.filter(codename__in=groups_dict['product managers']))
+		managers = []
+		for i in range(count):
+			user = User.objects.create_user(f'{self.prefix.lower()}_manager_{i}', password='manager',
+				is_staff=True)
+			user.groups.add(group)
+			user.managed_shops.set(self.random.sample(shop_ids, min(shops_per_manager, len(shop_ids))))
+			managers.append(user)
+		self.log(f'Менеджеров: {len(managers)}')
+		return managers
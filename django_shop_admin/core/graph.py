@@ -0,0 +1,154 @@
+from itertools import islice
+from collections import defaultdict
+
+# Алгоритмы над графом категорий в памяти.
+# Ребро графа - пара (дочерняя категория, родительская категория).
+
+
+def adjacency(edges):
+	adj = defaultdict(list)
+	for child, parent in edges:
+		adj[child].append(parent)
+	return adj
+
+
+def strongly_connected_components(adj):
+	# Итеративный алгоритм Тарьяна, O(V+E), без ограничения глубины рекурсии
+	index = {}
+	low = {}
+	on_stack = set()
+	stack = []
+	component = {}
+	counter = 0
+	nodes = set(adj)
+	for parents in adj.values():
+		nodes.update(parents)
+	for root in nodes:
+		if root in index:
+			continue
+		work = [(root, iter(adj.get(root, ())))]
+		index[root] = low[root] = counter
+		counter += 1
+		stack.append(root)
+		on_stack.add(root)
+		while work:
+			node, it = work[-1]
+			for nxt in it:
+				if nxt not in index:
+					index[nxt] = low[nxt] = counter
+					counter += 1
+					stack.append(nxt)
+					on_stack.add(nxt)
+					work.append((nxt, iter(adj.get(nxt, ()))))
+					break
+				elif nxt in on_stack:
+					low[node] = min(low[node], index[nxt])
+			else:
+				work.pop()
+				if work:
+					low[work[-1][0]] = min(low[work[-1][0]], low[node])
+				if low[node] == index[node]:
+					while True:
+						n = stack.pop()
+						on_stack.discard(n)
+						component[n] = node
+						if n == node:
+							break
+	return component
+
+
+#Возвращает ребра из new_edges, замыкающие цикл вместе с existing_edges.
+#existing_edges должны содержать все ребра, достижимые вверх
+#от родительских концов new_edges
+def find_cycle_edges(existing_edges, new_edges):
+	new_edges = list(new_edges)
+	adj = adjacency(existing_edges)
+	for child, parent in new_edges:
+		adj[child].append(parent)
+	component = strongly_connected_components(adj)
+	return [(c, p) for c, p in new_edges if c == p or component[c] == component[p]]
+
+
+#Число путей от корней до каждой вершины, достижимой вверх от node.
+#Корень имеет один (пустой) путь
+def count_paths(node, parents):
+	counts = {}
+	work = [node]
+	while work:
+		n = work[-1]
+		if n in counts:
+			work.pop()
+			continue
+		pending = [p for p in parents.get(n, ()) if p not in counts]
+		if pending:
+			work.extend(pending)
+		else:
+			work.pop()
+			ps = parents.get(n)
+			counts[n] = sum(counts[p] for p in ps) if ps else 1
+	return counts
+
+
+class CategoryPaths:
+	#Ленивая последовательность путей к категории в виде строк 'A / B / '.
+	#Количество считается динамическим программированием без перебора путей,
+	#срезы строятся с пропуском целых поддеревьев, а пути к вершинам
+	#с небольшим числом путей запоминаются
+	memo_limit = 1000
+
+	def __init__(self, node, edges, titles):
+		self.node = node
+		self.titles = dict(titles)
+		rank = {k: i for i, k in enumerate(self.titles)}
+		self.parents = {}
+		for child, parent in edges:
+			self.parents.setdefault(child, []).append(parent)
+		for ps in self.parents.values():
+			ps.sort(key=lambda p: rank.get(p, len(rank)))
+		self.counts = count_paths(node, self.parents)
+		self._memo = {}
+
+	def __len__(self):
+		return self.counts[self.node] if self.parents.get(self.node) else 0
+
+	def __iter__(self):
+		return self.iter_from(0)
+
+	def __getitem__(self, key):
+		if isinstance(key, slice):
+			start, stop, step = key.indices(len(self))
+			if step != 1:
+				return list(self)[key]
+			return list(islice(self.iter_from(start), max(stop - start, 0)))
+		if key < 0:
+			key += len(self)
+		if not 0 <= key < len(self):
+			raise IndexError(key)
+		return next(self.iter_from(key))
+
+	def iter_from(self, skip):
+		if not self.parents.get(self.node):
+			return iter(())
+		return self._prefixes(self.node, skip)
+
+	def _prefixes(self, node, skip):
+		if not self.parents.get(node):
+			if skip == 0:
+				yield ''
+			return
+		if self.counts[node] <= self.memo_limit:
+			if node not in self._memo:
+				self._memo[node] = list(self._generate(node, 0))
+			yield from islice(self._memo[node], skip, None)
+		else:
+			yield from self._generate(node, skip)
+
+	def _generate(self, node, skip):
+		for p in self.parents[node]:
+			if skip >= self.counts[p]:
+				skip -= self.counts[p]
+				continue
+			suffix = self.titles[p] + ' / '
+			for prefix in self._prefixes(p, skip):
+				yield prefix + suffix
+			skip = 0
@@ -0,0 +1,162 @@
+import csv
+import io
+import json
+import re
+from collections import Counter
+from decimal import Decimal, InvalidOperation
+from django.core.exceptions import ValidationError
+from django.db import transaction, IntegrityError, DatabaseError
+from .models import Shop, Category, Product, add_to_product_counters
+
+# Потоковый импорт продуктов из CSV/JSONL.
+# Поля строки: title, description, amount, price, active, shop (название),
+# categories (названия через '|' в CSV или список в JSONL).
+
+FORMATS = ('csv', 'jsonl')
+
+TITLE_RE = re.compile(r'^\S.*\S$', re.DOTALL)
+
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 'да', '+')
+
+
+def detect_format(filename):
+	ext = filename.rsplit('.', 1)[-1].lower()
+	return 'jsonl' if ext in ('jsonl', 'json', 'ndjson') else 'csv'
+
+
+#Лениво читает строки файла, возвращая пары (номер строки, словарь)
+def iter_rows(fileobj, fmt):
+	if isinstance(fileobj.read(0), bytes):
+		fileobj = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+	if fmt == 'csv':
+		reader = csv.DictReader(fileobj)
+		for row in reader:
+			yield reader.line_num, row
+	else:
+		for n, line in enumerate(fileobj, 1):
+			if not line.strip():
+				continue
+			try:
+				row = json.loads(line)
+			except ValueError as e:
+				yield n, e
+				continue
+			yield n, row if isinstance(row, dict) else ValueError('Ожидается объект JSON')
+
+
+def _value(row, key):
+	value = row.get(key)
+	if isinstance(value, str):
+		value = value.strip()
+	return value if value not in ('', None) else None
+
+
+class ProductImporter:
+	batch_size = 1000
+
+	def __init__(self, shops=None, batch_size=None, on_error=None):
+		shops = Shop.objects.all() if shops is None else shops
+		self.shops = dict(shops.values_list('title', 'id'))
+		self.categories = dict(Category.objects.values_list('title', 'id'))
+		self.batch_size = batch_size or self.batch_size
+		self.on_error = on_error or (lambda line, messages: None)
+		self.created = 0
+		self.failed = 0
+		self._batch = []
+
+	def error(self, line, messages):
+		self.failed += 1
+		self.on_error(line, messages)
+
+	def run(self, rows):
+		for line, row in rows:
+			if isinstance(row, Exception):
+				self.error(line, [str(row)])
+				continue
+			try:
+				self._batch.append((line, *self.build(row)))
+			except ValidationError as e:
+				self.error(line, e.messages)
+				continue
+			if len(self._batch) >= self.batch_size:
+				self.flush()
+		self.flush()
+		return self.created, self.failed
+
+	def build(self, row):
+		errors = []
+		#Значения JSONL могут быть любого типа, до использования проверяется тип
+		title = _value(row, 'title') or ''
+		if not isinstance(title, str) or not TITLE_RE.match(title):
+			errors.append('Неверное название продукта.')
+			title = ''
+		shop = _value(row, 'shop')
+		shop_id = self.shops.get(shop) if isinstance(shop, str) else None
+		if shop is not None and not isinstance(shop, str):
+			errors.append('Неверный магазин.')
+		elif shop_id is None:
+			errors.append(f"Магазин '{shop or ''}' не найден или недоступен.")
+		categories = _value(row, 'categories') or []
+		if isinstance(categories, str):
+			categories = [c.strip() for c in categories.split('|') if c.strip()]
+		elif not isinstance(categories, list):
+			errors.append('Неверный список категорий.')
+			categories = []
+		category_ids = set()
+		for c in categories:
+			if isinstance(c, str) and c in self.categories:
+				category_ids.add(self.categories[c])
+			else:
+				errors.append(f"Категория '{c}' не найдена.")
+		try:
+			price = Decimal(str(_value(row, 'price')))
+			if not price.is_finite():
+				raise InvalidOperation
+		except InvalidOperation:
+			price = None
+			errors.append('Неверная цена.')
+		active = _value(row, 'active')
+		if isinstance(active, str):
+			active = active.lower() in TRUE_VALUES
+		product = Product(title=title, description=_value(row, 'description'), amount=_value(row, 'amount') or 0,
+			price=price, active=True if active is None else bool(active), shop_id=shop_id)
+		try:
+			product.clean_fields(exclude=('shop',) + (('price',) if price is None else ()))
+		except ValidationError as e:
+			errors.extend(m for ms in e.message_dict.values() for m in ms)
+		if errors:
+			raise ValidationError(errors)
+		return product, category_ids
+
+	def flush(self):
+		batch, self._batch = self._batch, []
+		if not batch:
+			return
+		try:
+			with transaction.atomic():
+				self.insert(batch)
+		except (IntegrityError, DatabaseError):
+			#Пакет не прошел целиком - вставляем построчно, чтобы найти неверные строки
+			for item in batch:
+				item[1].pk = None
+				try:
+					with transaction.atomic():
+						self.insert([item])
+				except (IntegrityError, DatabaseError) as e:
+					self.error(item[0], [str(e).strip()])
+
+	def insert(self, batch):
+		Product.objects.bulk_create([p for line, p, cs in batch])
+		through = Product.categories.through
+		through.objects.bulk_create([through(product_id=p.pk, category_id=c)
+			for line, p, cs in batch for c in cs], ignore_conflicts=True)
+		shops, active_shops, categories, active_categories = Counter(), Counter(), Counter(), Counter()
+		for line, p, cs in batch:
+			shops[p.shop_id] += 1
+			active_shops[p.shop_id] += p.active
+			for c in cs:
+				categories[c] += 1
+				active_categories[c] += p.active
+		add_to_product_counters(Shop, shops, active_shops)
+		add_to_product_counters(Category, categories, active_categories)
+		self.created += len(batch)
@@ -0,0 +1,189 @@
+import logging
+import re
+import threading
+import time
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connections, transaction, DatabaseError
+from django.utils import timezone
+from .models import ViewStats
+
+# Статистика запросов по представлениям: время ответа (гистограмма для перцентилей),
+# кол-во и время запросов к БД, самые медленные SQL. Копится в памяти процесса
+# и периодически добавляется в таблицу view_stats одной транзакцией.
+
+logger = logging.getLogger(__name__)
+
+#Границы корзин гистограммы времени ответа, мс: 2^(k/4) от 1 мс до ~65 с
+BUCKETS = tuple(2 ** (k / 4) for k in range(65))
+
+IN_LIST_RE = re.compile(r'\((?:\s*%s\s*,)+\s*%s\s*\)')
+NUMBER_RE = re.compile(r'(?<![\w"])\d+(?:\.\d+)?\b')
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+
+
+def bucket_index(ms):
+	lo, hi = 0, len(BUCKETS)
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if BUCKETS[mid] < ms:
+			lo = mid + 1
+		else:
+			hi = mid
+	return lo
+
+
+#Перцентиль по гистограмме - верхняя граница корзины, в которую он попадает
+def percentile(histogram, p):
+	total = sum(histogram)
+	if not total:
+		return None
+	rank = p / 100 * total
+	seen = 0
+	for i, n in enumerate(histogram):
+		seen += n
+		if seen >= rank:
+			return round(BUCKETS[i], 1) if i < len(BUCKETS) else float('inf')
+	return None
+
+
+#Вид запроса без конкретных значений: параметры уже вынесены в %s,
+#остается свернуть списки IN и значения, подставленные в текст
+def fingerprint(sql):
+	sql = IN_LIST_RE.sub('(...)', sql)
+	sql = STRING_RE.sub('?', sql)
+	return NUMBER_RE.sub('?', sql)
+
+
+def merge_histograms(a, b):
+	if len(a) < len(b):
+		a, b = b, a
+	return [x + (b[i] if i < len(b) else 0) for i, x in enumerate(a)]
+
+
+#Объединяет списки медленных запросов [отпечаток, кол-во, всего мс, макс. мс],
+#оставляя limit самых медленных по максимальному времени
+def merge_slow_queries(a, b, limit):
+	merged = {sql: [sql, n, total, top] for sql, n, total, top in a}
+	for sql, n, total, top in b:
+		if sql in merged:
+			m = merged[sql]
+			m[1] += n
+			m[2] += total
+			m[3] = max(m[3], top)
+		else:
+			merged[sql] = [sql, n, total, top]
+	return sorted(merged.values(), key=lambda q: -q[3])[:limit]
+
+
+class ViewStatsCollector:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.stats = {}
+		self.last_flush = time.monotonic()
+
+	def add(self, view_name, ms, error, queries, query_ms, slowest):
+		with self.lock:
+			s = self.stats.get(view_name)
+			if s is None:
+				s = self.stats[view_name] = {
+					'requests': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+					'histogram': [0] * (len(BUCKETS) + 1), 'queries': 0, 'max_queries': 0,
+					'query_ms': 0.0, 'slow_queries': {},
+				}
+			s['requests'] += 1
+			s['errors'] += error
+			s['total_ms'] += ms
+			s['max_ms'] = max(s['max_ms'], ms)
+			s['histogram'][bucket_index(ms)] += 1
+			s['queries'] += queries
+			s['max_queries'] = max(s['max_queries'], queries)
+			s['query_ms'] += query_ms
+			if slowest is not None:
+				sql, sql_ms = slowest
+				q = s['slow_queries'].get(sql)
+				if q is None:
+					s['slow_queries'][sql] = [sql, 1, sql_ms, sql_ms]
+				else:
+					q[1] += 1
+					q[2] += sql_ms
+					q[3] = max(q[3], sql_ms)
+
+	def take(self):
+		with self.lock:
+			stats, self.stats = self.stats, {}
+			self.last_flush = time.monotonic()
+		return stats
+
+	def flush_due(self):
+		return time.monotonic() - self.last_flush >= settings.VIEW_STATS_FLUSH_INTERVAL
+
+	def flush(self):
+		stats = self.take()
+		if not stats:
+			return
+		limit = settings.VIEW_STATS_SLOW_QUERIES
+		period = timezone.now().replace(minute=0, second=0, microsecond=0)
+		try:
+			with transaction.atomic():
+				rows = {r.view_name: r for r in ViewStats.objects.select_for_update().filter(
+					period=period, view_name__in=list(stats))}
+				for view_name, s in stats.items():
+					row = rows.get(view_name) or ViewStats(view_name=view_name, period=period)
+					row.requests += s['requests']
+					row.errors += s['errors']
+					row.total_ms += s['total_ms']
+					row.max_ms = max(row.max_ms, s['max_ms'])
+					row.histogram = merge_histograms(row.histogram, s['histogram'])
+					row.queries += s['queries']
+					row.max_queries = max(row.max_queries, s['max_queries'])
+					row.query_ms += s['query_ms']
+					row.slow_queries = merge_slow_queries(row.slow_queries,
+						list(s['slow_queries'].values()), limit)
+					row.save()
+		except DatabaseError:
+			#Статистика не должна ломать обработку запросов, часть данных теряется
+			logger.exception('Не удалось сохранить статистику представлений')
+
+
+collector = ViewStatsCollector()
+
+
+class QueryTimer:
+	#Обертка выполнения запросов: считает кол-во и время, запоминает самый медленный
+	def __init__(self):
+		self.count = 0
+		self.ms = 0.0
+		self.slowest = None
+
+	def __call__(self, execute, sql, params, many, context):
+		start = time.perf_counter()
+		try:
+			return execute(sql, params, many, context)
+		finally:
+			ms = (time.perf_counter() - start) * 1000
+			self.count += 1
+			self.ms += ms
+			if self.slowest is None or ms > self.slowest[1]:
+				self.slowest = (sql, ms)
+
+
+class ViewStatsMiddleware:
+	def __init__(self, get_response):
+		self.get_response = get_response
+
+	def __call__(self, request):
+		timer = QueryTimer()
+		start = time.perf_counter()
+		with ExitStack() as stack:
+			for connection in connections.all():
+				stack.enter_context(connection.execute_wrapper(timer))
+			response = self.get_response(request)
+		ms = (time.perf_counter() - start) * 1000
+		match = getattr(request, 'resolver_match', None)
+		if match is not None:
+			slowest = (fingerprint(timer.slowest[0]), timer.slowest[1]) if timer.slowest else None
+			collector.add(match.view_name, ms, response.status_code >= 500, timer.count, timer.ms, slowest)
+			if collector.flush_due():
+				collector.flush()
+		return response
@@ -0,0 +1,138 @@
+import time
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Exists, OuterRef
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from .models import (BackgroundJob, Shop, Product, set_products_active, add_product_categories,
+	remove_product_categories, replace_product_categories, delete_products, delete_shops)
+
+# Фоновое выполнение массовых действий над продуктами без внешнего брокера:
+# задания хранятся в таблице background_jobs и выполняются командой runjobs
+# порциями по id, каждая порция - отдельная короткая транзакция.
+
+#Удаление магазинов: queryset - их продукты, магазин удаляется вместе с его последним продуктом
+def _delete_shops(queryset, shops, user_id=None):
+	deleted = delete_products(queryset)
+	delete_shops(Shop.objects.filter(pk__in=shops).filter(~Exists(Product.objects.filter(shop=OuterRef('pk')))),
+		user_id=user_id)
+	return deleted
+
+
+#Действие: функция (queryset, **params), возвращающая число изменений
+JOB_ACTIONS = {
+	'set_active': lambda queryset, active: set_products_active(queryset, active),
+	'add_categories': lambda queryset, categories: add_product_categories(queryset, categories),
+	'remove_categories': lambda queryset, categories: remove_product_categories(queryset, categories),
+	'replace_categories': lambda queryset, categories: sum(replace_product_categories(queryset, categories)),
+	'delete_products': lambda queryset, user_id=None: delete_products(queryset, user_id=user_id),
+	'delete_shops': _delete_shops,
+}
+
+#Задание в статусе "выполняется" без обновлений дольше этого времени
+#считается брошенным упавшим обработчиком и продолжается с последней порции
+STALE_TIMEOUT = timedelta(minutes=5)
+
+
+#Проверяет, больше ли в queryset продуктов, чем порог выполнения в запросе,
+#не считая все строки
+def exceeds_threshold(queryset):
+	threshold = settings.BACKGROUND_JOB_THRESHOLD
+	return queryset.order_by()[:threshold + 1].count() > threshold
+
+
+def run_action(action, queryset, **params):
+	return JOB_ACTIONS[action](queryset, **params)
+
+
+def enqueue(action, queryset, description, user=None, **params):
+	job = BackgroundJob(action=action, description=description, params=params, user=user)
+	job.set_queryset(queryset)
+	job.save()
+	return job
+
+
+#Отменяет задания, которые еще не завершены. Обработчик останавливается
+#перед следующей порцией, уже обработанные порции не откатываются
+def cancel_jobs(queryset):
+	return queryset.filter(status__in=BackgroundJob.ACTIVE_STATUSES).update(
+		status=BackgroundJob.CANCELLED, finished_at=timezone.now())
+
+
+def claim_job():
+	with transaction.atomic():
+		job = BackgroundJob.objects.select_for_update(skip_locked=True).filter(
+			Q(status=BackgroundJob.PENDING)
+			| Q(status=BackgroundJob.RUNNING, updated_at__lt=timezone.now() - STALE_TIMEOUT)
+		).order_by('id').first()
+		if job is not None:
+			job.status = BackgroundJob.RUNNING
+			job.started_at = job.started_at or timezone.now()
+			job.save(update_fields=('status', 'started_at', 'updated_at'))
+	return job
+
+
+def _update_job(job, **fields):
+	#Изменяет только выполняющееся задание, чтобы не затереть отмену
+	return BackgroundJob.objects.filter(pk=job.pk, status=BackgroundJob.RUNNING).update(
+		updated_at=timezone.now(), **fields)
+
+
+def run_job(job, chunk_size=None):
+	chunk_size = chunk_size or settings.BACKGROUND_JOB_CHUNK_SIZE
+	try:
+		queryset = job.get_queryset()
+		if job.total is None:
+			job.total = queryset.count()
+			_update_job(job, total=job.total)
+		while True:
+			ids = list(queryset.filter(id__gt=job.last_id).order_by('id')
+				.values_list('id', flat=True)[:chunk_size])
+			if not ids:
+				_update_job(job, status=BackgroundJob.DONE, finished_at=timezone.now())
+				return
+			with transaction.atomic():
+				#Строка задания блокируется на время порции: отмена дождется ее окончания
+				job.processed += len(ids)
+				if not _update_job(job, last_id=ids[-1], processed=job.processed):
+					return
+				run_action(job.action, queryset.filter(id__gt=job.last_id, id__lte=ids[-1]), **job.params)
+			job.last_id = ids[-1]
+	except Exception:
+		_update_job(job, status=BackgroundJob.FAILED, error=traceback.format_exc(),
+			finished_at=timezone.now())
+		raise
+
+
+#Удаляет файлы без ссылок, если хранилище их считает
+def sweep_files(log=print):
+	sweep = getattr(default_storage, 'sweep', None)
+	while sweep is not None:
+		swept = sweep()
+		if not swept:
+			return
+		log(f'Удалено файлов без ссылок: {swept}')
+
+
+#Выполняет задания по очереди, при пустой очереди удаляет файлы без ссылок
+#и ждет sleep секунд. С once=True завершается, когда очередь пуста
+def work(once=False, sleep=2, chunk_size=None, log=print):
+	while True:
+		job = claim_job()
+		if job is None:
+			sweep_files(log)
+			if once:
+				return
+			time.sleep(sleep)
+			continue
+		log(f'Задание {job}: начато')
+		try:
+			run_job(job, chunk_size)
+		except Exception:
+			log(f'Задание {job}: ошибка')
+			log(traceback.format_exc())
+			continue
+		job.refresh_from_db(fields=('status', 'processed'))
+		log(f'Задание {job}: {job.get_status_display().lower()}, обработано продуктов {job.processed}')
@@ -0,0 +1,32 @@
+import json
+from django.core.management.base import BaseCommand
+from core.benchmark import Benchmark, compare_reports
+
+
+class Command(BaseCommand):
+    help = 'Замеряет время и запросы к БД основных страниц и действий админки, выводит отчет JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='Путь к файлу отчета, по умолчанию стандартный вывод.')
+        parser.add_argument('--compare', help='Путь к отчету прошлого запуска для сравнения.')
+        parser.add_argument('--repeat', type=int, default=Benchmark.repeat,
+            help='Кол-во повторов каждого сценария.')
+        parser.add_argument('--user', help='Имя пользователя, по умолчанию первый суперпользователь.')
+        parser.add_argument('--scenario', action='append', default=[],
+            help='Название сценария, можно указать несколько раз.')
+
+    def handle(self, *args, **options):
+        log = print if options['output'] else (lambda message: None)
+        report = Benchmark(username=options['user'], repeat=options['repeat'], log=log).run(options['scenario'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        else:
+            print(json.dumps(report, ensure_ascii=False, indent=2))
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as f:
+                old = json.load(f)
+            print(f"{'Сценарий':<36}{'было, мс':>12}{'стало, мс':>12}{'x':>8}{'запросы':>12}")
+            for name, before, after, ratio, queries_before, queries_after in compare_reports(old, report):
+                ratio = f'{ratio:.2f}' if ratio is not None else '-'
+                print(f"{name:<36}{before:>12}{after:>12}{ratio:>8}{queries_before:>6} -> {queries_after}")
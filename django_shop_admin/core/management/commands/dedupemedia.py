@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.core.files.storage import default_storage
+from core.storage import dedupe_media
+
+
+class Command(BaseCommand):
+    help = 'Переводит загруженные фото магазинов и продуктов на имена по содержимому, удаляя дубликаты.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+            help='Только посчитать дубликаты, ничего не изменяя.')
+
+    def handle(self, *args, **options):
+        stats = dedupe_media(default_storage, dry_run=options['dry_run'])
+        print(f"Файлов: {stats['files']}, перенесено: {stats['moved']}, дубликатов: {stats['merged']}, "
+            f"нет на диске: {stats['missing']}, освобождено: {stats['freed_bytes'] / 1024 / 1024:.1f} МБ")
@@ -0,0 +1,28 @@
+import sys
+from django.core.management.base import BaseCommand
+from core.models import Product
+from core.exporting import export_lines, CONTENT_TYPES
+from core.routers import read_database
+
+
+class Command(BaseCommand):
+    help = 'Экспортирует продукты в файл CSV или JSONL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=tuple(CONTENT_TYPES), default='csv',
+            help='Формат файла.')
+        parser.add_argument('--output', help='Путь к файлу, по умолчанию стандартный вывод.')
+        parser.add_argument('--shop', action='append', default=[],
+            help='Название магазина, можно указать несколько раз.')
+
+    def handle(self, *args, **options):
+        queryset = Product.objects.using(read_database())
+        if options['shop']:
+            queryset = queryset.filter(shop__title__in=options['shop'])
+        out = open(options['output'], 'w', encoding='utf-8', newline='') if options['output'] else sys.stdout
+        try:
+            for line in export_lines(queryset, options['format']):
+                out.write(line)
+        finally:
+            if out is not sys.stdout:
+                out.close()
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from core.generating import DataGenerator
+
+
+class Command(BaseCommand):
+    help = 'Генерирует синтетические магазины, категории, продукты с фото и менеджеров.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shops', type=int, default=20, help='Кол-во магазинов.')
+        parser.add_argument('--products', type=int, default=10000, help='Кол-во продуктов.')
+        parser.add_argument('--categories', type=int, default=500, help='Кол-во категорий.')
+        parser.add_argument('--depth', type=int, default=6, help='Кол-во уровней графа категорий.')
+        parser.add_argument('--fan-in', type=int, default=2,
+            help='Наибольшее кол-во родительских категорий у категории.')
+        parser.add_argument('--categories-per-product', type=int, default=3,
+            help='Наибольшее кол-во категорий у продукта.')
+        parser.add_argument('--images', type=int, default=1, help='Кол-во фото у продукта.')
+        parser.add_argument('--managers', type=int, default=5, help='Кол-во менеджеров продуктов.')
+        parser.add_argument('--prefix', default='Тест',
+            help='Префикс названий магазинов, категорий и имен менеджеров.')
+        parser.add_argument('--seed', type=int, help='Начальное значение генератора случайных чисел.')
+        parser.add_argument('--batch-size', type=int, default=DataGenerator.batch_size,
+            help='Количество объектов, вставляемых одним запросом.')
+
+    def handle(self, *args, **options):
+        generator = DataGenerator(prefix=options['prefix'], seed=options['seed'],
+            batch_size=options['batch_size'])
+        shop_ids = generator.shops(options['shops'])
+        category_ids = generator.categories(options['categories'], options['depth'], options['fan_in'])
+        generator.products(options['products'], shop_ids, category_ids,
+            options['categories_per_product'], options['images'])
+        generator.managers(options['managers'], shop_ids)
+        print("Миниатюры фото можно создать командой makethumbnails")
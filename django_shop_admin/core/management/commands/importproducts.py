@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from core.importing import ProductImporter, iter_rows, detect_format, FORMATS
+
+
+class Command(BaseCommand):
+    help = 'Импортирует продукты из файла CSV или JSONL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к файлу.')
+        parser.add_argument('--format', choices=FORMATS,
+            help='Формат файла, по умолчанию определяется по расширению.')
+        parser.add_argument('--batch-size', type=int, default=ProductImporter.batch_size,
+            help='Количество продуктов, вставляемых одним запросом.')
+
+    def handle(self, *args, **options):
+        def on_error(line, messages):
+            print(f" - строка {line}: {' '.join(messages)}")
+
+        importer = ProductImporter(batch_size=options['batch_size'], on_error=on_error)
+        with open(options['path'], 'rb') as f:
+            created, failed = importer.run(iter_rows(f, options['format'] or detect_format(options['path'])))
+        print(f"Создано: {created}, ошибок: {failed}")
@@ -0,0 +1,36 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import django
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from core.models import Shop, ProductImage
+from core.thumbnails import make_thumbnails, has_thumbnails
+
+
+class Command(BaseCommand):
+    help = 'Создает миниатюры для уже загруженных фото магазинов и продуктов.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.THUMBNAIL_WORKERS,
+            help='Количество процессов.')
+        parser.add_argument('--force', action='store_true',
+            help='Пересоздать уже существующие миниатюры.')
+
+    def names(self, force):
+        shops = Shop.objects.exclude(imageUrl__isnull=True).exclude(imageUrl='')
+        for qs in (shops.values_list('imageUrl', flat=True),
+                ProductImage.objects.values_list('image', flat=True)):
+            for name in qs.iterator():
+                if force or not has_thumbnails(name):
+                    yield name
+
+    def handle(self, *args, **options):
+        done = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as executor:
+            futures = {executor.submit(make_thumbnails, name): name for name in self.names(options['force'])}
+            for future in as_completed(futures):
+                if future.exception() is None:
+                    done += 1
+                else:
+                    failed += 1
+                    print(f" - {futures[future]}: {future.exception()}")
+        print(f"Создано: {done}, ошибок: {failed}")
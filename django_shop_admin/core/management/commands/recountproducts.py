@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from core.models import recount_product_counters
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счетчики продуктов магазинов и категорий.'
+
+    def handle(self, *args, **options):
+        recount_product_counters()
+        print("Счетчики пересчитаны")
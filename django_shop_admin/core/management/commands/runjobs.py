@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from core.jobs import work
+
+
+class Command(BaseCommand):
+    help = 'Выполняет фоновые задания массовых действий над продуктами.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+            help='Завершиться, когда очередь заданий пуста.')
+        parser.add_argument('--sleep', type=float, default=2,
+            help='Пауза в секундах между проверками пустой очереди.')
+        parser.add_argument('--chunk-size', type=int,
+            help='Кол-во продуктов в одной транзакции.')
+
+    def handle(self, *args, **options):
+        work(once=options['once'], sleep=options['sleep'], chunk_size=options['chunk_size'])
@@ -0,0 +1,47 @@
+# Generated by Django 3.2.6 on 2026-10-17 00:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_auto_20210817_1649'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField(verbose_name='Глубина')),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='core.category', verbose_name='Предок')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='core.category', verbose_name='Потомок')),
+            ],
+            options={
+                'verbose_name': 'Предок категории',
+                'verbose_name_plural': 'Предки категорий',
+                'db_table': 'category_closure',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='categoryclosure',
+            constraint=models.UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_category_closure'),
+        ),
+        migrations.RunSQL(
+            sql=[
+                "INSERT INTO category_closure (ancestor_id, descendant_id, depth) "
+                "SELECT id, id, 0 FROM categories",
+                "INSERT INTO category_closure (ancestor_id, descendant_id, depth) "
+                "WITH RECURSIVE up(descendant_id, ancestor_id, depth) AS ("
+                " SELECT from_category_id, to_category_id, 1 FROM core_categoryparent"
+                " UNION"
+                " SELECT up.descendant_id, cp.to_category_id, up.depth + 1 FROM core_categoryparent cp"
+                " JOIN up ON cp.from_category_id = up.ancestor_id"
+                ") SELECT ancestor_id, descendant_id, MIN(depth) FROM up"
+                " GROUP BY ancestor_id, descendant_id",
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.2.6 on 2026-10-17 00:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_category_closure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='active_product_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Кол-во активных продуктов'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='product_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Кол-во продуктов'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='active_product_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Кол-во активных продуктов'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='product_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Кол-во продуктов'),
+        ),
+        migrations.RunSQL(
+            sql=[
+                "UPDATE shops SET"
+                " product_count = (SELECT COUNT(*) FROM products WHERE products.shop_id = shops.id),"
+                " active_product_count = (SELECT COUNT(*) FROM products WHERE products.shop_id = shops.id AND products.active)",
+                "UPDATE categories SET"
+                " product_count = (SELECT COUNT(*) FROM products_categories pc WHERE pc.category_id = categories.id),"
+                " active_product_count = (SELECT COUNT(*) FROM products_categories pc"
+                " JOIN products ON products.id = pc.product_id WHERE pc.category_id = categories.id AND products.active)",
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.6 on 2026-10-17 00:39
+
+from django.contrib.postgres.operations import TrigramExtension
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_product_counters'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            sql=[
+                "CREATE FUNCTION products_search_vector_update() RETURNS trigger AS $$"
+                " BEGIN"
+                " NEW.search_vector :="
+                " setweight(to_tsvector('russian', coalesce(NEW.title, '')), 'A') ||"
+                " setweight(to_tsvector('russian', coalesce(NEW.description, '')), 'B');"
+                " RETURN NEW;"
+                " END"
+                " $$ LANGUAGE plpgsql",
+                "CREATE TRIGGER products_search_vector_trigger"
+                " BEFORE INSERT OR UPDATE OF title, description, search_vector ON products"
+                " FOR EACH ROW EXECUTE FUNCTION products_search_vector_update()",
+                "UPDATE products SET search_vector ="
+                " setweight(to_tsvector('russian', coalesce(title, '')), 'A') ||"
+                " setweight(to_tsvector('russian', coalesce(description, '')), 'B')",
+            ],
+            reverse_sql=[
+                "DROP TRIGGER products_search_vector_trigger ON products",
+                "DROP FUNCTION products_search_vector_update()",
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='product_search_vector_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('title'), name='gin_trgm_ops'), name='product_title_trgm_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.6 on 2026-10-17 00:42
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0009_product_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackgroundJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(max_length=50, verbose_name='Действие')),
+                ('description', models.CharField(max_length=200, verbose_name='Описание')),
+                ('params', models.JSONField(blank=True, default=dict, verbose_name='Параметры')),
+                ('query', models.BinaryField(verbose_name='Запрос продуктов')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Выполняется'), ('done', 'Завершено'), ('failed', 'Ошибка'), ('cancelled', 'Отменено')], db_index=True, default='pending', max_length=10, verbose_name='Статус')),
+                ('total', models.PositiveIntegerField(blank=True, null=True, verbose_name='Всего продуктов')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='Обработано продуктов')),
+                ('last_id', models.BigIntegerField(default=0, verbose_name='Последний обработанный id')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Начато')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Завершено')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='background_jobs', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Фоновое задание',
+                'verbose_name_plural': 'Фоновые задания',
+                'db_table': 'background_jobs',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.6 on 2026-10-17 00:45
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_background_jobs'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='category',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('title'), name='gin_trgm_ops'), name='category_title_trgm_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shop',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('title'), name='gin_trgm_ops'), name='shop_title_trgm_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.6 on 2026-10-17 00:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_title_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ViewStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('view_name', models.CharField(max_length=200, verbose_name='Представление')),
+                ('period', models.DateTimeField(verbose_name='Час')),
+                ('requests', models.PositiveIntegerField(default=0, verbose_name='Запросов')),
+                ('errors', models.PositiveIntegerField(default=0, verbose_name='Ошибок')),
+                ('total_ms', models.FloatField(default=0, verbose_name='Общее время, мс')),
+                ('max_ms', models.FloatField(default=0, verbose_name='Макс. время, мс')),
+                ('histogram', models.JSONField(default=list, verbose_name='Гистограмма времени')),
+                ('queries', models.PositiveIntegerField(default=0, verbose_name='Запросов к БД')),
+                ('max_queries', models.PositiveIntegerField(default=0, verbose_name='Макс. запросов к БД')),
+                ('query_ms', models.FloatField(default=0, verbose_name='Время запросов к БД, мс')),
+                ('slow_queries', models.JSONField(default=list, verbose_name='Медленные запросы')),
+            ],
+            options={
+                'verbose_name': 'Статистика представления',
+                'verbose_name_plural': 'Статистика представлений',
+                'db_table': 'view_stats',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='viewstats',
+            constraint=models.UniqueConstraint(fields=('view_name', 'period'), name='unique_view_stats_period'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.6 on 2026-10-17 00:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0012_view_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создан')),
+                ('method', models.CharField(max_length=10, verbose_name='Метод')),
+                ('path', models.CharField(max_length=1000, verbose_name='Адрес')),
+                ('view_name', models.CharField(blank=True, max_length=200, verbose_name='Представление')),
+                ('status', models.PositiveIntegerField(verbose_name='Код ответа')),
+                ('duration_ms', models.FloatField(verbose_name='Время, мс')),
+                ('query_count', models.PositiveIntegerField(verbose_name='Запросов к БД')),
+                ('query_ms', models.FloatField(verbose_name='Время запросов к БД, мс')),
+                ('stats', models.BinaryField(verbose_name='Статистика cProfile')),
+                ('queries', models.JSONField(default=list, verbose_name='Запросы к БД')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Профиль запроса',
+                'verbose_name_plural': 'Профили запросов',
+                'db_table': 'request_profiles',
+            },
+        ),
+    ]
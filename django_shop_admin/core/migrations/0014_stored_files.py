@@ -0,0 +1,46 @@
+# Generated by Django 3.2.6 on 2026-10-17 00:54
+
+import core.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_request_profiles'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False, verbose_name='Имя файла')),
+                ('refs', models.IntegerField(default=0, verbose_name='Кол-во ссылок')),
+            ],
+            options={
+                'verbose_name': 'Файл',
+                'verbose_name_plural': 'Файлы',
+                'db_table': 'stored_files',
+            },
+        ),
+        migrations.AlterField(
+            model_name='productimage',
+            name='image',
+            field=models.ImageField(db_index=True, upload_to=core.models.product_image_path_handler, verbose_name='Фото'),
+        ),
+        migrations.AlterField(
+            model_name='shop',
+            name='imageUrl',
+            field=models.ImageField(blank=True, db_index=True, null=True, upload_to=core.models.shop_image_path_handler, verbose_name='Фото'),
+        ),
+        migrations.RunSQL(
+            sql=[
+                "INSERT INTO stored_files (name, refs)"
+                " SELECT name, COUNT(*) FROM ("
+                "SELECT image AS name FROM productimages"
+                " UNION ALL SELECT \"imageUrl\" FROM shops WHERE \"imageUrl\" <> ''"
+                ") r GROUP BY name",
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
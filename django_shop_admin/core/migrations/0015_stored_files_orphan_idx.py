@@ -0,0 +1,17 @@
+# Generated by Django 3.2.6 on 2026-10-17 00:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_stored_files'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='storedfile',
+            index=models.Index(condition=models.Q(('refs__lte', 0)), fields=['refs'], name='stored_files_orphan_idx'),
+        ),
+    ]
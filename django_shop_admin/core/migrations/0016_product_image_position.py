@@ -0,0 +1,35 @@
+# Generated by Django 3.2.6 on 2026-10-17 01:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_stored_files_orphan_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productimage',
+            name='position',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Порядок'),
+            preserve_default=False,
+        ),
+        migrations.RunSQL(
+            sql=[
+                "UPDATE productimages i SET position = r.n - 1 FROM ("
+                " SELECT id, ROW_NUMBER() OVER (PARTITION BY product_id ORDER BY id) n FROM productimages"
+                ") r WHERE i.id = r.id",
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='productimage',
+            constraint=models.UniqueConstraint(deferrable=models.Deferrable['DEFERRED'], fields=('product', 'position'), name='unique_product_image_position'),
+        ),
+        migrations.AddIndex(
+            model_name='productimage',
+            index=models.Index(condition=models.Q(('position', 0)), fields=['product'], include=('image',), name='product_main_image_idx'),
+        ),
+    ]
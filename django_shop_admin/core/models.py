@@ -1,13 +1,25 @@
 from django.db.models import (Model, CharField, TextField, ImageField, 
 	BooleanField, PositiveIntegerField, DecimalField, ForeignKey, ManyToManyField,
-	CASCADE, CheckConstraint, UniqueConstraint, Q, F)
+	IntegerField, BigIntegerField, FloatField, JSONField, BinaryField, DateTimeField, CASCADE, SET_NULL,
+	CheckConstraint, UniqueConstraint, Deferrable, Index, Q, F, Case, When, Value, Count, Max, Subquery, OuterRef)
+from django.db.models.functions import Coalesce, Upper
+from django.contrib.postgres.search import SearchVectorField
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.conf import settings
-from django.db import transaction
+from django.db import transaction, connection, connections, router
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_init, post_save, pre_delete, post_delete
 import uuid
+import pickle
 from django.core.validators import MinValueValidator
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.admin.models import LogEntry, DELETION
+from django.contrib.contenttypes.models import ContentType
+from .graph import find_cycle_edges, CategoryPaths
+from .thumbnails import schedule_thumbnails, delete_thumbnails
+from django_cleanup.signals import cleanup_pre_delete
+from .storage import ContentAddressedStorage
 
 # Create your models here.
 
@@ -18,9 +30,11 @@ class Shop(Model):
 	title = CharField(verbose_name='Название', max_length=50, unique=True)
 	description = TextField(verbose_name='Описание', null=True, blank=True)
 	imageUrl = ImageField(verbose_name="Фото", null=True, blank=True, 
-		upload_to=shop_image_path_handler, unique=True)
+		upload_to=shop_image_path_handler, db_index=True)
 	product_managers = ManyToManyField(User, limit_choices_to=Q(groups__name='product managers'),
 		related_name='managed_shops', verbose_name='Менеджеры продуктов', blank=True)
+	product_count = IntegerField(verbose_name='Кол-во продуктов', default=0, editable=False)
+	active_product_count = IntegerField(verbose_name='Кол-во активных продуктов', default=0, editable=False)
 
 	def __str__(self):
 		return self.title
@@ -32,6 +46,9 @@ class Shop(Model):
 		constraints = (
 				CheckConstraint(check=Q(title__iregex=r'^\S.*\S$'), name='shop_title_check'),
 		)
+		indexes = (
+				GinIndex(OpClass(Upper('title'), name='gin_trgm_ops'), name='shop_title_trgm_idx'),
+			)
 
 
 class Category(Model):
@@ -39,20 +56,20 @@ class Category(Model):
 	description = TextField(verbose_name='Описание', null=True, blank=True)
 	parents = ManyToManyField('self', symmetrical=False, through='CategoryParent', 
 		blank=True, verbose_name='Родительские категории')
+	product_count = IntegerField(verbose_name='Кол-во продуктов', default=0, editable=False)
+	active_product_count = IntegerField(verbose_name='Кол-во активных продуктов', default=0, editable=False)
 
 	def __str__(self):
 		return self.title
 
+	def get_paths(self):
+		edges = load_ancestor_edges((self.pk,))
+		titles = Category.objects.filter(pk__in={i for e in edges for i in e}
+			).order_by('title').values_list('id', 'title')
+		return CategoryPaths(self.pk, edges, titles)
+
 	def get_all_paths(self):
-		if self.parents:
-			for paths, title in ((list(x.get_all_paths()), x.title) for x in self.parents.only('title').order_by('title').iterator()):
-				if not paths:
-					yield title+' / '
-				else:
-					for p in paths:
-						yield p+title+' / '
-		else:
-			yield []
+		return iter(self.get_paths())
 
 	class Meta:
 		db_table = 'categories'
@@ -61,6 +78,9 @@ class Category(Model):
 		constraints = (
 				CheckConstraint(check=Q(title__iregex=r'^\S.*\S$'), name='category_title_check'),
 		)
+		indexes = (
+				GinIndex(OpClass(Upper('title'), name='gin_trgm_ops'), name='category_title_trgm_idx'),
+			)
 
 
 class CategoryParent(Model):
@@ -79,35 +99,241 @@ class CategoryParent(Model):
 
 	@transaction.atomic
 	def save(self, *args, **kwargs):
-		check_child_in_parents(self.from_category_id, self.to_category_id, self.to_category_id)
+		check_category_edges(((self.from_category_id, self.to_category_id),))
 		super(CategoryParent, self).save(*args, **kwargs)
+		rebuild_category_closure((self.from_category_id,))
 
+	@transaction.atomic
+	def delete(self, *args, **kwargs):
+		result = super(CategoryParent, self).delete(*args, **kwargs)
+		rebuild_category_closure((self.from_category_id,))
+		return result
 
-def check_child_in_parents(from_id, to_id, start_to, checked=set()):
-	if CategoryParent.objects.filter(from_category_id=to_id, to_category_id=from_id).exists():
-			raise ValidationError(f'Доч. категория {Category.objects.get(id=from_id).title} не может быть родительской '\
-				f"для {Category.objects.filter(pk=start_to).values_list('title', flat=True)[0]} "\
-				f"({Category.objects.filter(pk=to_id).values_list('title', flat=True)[0]}).")
-	else:
-		for i in CategoryParent.objects.filter(from_category_id=to_id).values_list('to_category_id', flat=True):
-			if i not in checked:
-				checked.add(i)
-				check_child_in_parents(from_id, i, start_to, checked)
+
+class CategoryClosure(Model):
+	ancestor = ForeignKey(Category, on_delete=CASCADE, 
+		related_name='descendant_links', verbose_name='Предок')
+	descendant = ForeignKey(Category, on_delete=CASCADE, 
+		related_name='ancestor_links', verbose_name='Потомок')
+	depth = PositiveIntegerField(verbose_name='Глубина')
+
+	class Meta:
+		db_table = 'category_closure'
+		constraints = (
+				UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_category_closure'),
+			)
+		verbose_name = "Предок категории"
+		verbose_name_plural = "Предки категорий"
+
+
+#Пересчитывает строки таблицы замыкания для категорий category_ids и всех их потомков,
+#без аргументов перестраивает таблицу целиком
+def rebuild_category_closure(category_ids=None):
+	closure = CategoryClosure._meta.db_table
+	edges = CategoryParent._meta.db_table
+	with connection.cursor() as cursor:
+		if category_ids is None:
+			cursor.execute(f"DELETE FROM {closure}")
+			cursor.execute(f"INSERT INTO {closure} (ancestor_id, descendant_id, depth) "
+				f"SELECT id, id, 0 FROM {Category._meta.db_table}")
+			where, params = '', []
+		else:
+			params = list(set(CategoryClosure.objects.filter(ancestor_id__in=category_ids
+				).values_list('descendant_id', flat=True)) | set(category_ids))
+			if not params:
+				return
+			placeholders = ', '.join(['%s'] * len(params))
+			cursor.execute(f"DELETE FROM {closure} WHERE depth > 0 AND descendant_id IN ({placeholders})", params)
+			where = f" WHERE from_category_id IN ({placeholders})"
+		cursor.execute(
+			f"INSERT INTO {closure} (ancestor_id, descendant_id, depth) "
+			f"WITH RECURSIVE up(descendant_id, ancestor_id, depth) AS ("
+			f" SELECT from_category_id, to_category_id, 1 FROM {edges}{where}"
+			f" UNION"
+			f" SELECT up.descendant_id, cp.to_category_id, up.depth + 1 FROM {edges} cp"
+			f" JOIN up ON cp.from_category_id = up.ancestor_id"
+			f") SELECT ancestor_id, descendant_id, MIN(depth) FROM up"
+			f" GROUP BY ancestor_id, descendant_id",
+			params)
+
+
+#Одним рекурсивным запросом загружает все ребра (дочерняя, родительская),
+#достижимые вверх от категорий category_ids
+def load_ancestor_edges(category_ids):
+	category_ids = list(category_ids)
+	if not category_ids:
+		return []
+	table = CategoryParent._meta.db_table
+	with connections[router.db_for_read(CategoryParent)].cursor() as cursor:
+		cursor.execute(
+			f"WITH RECURSIVE up(from_id, to_id) AS ("
+			f" SELECT from_category_id, to_category_id FROM {table}"
+			f" WHERE from_category_id IN ({', '.join(['%s'] * len(category_ids))})"
+			f" UNION"
+			f" SELECT cp.from_category_id, cp.to_category_id FROM {table} cp"
+			f" JOIN up ON cp.from_category_id = up.to_id"
+			f") SELECT from_id, to_id FROM up",
+			category_ids)
+		return cursor.fetchall()
+
+
+#Проверяет, что добавление ребер (дочерняя, родительская) не создаст цикл,
+#и сообщает обо всех неверных ребрах одной ошибкой
+def check_category_edges(edges):
+	edges = list(edges)
+	if not edges:
+		return
+	existing = load_ancestor_edges({parent for child, parent in edges})
+	wrong = find_cycle_edges(existing, edges)
+	if wrong:
+		titles = dict(Category.objects.filter(
+			pk__in={i for e in wrong for i in e}).values_list('id', 'title'))
+		raise ValidationError([
+			f'Доч. категория {titles.get(child, child)} не может быть родительской '\
+			f'для {titles.get(parent, parent)}.' for child, parent in wrong])
 
 
 def process_m2m_category_update(sender, instance, action, reverse, pk_set, **kwargs):
 	if action == 'pre_add':
 		if reverse:
-			for k in pk_set:
-				check_child_in_parents(k, instance.pk, instance.pk)
+			check_category_edges((k, instance.pk) for k in pk_set)
 		else:
-			for k in pk_set:
-				check_child_in_parents(instance.pk, k, k)
+			check_category_edges((instance.pk, k) for k in pk_set)
+	elif action == 'pre_clear' and reverse:
+		instance._cleared_children = list(instance.category_set.values_list('id', flat=True))
+	elif action in ('post_add', 'post_remove'):
+		rebuild_category_closure(pk_set if reverse else (instance.pk,))
+	elif action == 'post_clear':
+		rebuild_category_closure(instance.__dict__.pop('_cleared_children', ()) if reverse else (instance.pk,))
 	
 
 m2m_changed.connect(process_m2m_category_update, sender=CategoryParent)
 
 
+def process_category_save(sender, instance, created, **kwargs):
+	if created:
+		CategoryClosure.objects.create(ancestor=instance, descendant=instance, depth=0)
+
+
+def process_category_pre_delete(sender, instance, **kwargs):
+	instance._deleted_children = list(instance.category_set.values_list('id', flat=True))
+
+
+def process_category_delete(sender, instance, **kwargs):
+	rebuild_category_closure(instance.__dict__.pop('_deleted_children', ()))
+
+
+post_save.connect(process_category_save, sender=Category)
+pre_delete.connect(process_category_pre_delete, sender=Category)
+post_delete.connect(process_category_delete, sender=Category)
+
+
+#Версия набора записей кэша из значений ключей keys: запись хранится под ключом
+#с версией и перестает читаться, когда любой из ключей меняется
+def get_cache_version(keys):
+	versions = cache.get_many(keys)
+	if len(versions) < len(keys):
+		for key in keys:
+			if key not in versions:
+				cache.add(key, uuid.uuid4().hex, None)
+		versions = cache.get_many(keys)
+	return ':'.join(versions.get(key, '') for key in keys)
+
+
+def bump_cache_version(keys):
+	if not keys:
+		return
+	bump = lambda: cache.set_many({key: uuid.uuid4().hex for key in keys}, None)
+	#Сразу, чтобы не читать записи старой версии, и после фиксации транзакции,
+	#чтобы в кэш не попали незафиксированные данные
+	bump()
+	transaction.on_commit(bump)
+
+
+CATEGORY_CHOICES_VERSION_KEY = 'category_choices_version'
+
+CATEGORY_CHOICES_TIMEOUT = 24*60*60
+
+
+#Пары (id, название) родительских категорий по названию для фильтра списка категорий.
+#Список выводится целиком на каждой странице, поэтому хранится в кэше под ключом
+#с версией, которая меняется при изменении категорий и связей между ними
+def get_parent_category_choices():
+	key = f'parent_category_choices:{get_cache_version((CATEGORY_CHOICES_VERSION_KEY,))}'
+	choices = cache.get(key)
+	if choices is None:
+		choices = list(Category.objects.filter(from_category__isnull=False).distinct()
+			.order_by('title').values_list('id', 'title'))
+		cache.set(key, choices, CATEGORY_CHOICES_TIMEOUT)
+	return choices
+
+
+def process_category_choices_change(sender, **kwargs):
+	if kwargs.get('action', 'post_').startswith('post_'):
+		bump_cache_version((CATEGORY_CHOICES_VERSION_KEY,))
+
+
+post_save.connect(process_category_choices_change, sender=Category)
+post_delete.connect(process_category_choices_change, sender=Category)
+post_save.connect(process_category_choices_change, sender=CategoryParent)
+post_delete.connect(process_category_choices_change, sender=CategoryParent)
+m2m_changed.connect(process_category_choices_change, sender=CategoryParent)
+
+
+AUTH_VERSION_KEY = 'auth_version'
+
+AUTH_CACHE_TIMEOUT = 24*60*60
+
+
+def auth_version_keys(user_id):
+	return AUTH_VERSION_KEY, f'{AUTH_VERSION_KEY}:{user_id}'
+
+
+#Версия кэша пользователя, прав и доступных магазинов (core.permissions): общая часть
+#меняется при изменении групп и прав, личная - при изменении пользователя и его связей
+def get_auth_version(user_id):
+	return get_cache_version(auth_version_keys(user_id))
+
+
+#user_ids=None - сброс для всех пользователей
+def bump_auth_version(user_ids=None):
+	bump_cache_version([AUTH_VERSION_KEY] if user_ids is None else [auth_version_keys(pk)[1] for pk in user_ids])
+
+
+def process_user_auth_change(sender, instance, **kwargs):
+	bump_auth_version((instance.pk,))
+
+
+def process_group_auth_change(sender, **kwargs):
+	if kwargs.get('action', 'post_').startswith('post_'):
+		bump_auth_version()
+
+
+#Связи пользователя с группами, правами и магазинами: при изменении со стороны
+#пользователя сбрасывается его версия, с другой стороны - версии затронутых пользователей
+def process_user_m2m_auth_change(sender, instance, action, reverse, pk_set, **kwargs):
+	if not action.startswith('post_'):
+		return
+	if isinstance(instance, User):
+		bump_auth_version((instance.pk,))
+	elif pk_set is not None:
+		bump_auth_version(pk_set)
+	else:
+		bump_auth_version()
+
+
+post_save.connect(process_user_auth_change, sender=User)
+post_delete.connect(process_user_auth_change, sender=User)
+post_delete.connect(process_group_auth_change, sender=Group)
+post_delete.connect(process_group_auth_change, sender=Permission)
+m2m_changed.connect(process_group_auth_change, sender=Group.permissions.through)
+m2m_changed.connect(process_user_m2m_auth_change, sender=User.groups.through)
+m2m_changed.connect(process_user_m2m_auth_change, sender=User.user_permissions.through)
+m2m_changed.connect(process_user_m2m_auth_change, sender=Shop.product_managers.through)
+#Связи удаленного магазина с менеджерами удаляются без сигналов
+post_delete.connect(process_group_auth_change, sender=Shop)
+
+
 class Product(Model):
 	title = CharField(verbose_name='Название', max_length=100, db_index=True)
 	description = TextField(verbose_name='Описание', null=True, blank=True)
@@ -117,6 +343,8 @@ class Product(Model):
 	active = BooleanField(default=True, blank=True, verbose_name='Активен')
 	shop = ForeignKey(Shop, on_delete=CASCADE, related_name='products', verbose_name='Магазин')
 	categories = ManyToManyField(Category, related_name='products', verbose_name='Категории')
+	#Заполняется триггером БД из названия и описания (миграция 0009)
+	search_vector = SearchVectorField(null=True, editable=False)
 
 	def __str__(self):
 		return self.title
@@ -129,16 +357,537 @@ class Product(Model):
 				CheckConstraint(check=Q(title__iregex=r'^\S.*\S$'), name='product_title_check'),
 				CheckConstraint(check=Q(price__gte=0), name='price_gte_0'),
 			)
+		indexes = (
+				GinIndex(fields=('search_vector',), name='product_search_vector_idx'),
+				GinIndex(OpClass(Upper('title'), name='gin_trgm_ops'), name='product_title_trgm_idx'),
+			)
+
+
+#Изменяет счетчики продуктов на величины из словарей {pk: приращение}
+#одним запросом UPDATE
+def add_to_product_counters(model, counts=None, active_counts=None):
+	updates, pks = {}, set()
+	for field, deltas in (('product_count', counts), ('active_product_count', active_counts)):
+		deltas = {k: v for k, v in (deltas or {}).items() if k is not None and v}
+		if deltas:
+			pks.update(deltas)
+			updates[field] = F(field) + Case(*(When(pk=k, then=Value(v)) for k, v in deltas.items()),
+				default=Value(0), output_field=IntegerField())
+	if updates:
+		model.objects.filter(pk__in=pks).update(**updates)
+
+
+#Пересчитывает счетчики продуктов магазинов и категорий целиком
+def recount_product_counters():
+	def count(qs, field):
+		return Coalesce(Subquery(qs.filter(**{field: OuterRef('pk')}).order_by().values(field)
+			.annotate(n=Count('*')).values('n')), 0)
+	through = Product.categories.through.objects
+	with transaction.atomic():
+		Shop.objects.update(
+			product_count=count(Product.objects, 'shop'),
+			active_product_count=count(Product.objects.filter(active=True), 'shop'))
+		Category.objects.update(
+			product_count=count(through, 'category'),
+			active_product_count=count(through.filter(product__active=True), 'category'))
+
+
+#Массово изменяет флаг активности продуктов с обновлением счетчиков
+@transaction.atomic
+def set_products_active(queryset, active):
+	changed = queryset.filter(active=not active)
+	sign = 1 if active else -1
+	shops = {k: sign*n for k, n in changed.order_by().values_list('shop_id').annotate(n=Count('id'))}
+	categories = {k: sign*n for k, n in Product.categories.through.objects.filter(
+		product__in=changed.values('id')).order_by().values_list('category_id').annotate(n=Count('id'))}
+	updated = changed.update(active=active)
+	add_to_product_counters(Shop, active_counts=shops)
+	add_to_product_counters(Category, active_counts=categories)
+	return updated
+
+
+#Выполняет запрос к таблице связей продуктов и категорий, возвращающий строки
+#(product_id, category_id) из RETURNING, и обновляет счетчики категорий на sign за строку
+def _change_product_categories(sql, params, sign):
+	with connection.cursor() as cursor:
+		cursor.execute(
+			f"WITH changed AS ({sql} RETURNING product_id, category_id)"
+			f" SELECT changed.category_id, COUNT(*), COUNT(*) FILTER (WHERE p.active) FROM changed"
+			f" JOIN {Product._meta.db_table} p ON p.id = changed.product_id GROUP BY changed.category_id",
+			params)
+		rows = cursor.fetchall()
+	add_to_product_counters(Category, {c: sign*n for c, n, a in rows}, {c: sign*a for c, n, a in rows})
+	return sum(n for c, n, a in rows)
+
+
+#Массово добавляет продуктам queryset категории category_ids одним INSERT ... SELECT,
+#уже существующие связи пропускаются. Возвращает число новых связей
+@transaction.atomic
+def add_product_categories(queryset, category_ids):
+	category_ids = list(category_ids)
+	if not category_ids:
+		return 0
+	products, params = queryset.order_by().values('id').query.sql_with_params()
+	return _change_product_categories(
+		f"INSERT INTO {Product.categories.through._meta.db_table} (product_id, category_id)"
+		f" SELECT p.id, c.id FROM ({products}) p"
+		f" CROSS JOIN (VALUES {', '.join(['(%s)'] * len(category_ids))}) c(id)"
+		f" ON CONFLICT DO NOTHING",
+		(*params, *category_ids), 1)
+
+
+#Массово удаляет у продуктов queryset категории category_ids одним DELETE,
+#с exclude=True - удаляет все категории, кроме category_ids. Возвращает число удаленных связей
+@transaction.atomic
+def remove_product_categories(queryset, category_ids, exclude=False):
+	category_ids = list(category_ids)
+	if not category_ids and not exclude:
+		return 0
+	products, params = queryset.order_by().values('id').query.sql_with_params()
+	where = ''
+	if category_ids:
+		where = (f" AND category_id {'NOT IN' if exclude else 'IN'}"
+			f" ({', '.join(['%s'] * len(category_ids))})")
+	return _change_product_categories(
+		f"DELETE FROM {Product.categories.through._meta.db_table}"
+		f" WHERE product_id IN ({products}){where}",
+		(*params, *category_ids), -1)
+
+
+#Заменяет категории продуктов queryset на category_ids: одно удаление лишних связей
+#и одна вставка недостающих
+@transaction.atomic
+def replace_product_categories(queryset, category_ids):
+	category_ids = list(category_ids)
+	removed = remove_product_categories(queryset, category_ids, exclude=True)
+	added = add_product_categories(queryset, category_ids)
+	return added, removed
+
+
+def process_product_init(sender, instance, **kwargs):
+	instance._counted_state = (instance.__dict__.get('shop_id'), instance.__dict__.get('active'))
+
+
+def process_product_save(sender, instance, created, **kwargs):
+	shop_id, active = instance.__dict__.get('shop_id'), instance.__dict__.get('active')
+	if created:
+		add_to_product_counters(Shop, {shop_id: 1}, {shop_id: int(active)})
+	else:
+		old_shop_id, old_active = getattr(instance, '_counted_state', (None, None))
+		if old_shop_id is None or shop_id is None:
+			old_shop_id = shop_id
+		if old_active is None or active is None:
+			old_active = active
+		if old_shop_id != shop_id or old_active != active:
+			counts, active_counts = {}, {}
+			if old_shop_id != shop_id:
+				counts = {old_shop_id: -1, shop_id: 1}
+			active_counts[old_shop_id] = -int(bool(old_active))
+			active_counts[shop_id] = active_counts.get(shop_id, 0) + int(bool(active))
+			add_to_product_counters(Shop, counts, active_counts)
+		if old_active != active:
+			Category.objects.filter(products=instance).update(
+				active_product_count=F('active_product_count') + (1 if active else -1))
+	instance._counted_state = (shop_id, active)
+
+
+def process_product_pre_delete(sender, instance, **kwargs):
+	#Состояние берется из базы, так как экземпляр в памяти может быть устаревшим
+	instance._deleted_state = list(Product.objects.filter(pk=instance.pk)
+		.values_list('shop_id', 'active', 'categories'))
+
+
+def process_product_delete(sender, instance, **kwargs):
+	state = instance.__dict__.pop('_deleted_state', ())
+	if not state:
+		return
+	shop_id, active = state[0][0], int(state[0][1])
+	categories = [c for s, a, c in state if c is not None]
+	add_to_product_counters(Shop, {shop_id: -1}, {shop_id: -active})
+	add_to_product_counters(Category, {k: -1 for k in categories}, {k: -active for k in categories})
+
+
+def process_m2m_product_categories_update(sender, instance, action, reverse, pk_set, **kwargs):
+	if action == 'pre_clear':
+		if reverse:
+			instance._cleared_products = instance.products.aggregate(
+				n=Count('id'), active=Count('id', filter=Q(active=True)))
+		else:
+			instance._cleared_categories = list(instance.categories.values_list('id', flat=True))
+	elif action == 'pre_remove':
+		#pk_set содержит все переданные в remove() id, в том числе несвязанные
+		if reverse:
+			links = sender.objects.filter(category_id=instance.pk, product_id__in=pk_set).values_list('product_id')
+		else:
+			links = sender.objects.filter(product_id=instance.pk, category_id__in=pk_set).values_list('category_id')
+		instance._removed_ids = {pk for pk, in links}
+	elif action in ('post_add', 'post_remove', 'post_clear'):
+		sign = -1 if action != 'post_add' else 1
+		if action == 'post_remove':
+			pk_set = instance.__dict__.pop('_removed_ids', set())
+		if reverse:
+			if action == 'post_clear':
+				cleared = instance.__dict__.pop('_cleared_products', {'n': 0, 'active': 0})
+				n, active = cleared['n'], cleared['active']
+			else:
+				n, active = len(pk_set), Product.objects.filter(pk__in=pk_set, active=True).count()
+			add_to_product_counters(Category, {instance.pk: sign*n}, {instance.pk: sign*active})
+		else:
+			categories = instance.__dict__.pop('_cleared_categories', ()) if action == 'post_clear' else pk_set
+			active = int(bool(instance.active))
+			add_to_product_counters(Category, {k: sign for k in categories}, {k: sign*active for k in categories})
+
+
+post_init.connect(process_product_init, sender=Product)
+post_save.connect(process_product_save, sender=Product)
+pre_delete.connect(process_product_pre_delete, sender=Product)
+post_delete.connect(process_product_delete, sender=Product)
+m2m_changed.connect(process_m2m_product_categories_update, sender=Product.categories.through)
 
 
 def product_image_path_handler(instance, filename):
 	return f"{settings.IMAGES_DIR}/products/{instance.product.id}/{uuid.uuid4()}.{filename.split('.')[-1]}"
 
+#Фото продукта упорядочены по position без пропусков, основное фото - position 0
 class ProductImage(Model):
-	image = ImageField(verbose_name='Фото', unique=True, upload_to=product_image_path_handler)
+	image = ImageField(verbose_name='Фото', db_index=True, upload_to=product_image_path_handler)
 	product = ForeignKey(Product, on_delete=CASCADE, verbose_name='Продукт', related_name='images')
+	position = PositiveIntegerField(verbose_name='Порядок', editable=False)
 
 	class Meta:
 		db_table = 'productimages'
 		verbose_name = 'Фото продукта'
 		verbose_name_plural = 'Фото продукта'
+		constraints = (
+				#Отложенная проверка, чтобы перестановка выполнялась одним UPDATE
+				UniqueConstraint(fields=('product', 'position'), name='unique_product_image_position',
+					deferrable=Deferrable.DEFERRED),
+			)
+		indexes = (
+				#Основное фото читается только из индекса
+				Index(fields=('product',), include=('image',), condition=Q(position=0),
+					name='product_main_image_idx'),
+			)
+
+	def save(self, *args, **kwargs):
+		if self.position is None:
+			last = ProductImage.objects.filter(product_id=self.product_id).aggregate(m=Max('position'))['m']
+			self.position = 0 if last is None else last + 1
+		elif not self._state.adding and not args and kwargs.get('update_fields') is None:
+			#Позицию меняет только renumber_product_images: загруженное значение могло
+			#устареть после удаления другого фото в той же форме
+			kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+				if not f.primary_key and f.name != 'position']
+		super(ProductImage, self).save(*args, **kwargs)
+
+
+#Переставляет фото продуктов одним UPDATE: сначала фото из order в его порядке,
+#затем остальные в прежнем порядке, позиции - подряд с 0. Возвращает число измененных фото
+def renumber_product_images(product_ids, order=()):
+	with connection.cursor() as cursor:
+		cursor.execute(
+			f"UPDATE {ProductImage._meta.db_table} i SET position = r.n - 1 FROM ("
+			f" SELECT id, ROW_NUMBER() OVER (PARTITION BY product_id"
+			f" ORDER BY array_position(%s::bigint[], id), position, id) n"
+			f" FROM {ProductImage._meta.db_table} WHERE product_id = ANY(%s)"
+			f") r WHERE i.id = r.id AND i.position <> r.n - 1",
+			(list(order), list(product_ids)))
+		return cursor.rowcount
+
+
+#Имя файла основного фото продукта или None
+def main_image_name(product_id):
+	#Без сортировки (first() добавил бы ORDER BY id), чтобы чтение было только из индекса
+	names = ProductImage.objects.filter(product_id=product_id, position=0).values_list('image', flat=True)[:1]
+	return names[0] if names else None
+
+
+def process_image_save(sender, instance, **kwargs):
+	for f in sender._meta.fields:
+		if isinstance(f, ImageField):
+			name = getattr(instance, f.attname).name
+			if name:
+				transaction.on_commit(lambda name=name: schedule_thumbnails(name))
+
+
+def process_file_cleanup(sender, file, **kwargs):
+	#Хранилище с подсчетом ссылок само удаляет миниатюры вместе с последней ссылкой
+	if file.name and not isinstance(file.storage, ContentAddressedStorage):
+		delete_thumbnails(file.name)
+
+
+#После удаления фото позиции остальных сдвигаются, следующее фото становится основным
+def process_image_delete(sender, instance, **kwargs):
+	renumber_product_images((instance.product_id,))
+
+
+post_save.connect(process_image_save, sender=Shop)
+post_save.connect(process_image_save, sender=ProductImage)
+post_delete.connect(process_image_delete, sender=ProductImage)
+cleanup_pre_delete.connect(process_file_cleanup)
+
+
+class StoredFile(Model):
+	name = CharField(verbose_name='Имя файла', max_length=100, primary_key=True)
+	refs = IntegerField(verbose_name='Кол-во ссылок', default=0)
+
+	class Meta:
+		db_table = 'stored_files'
+		verbose_name = 'Файл'
+		verbose_name_plural = 'Файлы'
+		indexes = (
+				Index(fields=('refs',), condition=Q(refs__lte=0), name='stored_files_orphan_idx'),
+			)
+
+
+#Модели и поля, ссылки которых на файлы считаются в stored_files
+def stored_file_fields():
+	return [(model, f) for model in (Shop, ProductImage) for f in model._meta.fields if isinstance(f, ImageField)]
+
+
+#Изменяет кол-во ссылок на файлы на величины из словаря {имя: приращение}
+def add_stored_file_refs(deltas):
+	deltas = sorted((k, v) for k, v in deltas.items() if k and v)
+	if not deltas:
+		return
+	with connection.cursor() as cursor:
+		cursor.execute(f'''
+			INSERT INTO {StoredFile._meta.db_table} (name, refs)
+			VALUES {', '.join(['(%s, %s)'] * len(deltas))}
+			ON CONFLICT (name) DO UPDATE SET refs = {StoredFile._meta.db_table}.refs + EXCLUDED.refs
+		''', [x for d in deltas for x in d])
+
+
+#Блокирует строку файла до конца транзакции, создавая ее при необходимости
+def lock_stored_file(name):
+	with connection.cursor() as cursor:
+		cursor.execute(f'''
+			INSERT INTO {StoredFile._meta.db_table} (name, refs) VALUES (%s, 0)
+			ON CONFLICT (name) DO UPDATE SET refs = {StoredFile._meta.db_table}.refs
+		''', [name])
+
+
+#Пересчитывает ссылки на все файлы
+def recount_stored_files():
+	refs = ' UNION ALL '.join(
+		f'SELECT "{f.column}" AS name FROM {model._meta.db_table} WHERE "{f.column}" <> \'\''
+		for model, f in stored_file_fields())
+	table = StoredFile._meta.db_table
+	with transaction.atomic(), connection.cursor() as cursor:
+		cursor.execute(f'''
+			INSERT INTO {table} (name, refs)
+			SELECT name, count(*) FROM ({refs}) r GROUP BY name
+			ON CONFLICT (name) DO UPDATE SET refs = EXCLUDED.refs
+		''')
+		cursor.execute(f'UPDATE {table} SET refs = 0 WHERE refs <> 0 AND name NOT IN (SELECT name FROM ({refs}) r)')
+
+
+def _stored_file_names(instance):
+	names = {}
+	for f in instance._meta.fields:
+		#Отложенные поля не учитываются
+		if isinstance(f, ImageField) and f.attname in instance.__dict__:
+			value = instance.__dict__[f.attname]
+			names[f.attname] = getattr(value, 'name', value)
+	return names
+
+
+def process_stored_file_init(sender, instance, **kwargs):
+	instance._stored_files = _stored_file_names(instance)
+
+
+def process_stored_file_save(sender, instance, created, **kwargs):
+	names = _stored_file_names(instance)
+	old_names = {} if created else getattr(instance, '_stored_files', {})
+	deltas = {}
+	for attname, name in names.items():
+		old = old_names.get(attname)
+		if name != old and (created or attname in old_names):
+			deltas[name] = deltas.get(name, 0) + 1
+			deltas[old] = deltas.get(old, 0) - 1
+	add_stored_file_refs(deltas)
+	instance._stored_files = names
+
+
+def process_stored_file_delete(sender, instance, **kwargs):
+	deltas = {}
+	for name in _stored_file_names(instance).values():
+		deltas[name] = deltas.get(name, 0) - 1
+	add_stored_file_refs(deltas)
+
+
+post_init.connect(process_stored_file_init, sender=Shop)
+post_init.connect(process_stored_file_init, sender=ProductImage)
+post_save.connect(process_stored_file_save, sender=Shop)
+post_save.connect(process_stored_file_save, sender=ProductImage)
+post_delete.connect(process_stored_file_delete, sender=Shop)
+post_delete.connect(process_stored_file_delete, sender=ProductImage)
+
+
+
+#Удаляет продукты с фото и связями с категориями одним запросом на порцию
+#и обновляет счетчики. Файлы фото остаются на диске: ссылки на них в stored_files
+#уменьшаются, а файлы без ссылок после коммита удаляет ContentAddressedStorage.sweep
+#Записывает удаление объектов (pk, название) в журнал администратора одним запросом,
+#как ModelAdmin.log_deletion для каждого объекта
+def log_deletions(user_id, model, objects):
+	if user_id is None or not objects:
+		return
+	content_type = ContentType.objects.get_for_model(model, for_concrete_model=False)
+	LogEntry.objects.bulk_create([LogEntry(user_id=user_id, content_type=content_type, object_id=str(pk),
+		object_repr=str(title)[:200], action_flag=DELETION) for pk, title in objects])
+
+
+def _delete_products(ids, user_id=None):
+	through = Product.categories.through._meta.db_table
+	with connection.cursor() as cursor:
+		cursor.execute(
+			f"WITH i AS (DELETE FROM {ProductImage._meta.db_table} WHERE product_id = ANY(%s) RETURNING image),"
+			f" c AS (DELETE FROM {through} WHERE product_id = ANY(%s) RETURNING product_id, category_id),"
+			f" p AS (DELETE FROM {Product._meta.db_table} WHERE id = ANY(%s) RETURNING id, shop_id, active, title)"
+			f" SELECT 's', shop_id::text, COUNT(*), COUNT(*) FILTER (WHERE active) FROM p GROUP BY shop_id"
+			f" UNION ALL SELECT 'c', c.category_id::text, COUNT(*), COUNT(*) FILTER (WHERE p.active)"
+			f" FROM c JOIN p ON p.id = c.product_id GROUP BY c.category_id"
+			f" UNION ALL SELECT 'i', image, COUNT(*), 0 FROM i GROUP BY image"
+			f" UNION ALL SELECT 'p', title, id, 0 FROM p",
+			(ids, ids, ids))
+		rows = cursor.fetchall()
+	shops = [(int(k), n, a) for t, k, n, a in rows if t == 's']
+	categories = [(int(k), n, a) for t, k, n, a in rows if t == 'c']
+	add_to_product_counters(Shop, {k: -n for k, n, a in shops}, {k: -a for k, n, a in shops})
+	add_to_product_counters(Category, {k: -n for k, n, a in categories}, {k: -a for k, n, a in categories})
+	add_stored_file_refs({k: -n for t, k, n, a in rows if t == 'i'})
+	log_deletions(user_id, Product, [(n, k) for t, k, n, a in rows if t == 'p'])
+	return sum(n for k, n, a in shops)
+
+
+#Удаляет продукты queryset порциями по chunk_size, каждая порция - отдельная транзакция.
+#Удаление записывается в журнал от имени user_id. Возвращает число удаленных продуктов
+def delete_products(queryset, chunk_size=None, user_id=None):
+	chunk_size = chunk_size or settings.BACKGROUND_JOB_CHUNK_SIZE
+	deleted = 0
+	while True:
+		with transaction.atomic():
+			ids = list(queryset.order_by('id').values_list('id', flat=True)[:chunk_size])
+			if not ids:
+				return deleted
+			deleted += _delete_products(ids, user_id)
+
+
+#Удаляет магазины вместе со всеми их продуктами. Продукты удаляются порциями,
+#затем магазины одним запросом. В журнал, как при каскадном удалении в админке,
+#записывается только удаление магазинов
+def delete_shops(queryset, chunk_size=None, user_id=None):
+	shop_ids = list(queryset.values_list('id', flat=True))
+	delete_products(Product.objects.filter(shop_id__in=shop_ids), chunk_size)
+	with transaction.atomic():
+		#Продукты, добавленные в магазины за время удаления
+		_delete_products(list(Product.objects.filter(shop_id__in=shop_ids).values_list('id', flat=True)))
+		managers = Shop.product_managers.through.objects.filter(shop_id__in=shop_ids)
+		bump_auth_version(set(managers.values_list('user_id', flat=True)))
+		managers.delete()
+		with connection.cursor() as cursor:
+			cursor.execute(
+				f'DELETE FROM {Shop._meta.db_table} WHERE id = ANY(%s) RETURNING id, title, "imageUrl"', (shop_ids,))
+			rows = cursor.fetchall()
+		images = [name for pk, title, name in rows]
+		add_stored_file_refs({name: -images.count(name) for name in images})
+		log_deletions(user_id, Shop, [(pk, title) for pk, title, name in rows])
+	return len(shop_ids)
+
+
+class BackgroundJob(Model):
+	PENDING, RUNNING, DONE, FAILED, CANCELLED = 'pending', 'running', 'done', 'failed', 'cancelled'
+	STATUSES = (
+			(PENDING, 'В очереди'),
+			(RUNNING, 'Выполняется'),
+			(DONE, 'Завершено'),
+			(FAILED, 'Ошибка'),
+			(CANCELLED, 'Отменено'),
+		)
+	ACTIVE_STATUSES = (PENDING, RUNNING)
+	action = CharField(verbose_name='Действие', max_length=50)
+	description = CharField(verbose_name='Описание', max_length=200)
+	params = JSONField(verbose_name='Параметры', default=dict, blank=True)
+	query = BinaryField(verbose_name='Запрос продуктов')
+	status = CharField(verbose_name='Статус', max_length=10, choices=STATUSES, default=PENDING, db_index=True)
+	user = ForeignKey(User, on_delete=SET_NULL, null=True, blank=True, related_name='background_jobs',
+		verbose_name='Пользователь')
+	total = PositiveIntegerField(verbose_name='Всего продуктов', null=True, blank=True)
+	processed = PositiveIntegerField(verbose_name='Обработано продуктов', default=0)
+	last_id = BigIntegerField(verbose_name='Последний обработанный id', default=0)
+	error = TextField(verbose_name='Ошибка', blank=True)
+	created_at = DateTimeField(verbose_name='Создано', auto_now_add=True)
+	started_at = DateTimeField(verbose_name='Начато', null=True, blank=True)
+	finished_at = DateTimeField(verbose_name='Завершено', null=True, blank=True)
+	#Обновляется после каждой порции, по нему находятся задания упавших обработчиков
+	updated_at = DateTimeField(verbose_name='Обновлено', auto_now=True)
+
+	def __str__(self):
+		return f'{self.description} #{self.pk}'
+
+	@property
+	def is_active(self):
+		return self.status in self.ACTIVE_STATUSES
+
+	#Запрос хранится сериализованным, чтобы задание обработало
+	#ровно те продукты, что были выбраны или отфильтрованы в списке
+	def set_queryset(self, queryset):
+		self.query = pickle.dumps(queryset.order_by().query)
+
+	def get_queryset(self):
+		queryset = Product.objects.all()
+		queryset.query = pickle.loads(bytes(self.query))
+		return queryset
+
+	class Meta:
+		db_table = 'background_jobs'
+		verbose_name = "Фоновое задание"
+		verbose_name_plural = "Фоновые задания"
+
+
+class ViewStats(Model):
+	#Статистика представления за час, заполняется core.instrumentation
+	view_name = CharField(verbose_name='Представление', max_length=200)
+	period = DateTimeField(verbose_name='Час')
+	requests = PositiveIntegerField(verbose_name='Запросов', default=0)
+	errors = PositiveIntegerField(verbose_name='Ошибок', default=0)
+	total_ms = FloatField(verbose_name='Общее время, мс', default=0)
+	max_ms = FloatField(verbose_name='Макс. время, мс', default=0)
+	histogram = JSONField(verbose_name='Гистограмма времени', default=list)
+	queries = PositiveIntegerField(verbose_name='Запросов к БД', default=0)
+	max_queries = PositiveIntegerField(verbose_name='Макс. запросов к БД', default=0)
+	query_ms = FloatField(verbose_name='Время запросов к БД, мс', default=0)
+	slow_queries = JSONField(verbose_name='Медленные запросы', default=list)
+
+	class Meta:
+		db_table = 'view_stats'
+		constraints = (
+				UniqueConstraint(fields=('view_name', 'period'), name='unique_view_stats_period'),
+			)
+		verbose_name = "Статистика представления"
+		verbose_name_plural = "Статистика представлений"
+
+
+class RequestProfile(Model):
+	#Профиль запроса, записанный core.profiling. Хранятся последние keep профилей
+	keep = 100
+	user = ForeignKey(User, on_delete=SET_NULL, null=True, blank=True, verbose_name='Пользователь')
+	created_at = DateTimeField(verbose_name='Создан', auto_now_add=True)
+	method = CharField(verbose_name='Метод', max_length=10)
+	path = CharField(verbose_name='Адрес', max_length=1000)
+	view_name = CharField(verbose_name='Представление', max_length=200, blank=True)
+	status = PositiveIntegerField(verbose_name='Код ответа')
+	duration_ms = FloatField(verbose_name='Время, мс')
+	query_count = PositiveIntegerField(verbose_name='Запросов к БД')
+	query_ms = FloatField(verbose_name='Время запросов к БД, мс')
+	stats = BinaryField(verbose_name='Статистика cProfile')
+	queries = JSONField(verbose_name='Запросы к БД', default=list)
+
+	def __str__(self):
+		return f'{self.method} {self.path}'
+
+	class Meta:
+		db_table = 'request_profiles'
+		verbose_name = "Профиль запроса"
+		verbose_name_plural = "Профили запросов"
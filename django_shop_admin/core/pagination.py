@@ -0,0 +1,172 @@
+import json
+from django.contrib.admin.views.main import ChangeList, PAGE_VAR
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+CURSOR_VAR = 'cursor'
+BEFORE_VAR = 'before'
+
+
+#Оценка количества строк по статистике планировщика PostgreSQL:
+#для запроса без условий - reltuples таблицы, иначе - оценка из EXPLAIN
+def estimate_count(queryset):
+	connection = connections[queryset.db]
+	if connection.vendor != 'postgresql':
+		return None
+	query = queryset.query
+	with connection.cursor() as cursor:
+		if not query.where and not query.distinct:
+			cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+				[queryset.model._meta.db_table])
+			row = cursor.fetchone()
+			if row and row[0] >= 0:
+				return row[0]
+		sql, params = queryset.order_by().values('pk').query.sql_with_params()
+		cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+		plan = cursor.fetchone()[0]
+		if isinstance(plan, str):
+			plan = json.loads(plan)
+		return int(plan[0]['Plan']['Plan Rows'])
+
+
+def format_estimate(count):
+	for limit, suffix in ((10**9, 'B'), (10**6, 'M'), (10**3, 'K')):
+		if count >= limit:
+			return f'~{count/limit:.1f}{suffix}'
+	return f'~{count}'
+
+
+class EstimatedCountPaginator(Paginator):
+	#Выше этого значения точный COUNT(*) заменяется оценкой планировщика
+	estimate_threshold = 10000
+	estimated = False
+
+	@cached_property
+	def count(self):
+		estimate = estimate_count(self.object_list)
+		if estimate is not None and estimate >= self.estimate_threshold:
+			self.estimated = True
+			return estimate
+		return super().count
+
+
+class KeysetChangeList(ChangeList):
+	#Список с переходом на соседние страницы по ключу (значения сортировки + уникальное поле)
+	#первой или последней строки вместо OFFSET. Номера страниц остаются для первых страниц
+	keyset_mode = False
+	next_cursor_url = None
+	previous_cursor_url = None
+
+	def get_filters_params(self, params=None):
+		lookup_params = super().get_filters_params(params)
+		lookup_params.pop(CURSOR_VAR, None)
+		lookup_params.pop(BEFORE_VAR, None)
+		return lookup_params
+
+	def get_query_string(self, new_params=None, remove=None):
+		return super().get_query_string(new_params, [CURSOR_VAR, BEFORE_VAR, *(remove or ())])
+
+	@property
+	def result_count_display(self):
+		if getattr(self.paginator, 'estimated', False):
+			return format_estimate(self.result_count)
+		return self.result_count
+
+	def keyset_fields(self):
+		#Поля итоговой сортировки в виде [(поле, по убыванию)], None - если сортировка
+		#не подходит для ключа: последним должно быть уникальное поле (id или, например,
+		#уникальное название - к нему Django не добавляет id)
+		opts = self.lookup_opts
+		keys = []
+		for item in self.queryset.query.order_by:
+			if not isinstance(item, str) or '__' in item or item.startswith('?'):
+				return None
+			desc = item.startswith('-')
+			name = item.lstrip('-')
+			try:
+				field = opts.pk if name == 'pk' else opts.get_field(name)
+			except FieldDoesNotExist:
+				return None
+			if not field.concrete or field.null or field.is_relation:
+				return None
+			keys.append((field, desc))
+		if not keys or not keys[-1][0].unique:
+			return None
+		return keys
+
+	def keyset_filter(self, keys, values):
+		q = Q()
+		for i, (field, desc) in enumerate(keys):
+			cond = {f.attname: v for (f, d), v in zip(keys[:i], values)}
+			cond[f'{field.attname}__{"lt" if desc else "gt"}'] = values[i]
+			q |= Q(**cond)
+		return q
+
+	def parse_cursor(self, keys, cursor):
+		try:
+			values = [f.to_python(v) for (f, d), v in zip(keys, json.loads(cursor))]
+		except (ValueError, TypeError, ValidationError):
+			raise IncorrectLookupParameters
+		if len(values) != len(keys):
+			raise IncorrectLookupParameters
+		return values
+
+	def cursor(self, keys, row):
+		return json.dumps([str(f.value_from_object(row)) for f, d in keys])
+
+	def get_results(self, request):
+		keys = self.keyset_fields()
+		after, before = request.GET.get(CURSOR_VAR), request.GET.get(BEFORE_VAR)
+		if keys is None or (after is None and before is None):
+			super().get_results(request)
+			has_next = self.multi_page and not self.show_all and self.page_num < self.paginator.num_pages
+			has_previous = False
+			rows = list(self.result_list) if has_next else ()
+		else:
+			self.paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+			self.result_count = self.paginator.count
+			if before is None:
+				rows = list(self.queryset.filter(self.keyset_filter(keys, self.parse_cursor(keys, after)))
+					[:self.list_per_page+1])
+				has_next, has_previous = len(rows) > self.list_per_page, True
+				rows = rows[:self.list_per_page]
+			else:
+				#Предыдущая страница - строки перед первой в обратном порядке
+				reverse_keys = [(f, not d) for f, d in keys]
+				rows = list(self.queryset.filter(self.keyset_filter(reverse_keys, self.parse_cursor(keys, before)))
+					.reverse()[:self.list_per_page+1])
+				has_next, has_previous = True, len(rows) > self.list_per_page
+				rows = rows[:self.list_per_page][::-1]
+			self.result_list = rows
+			self.show_full_result_count = False
+			self.full_result_count = None
+			self.show_admin_actions = True
+			self.can_show_all = False
+			self.multi_page = True
+			self.keyset_mode = True
+		if keys and rows:
+			if has_next:
+				self.next_cursor_url = super().get_query_string(
+					{CURSOR_VAR: self.cursor(keys, rows[-1])}, [PAGE_VAR, BEFORE_VAR])
+			if has_previous:
+				self.previous_cursor_url = super().get_query_string(
+					{BEFORE_VAR: self.cursor(keys, rows[0])}, [PAGE_VAR, CURSOR_VAR])
+
+
+class KeysetPaginationMixin:
+	paginator = EstimatedCountPaginator
+	show_full_result_count = False
+
+	def get_changelist(self, request, **kwargs):
+		return KeysetChangeList
+
+	def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+		#Автодополнение по числу строк решает, есть ли следующая страница: с завышенной
+		#оценкой оно запросило бы несуществующую страницу
+		if getattr(request.resolver_match, 'url_name', None) == 'autocomplete':
+			return Paginator(queryset, per_page, orphans, allow_empty_first_page)
+		return super().get_paginator(request, queryset, per_page, orphans, allow_empty_first_page)
@@ -1,6 +1,81 @@
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from .models import get_auth_version, AUTH_CACHE_TIMEOUT
+
 groups_dict = {
 	'product managers': ('view_category','view_categoryparent',
 		'view_product', 'change_product', 'add_product', 'delete_product',
 		'view_productimage', 'add_productimage', 'change_productimage', 'delete_productimage',
 		'view_shop'),
-}
\ No newline at end of file
+}
+
+
+#Значение для пользователя из кэша под ключом с версией (models.get_auth_version),
+#которая меняется при изменении пользователя, его групп, прав и магазинов
+def cached_auth_value(user, name, compute):
+	version = getattr(user, '_auth_version', None)
+	if version is None:
+		version = user._auth_version = get_auth_version(user.pk)
+	key = f'auth:{user.pk}:{version}:{name}'
+	value = cache.get(key)
+	if value is None:
+		value = compute()
+		cache.set(key, value, AUTH_CACHE_TIMEOUT)
+	return value
+
+
+class CachedModelBackend(ModelBackend):
+	#Пользователь сессии и его права берутся из кэша, прогретый запрос не обращается к БД
+	def get_user(self, user_id):
+		version = get_auth_version(user_id)
+		key = f'auth:{user_id}:{version}:user'
+		user = cache.get(key)
+		if user is None:
+			user = super().get_user(user_id)
+			if user is None:
+				return None
+			cache.set(key, user, AUTH_CACHE_TIMEOUT)
+		user._auth_version = version
+		return user
+
+	def get_all_permissions(self, user_obj, obj=None):
+		if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+			return set()
+		if not hasattr(user_obj, '_perm_cache'):
+			user_obj._perm_cache = cached_auth_value(user_obj, 'perms',
+				lambda: super(CachedModelBackend, self).get_all_permissions(user_obj))
+		return user_obj._perm_cache
+
+
+class ShopAccess:
+	#Набор магазинов, доступных пользователю. Вычисляется одним запросом
+	#и хранится в запросе, чтобы все проверки прав и фильтры использовали его
+	request_attr = '_shop_access'
+
+	def __init__(self, user):
+		self.user = user
+		self.is_superuser = user.is_superuser
+		self._shop_ids = None
+
+	@classmethod
+	def for_request(cls, request):
+		access = getattr(request, cls.request_attr, None)
+		if access is None or access.user is not request.user:
+			access = cls(request.user)
+			setattr(request, cls.request_attr, access)
+		return access
+
+	@property
+	def shop_ids(self):
+		if self._shop_ids is None:
+			self._shop_ids = cached_auth_value(self.user, 'shops',
+				lambda: frozenset(self.user.managed_shops.values_list('id', flat=True)))
+		return self._shop_ids
+
+	def has_shop(self, shop_id):
+		return self.is_superuser or shop_id in self.shop_ids
+
+	def filter_shops(self, queryset, field='pk'):
+		if self.is_superuser:
+			return queryset
+		return queryset.filter(**{f'{field}__in': self.shop_ids})
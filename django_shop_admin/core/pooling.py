@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+from collections import deque
+import psycopg2
+from psycopg2 import extensions
+
+# Пул соединений PostgreSQL на процесс (бэкенд core.backends.postgresql): соединение
+# берется из пула при первом запросе к БД и возвращается в конце запроса вместо
+# закрытия, новое соединение (TLS, аутентификация) открывается только если свободных
+# нет, а размер пула меньше MAX_SIZE. Пул общий для потоков процесса, поэтому работает
+# одинаково под WSGI (потоки воркера) и ASGI (потоки sync_to_async).
+
+DEFAULTS = {
+	#Максимум открытых соединений процесса с одной базой
+	'MAX_SIZE': 10,
+	#Сколько секунд ждать свободного соединения, затем OperationalError
+	'TIMEOUT': 10,
+	#Свободное дольше стольких секунд соединение закрывается
+	'MAX_IDLE': 300,
+	#Соединение старше стольких секунд закрывается при возврате
+	'MAX_LIFETIME': 3600,
+	#Соединение, простоявшее дольше стольких секунд, проверяется запросом SELECT 1 при выдаче
+	'CHECK_AFTER': 5,
+}
+
+COUNTERS = ('checkouts', 'waits', 'wait_ms', 'timeouts', 'created', 'closed', 'failed_checks')
+
+_pools = {}
+_lock = threading.Lock()
+_pid = os.getpid()
+#Соединения, открытые до fork: сокет общий с родителем, закрывать их нельзя
+_inherited = []
+
+
+class ConnectionPool:
+	def __init__(self, alias, database, options):
+		self.alias = alias
+		self.database = database
+		self.options = dict(DEFAULTS, **options)
+		self.cond = threading.Condition()
+		#(соединение, время открытия, время возврата), последним - недавно возвращенное
+		self.idle = deque()
+		self.size = 0
+		#id соединения -> время открытия для выданных соединений
+		self.in_use = {}
+		self.counters = dict.fromkeys(COUNTERS, 0)
+
+	def _discard(self, conn):
+		self.size -= 1
+		self.counters['closed'] += 1
+		self.cond.notify()
+		try:
+			conn.close()
+		except psycopg2.Error:
+			pass
+
+	def _reap(self, now):
+		while self.idle and now - self.idle[0][2] > self.options['MAX_IDLE']:
+			self._discard(self.idle.popleft()[0])
+
+	def _is_healthy(self, conn, idle_for):
+		if conn.closed:
+			return False
+		if idle_for <= self.options['CHECK_AFTER']:
+			return True
+		try:
+			with conn.cursor() as cursor:
+				cursor.execute('SELECT 1')
+			if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+				conn.rollback()
+		except psycopg2.Error:
+			return False
+		return True
+
+	#connect открывает новое соединение, если свободных нет и размер позволяет
+	def checkout(self, connect):
+		deadline = time.monotonic() + self.options['TIMEOUT']
+		waited_from = None
+		with self.cond:
+			self.counters['checkouts'] += 1
+		while True:
+			with self.cond:
+				while True:
+					now = time.monotonic()
+					self._reap(now)
+					if self.idle or self.size < self.options['MAX_SIZE']:
+						break
+					if waited_from is None:
+						waited_from = now
+						self.counters['waits'] += 1
+					if now >= deadline:
+						self.counters['timeouts'] += 1
+						self.counters['wait_ms'] += (now - waited_from) * 1000
+						raise psycopg2.OperationalError(
+							f'Нет свободного соединения с БД {self.alias} за {self.options["TIMEOUT"]} с')
+					self.cond.wait(deadline - now)
+				if waited_from is not None:
+					self.counters['wait_ms'] += (now - waited_from) * 1000
+					waited_from = None
+				if self.idle:
+					conn, created_at, returned_at = self.idle.pop()
+				else:
+					conn = None
+					self.size += 1
+			if conn is None:
+				try:
+					conn = connect()
+				except BaseException:
+					with self.cond:
+						self.size -= 1
+						self.cond.notify()
+					raise
+				with self.cond:
+					self.counters['created'] += 1
+					self.in_use[id(conn)] = time.monotonic()
+				return conn
+			#Проверка выполняется вне блокировки, неисправное соединение заменяется
+			if self._is_healthy(conn, now - returned_at):
+				with self.cond:
+					self.in_use[id(conn)] = created_at
+				return conn
+			with self.cond:
+				self.counters['failed_checks'] += 1
+				self._discard(conn)
+
+	def checkin(self, conn):
+		now = time.monotonic()
+		with self.cond:
+			created_at = self.in_use.pop(id(conn), now)
+		keep = not conn.closed and now - created_at < self.options['MAX_LIFETIME']
+		if keep:
+			#Незавершенная транзакция откатывается, соединение возвращается в исходное состояние
+			try:
+				if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+					conn.rollback()
+			except psycopg2.Error:
+				keep = False
+		with self.cond:
+			if keep:
+				self.idle.append((conn, created_at, now))
+				self.cond.notify()
+			else:
+				self._discard(conn)
+
+	def close(self):
+		with self.cond:
+			while self.idle:
+				self._discard(self.idle.popleft()[0])
+
+	def metrics(self):
+		with self.cond:
+			self._reap(time.monotonic())
+			return dict(self.counters, alias=self.alias, database=self.database, size=self.size,
+				idle=len(self.idle), in_use=self.size - len(self.idle), wait_ms=round(self.counters['wait_ms'], 1),
+				max_size=self.options['MAX_SIZE'])
+
+
+#Пул для псевдонима и параметров подключения: у тестовой и служебной базы свои пулы
+def get_pool(alias, conn_params, options):
+	global _pid
+	key = (alias, tuple(sorted((k, str(v)) for k, v in conn_params.items())))
+	with _lock:
+		if os.getpid() != _pid:
+			for pool in _pools.values():
+				_inherited.extend(conn for conn, _, _ in pool.idle)
+			_pools.clear()
+			_pid = os.getpid()
+		pool = _pools.get(key)
+		if pool is None:
+			pool = _pools[key] = ConnectionPool(alias, conn_params.get('database'), options)
+		return pool
+
+
+def close_pools(database=None):
+	with _lock:
+		pools = [pool for pool in _pools.values() if database is None or pool.database == database]
+	for pool in pools:
+		pool.close()
+
+
+#Счетчики пулов текущего процесса
+def pool_metrics():
+	with _lock:
+		pools = list(_pools.values())
+	return [pool.metrics() for pool in pools]
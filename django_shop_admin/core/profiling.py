@@ -0,0 +1,112 @@
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import time
+import traceback
+from contextlib import ExitStack
+from django.db import connections
+from .models import RequestProfile
+
+# Профилирование отдельного запроса по требованию суперпользователя:
+# параметр ?_profile=1 или заголовок X-Profile: 1. Запрос выполняется под cProfile,
+# SQL записывается вместе с местом вызова в коде приложения, результат
+# сохраняется в RequestProfile и доступен на странице "Профили запросов".
+
+PROFILE_PARAM = '_profile'
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#Модули, кадры которых не считаются местом вызова запроса
+SKIP_FILES = (os.path.join(APP_DIR, 'profiling.py'), os.path.join(APP_DIR, 'instrumentation.py'))
+
+SORT_KEYS = ('cumulative', 'tottime', 'calls')
+
+
+def profiling_requested(request):
+	return request.GET.get(PROFILE_PARAM) == '1' or request.META.get(PROFILE_HEADER) == '1'
+
+
+#Ближайшие к запросу кадры стека из файлов приложения, например 'admin.py:610 in get_queryset'
+def query_origin(limit=3):
+	frames = [f for f in traceback.extract_stack()
+		if f.filename.startswith(APP_DIR) and f.filename not in SKIP_FILES]
+	return [f'{os.path.relpath(f.filename, APP_DIR)}:{f.lineno} in {f.name}' for f in frames[-limit:]][::-1]
+
+
+class QueryRecorder:
+	params_limit = 500
+
+	def __init__(self):
+		self.queries = []
+
+	def __call__(self, execute, sql, params, many, context):
+		start = time.perf_counter()
+		try:
+			return execute(sql, params, many, context)
+		finally:
+			self.queries.append({
+				'sql': sql,
+				'params': repr(params)[:self.params_limit],
+				'ms': round((time.perf_counter() - start) * 1000, 3),
+				'origin': query_origin(),
+			})
+
+
+def load_stats(data, stream):
+	stats = pstats.Stats(stream=stream)
+	stats.stats = marshal.loads(bytes(data))
+	stats.get_top_level_stats()
+	return stats
+
+
+#Текстовая сводка профиля, отсортированная по sort, первые limit функций
+def stats_summary(data, sort='cumulative', limit=60):
+	stream = io.StringIO()
+	load_stats(data, stream).sort_stats(sort).print_stats(limit)
+	return stream.getvalue()
+
+
+class ProfilingMiddleware:
+	def __init__(self, get_response):
+		self.get_response = get_response
+
+	def __call__(self, request):
+		if not (profiling_requested(request) and request.user.is_superuser):
+			return self.get_response(request)
+		if PROFILE_PARAM in request.GET:
+			#Параметр не должен попасть в фильтры списков админки
+			request.GET = request.GET.copy()
+			del request.GET[PROFILE_PARAM]
+		recorder = QueryRecorder()
+		profiler = cProfile.Profile()
+		start = time.perf_counter()
+		with ExitStack() as stack:
+			for connection in connections.all():
+				stack.enter_context(connection.execute_wrapper(recorder))
+			profiler.enable()
+			try:
+				response = self.get_response(request)
+			finally:
+				profiler.disable()
+		ms = (time.perf_counter() - start) * 1000
+		profiler.create_stats()
+		match = getattr(request, 'resolver_match', None)
+		profile = RequestProfile.objects.create(
+			user=request.user,
+			method=request.method,
+			path=request.get_full_path()[:1000],
+			view_name=match.view_name if match else '',
+			status=response.status_code,
+			duration_ms=ms,
+			query_count=len(recorder.queries),
+			query_ms=sum(q['ms'] for q in recorder.queries),
+			stats=marshal.dumps(profiler.stats),
+			queries=recorder.queries,
+		)
+		RequestProfile.objects.filter(pk__in=RequestProfile.objects.order_by('-pk')
+			.values('pk')[RequestProfile.keep:]).delete()
+		response['X-Profile-Id'] = str(profile.pk)
+		return response
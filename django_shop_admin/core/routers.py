@@ -0,0 +1,114 @@
+import logging
+import random
+import time
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import connections, DatabaseError, DEFAULT_DB_ALIAS
+
+# Чтение тяжелых страниц (списки, фильтры, автодополнение, пути к категории, экспорт)
+# с реплик. Запись и чтение после записи - с основной базы: запрос, в котором была
+# запись, и все запросы сессии в течение DATABASE_REPLICA_STICKY_SECONDS после
+# изменяющего запроса. Недоступная или отстающая реплика пропускается до следующей проверки.
+
+logger = logging.getLogger(__name__)
+
+#Реплика, выбранная для текущего запроса, и была ли в нем запись
+routing = ContextVar('replica_routing', default=None)
+
+STICKY_SESSION_KEY = '_primary_until'
+
+_health = {}
+
+
+def _check_replica(alias):
+	try:
+		with connections[alias].cursor() as cursor:
+			cursor.execute(
+				"SELECT CASE WHEN NOT pg_is_in_recovery()"
+				" OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0"
+				" ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END")
+			lag = cursor.fetchone()[0]
+	except DatabaseError:
+		logger.warning('Реплика %s недоступна', alias, exc_info=True)
+		connections[alias].close()
+		return False
+	if lag is not None and lag > settings.DATABASE_REPLICA_MAX_LAG:
+		logger.warning('Реплика %s отстает на %.1f с', alias, lag)
+		return False
+	return True
+
+
+#Состояние реплики кэшируется в процессе на DATABASE_REPLICA_CHECK_INTERVAL секунд
+def replica_is_healthy(alias):
+	now = time.monotonic()
+	healthy, checked_at = _health.get(alias, (True, None))
+	if checked_at is None or now - checked_at >= settings.DATABASE_REPLICA_CHECK_INTERVAL:
+		healthy = _check_replica(alias)
+		_health[alias] = (healthy, now)
+	return healthy
+
+
+#Случайная исправная реплика или None
+def choose_replica():
+	replicas = [alias for alias in settings.DATABASE_REPLICAS if replica_is_healthy(alias)]
+	return random.choice(replicas) if replicas else None
+
+
+def is_sticky(request):
+	session = getattr(request, 'session', None)
+	return session is not None and session.get(STICKY_SESSION_KEY, 0) > time.time()
+
+
+#База для чтения вне маршрутизируемых запросов, например для потокового экспорта,
+#который читает данные уже после выхода из представления
+def read_database(request=None):
+	if request is not None and is_sticky(request):
+		return DEFAULT_DB_ALIAS
+	return choose_replica() or DEFAULT_DB_ALIAS
+
+
+class ReplicaRouter:
+	def db_for_read(self, model, **hints):
+		state = routing.get()
+		if state is not None and not state['written']:
+			return state['alias']
+		return None
+
+	def db_for_write(self, model, **hints):
+		state = routing.get()
+		if state is not None:
+			state['written'] = True
+		return DEFAULT_DB_ALIAS
+
+	def allow_relation(self, obj1, obj2, **hints):
+		return True
+
+	def allow_migrate(self, db, app_label, model_name=None, **hints):
+		if db in settings.DATABASE_REPLICAS:
+			return False
+		return None
+
+
+class ReplicaRoutingMiddleware:
+	def __init__(self, get_response):
+		self.get_response = get_response
+
+	def __call__(self, request):
+		state = {'alias': None, 'written': False}
+		token = routing.set(state)
+		try:
+			response = self.get_response(request)
+		finally:
+			routing.reset(token)
+		#Изменяющий запрос закрепляет сессию за основной базой
+		if request.method not in ('GET', 'HEAD', 'OPTIONS') and hasattr(request, 'session'):
+			request.session[STICKY_SESSION_KEY] = time.time() + settings.DATABASE_REPLICA_STICKY_SECONDS
+		return response
+
+	def process_view(self, request, view_func, view_args, view_kwargs):
+		if (request.method in ('GET', 'HEAD') and request.resolver_match.view_name in settings.DATABASE_REPLICA_VIEWS
+				and not is_sticky(request)):
+			state = routing.get()
+			if state is not None:
+				state['alias'] = choose_replica()
+		return None
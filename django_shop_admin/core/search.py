@@ -0,0 +1,26 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db.models import F, Q
+from django.db.models.functions import Upper
+
+# Поиск продуктов: полнотекстовый по названию и описанию (search_vector, GIN)
+# и по подстроке/похожести названия (триграммный GIN-индекс по UPPER(title)).
+
+SEARCH_CONFIG = 'russian'
+
+MAX_ID = 2**63 - 1
+
+
+#Фильтрует и упорядочивает продукты по релевантности. Число ищется как id
+def search_products(queryset, term):
+	term = term.strip()
+	if not term:
+		return queryset
+	if term.isdecimal() and int(term) <= MAX_ID:
+		return queryset.filter(pk=int(term))
+	query = SearchQuery(term, config=SEARCH_CONFIG, search_type='websearch')
+	return queryset.alias(title_upper=Upper('title')).filter(
+		Q(search_vector=query) | Q(title_upper__contains=term.upper())
+		| Q(title_upper__trigram_similar=term.upper())
+	).annotate(
+		search_rank=SearchRank(F('search_vector'), query) + TrigramSimilarity('title', term)
+	).order_by('-search_rank', '-pk')
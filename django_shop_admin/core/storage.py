@@ -0,0 +1,139 @@
+import os
+import re
+import hashlib
+import shutil
+import tempfile
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+
+# Хранилище с дедупликацией: файл хэшируется при записи на диск и сохраняется
+# под именем images/sha256/ab/cd/<хэш>.<расширение>, одинаковые фото хранятся
+# один раз. Ссылки строк Shop/ProductImage на файл считаются в таблице
+# stored_files, удаление (django_cleanup) выполняется только для последней ссылки.
+
+CONTENT_NAME_RE = re.compile(r'/sha256/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.\w+$')
+
+
+def content_name(digest, filename):
+	ext = os.path.splitext(filename)[1].lower()
+	return f'{settings.IMAGES_DIR}/sha256/{digest[:2]}/{digest[2:4]}/{digest}{ext}'
+
+
+def is_content_name(name):
+	return bool(CONTENT_NAME_RE.search(name))
+
+
+class ContentAddressedStorage(FileSystemStorage):
+	def _save(self, name, content):
+		from .models import lock_stored_file
+		digest = hashlib.sha256()
+		#Как FileSystemStorage, создает MEDIA_ROOT при первой загрузке
+		os.makedirs(self.location, exist_ok=True)
+		fd, tmp_path = tempfile.mkstemp(dir=self.location, prefix='.upload-')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				for chunk in content.chunks():
+					digest.update(chunk)
+					f.write(chunk)
+			name = content_name(digest.hexdigest(), name)
+			path = self.path(name)
+			#Блокировка строки до конца транзакции: удаление этого же файла
+			#дождется ее и увидит новую ссылку
+			lock_stored_file(name)
+			if not os.path.exists(path):
+				os.makedirs(os.path.dirname(path), exist_ok=True)
+				if self.file_permissions_mode is not None:
+					os.chmod(tmp_path, self.file_permissions_mode)
+				os.replace(tmp_path, path)
+		finally:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+		return name
+
+	def delete(self, name):
+		from .models import StoredFile
+		from .thumbnails import thumbnail_name
+		with transaction.atomic():
+			refs = StoredFile.objects.select_for_update().filter(name=name).values_list('refs', flat=True).first()
+			if refs is not None and refs > 0:
+				return
+			super().delete(name)
+			if refs is not None:
+				StoredFile.objects.filter(name=name).delete()
+			#Миниатюры удаляются и у файлов без строки (загруженных до подсчета ссылок),
+			#мимо delete(), чтобы не искать миниатюры миниатюр
+			for size in settings.THUMBNAIL_SIZES:
+				super().delete(thumbnail_name(name, size))
+
+	#Удаляет до limit файлов, ссылки на которые удалены запросами без сигналов
+	#(delete_products, delete_shops). Видны только закоммиченные изменения, строки,
+	#заблокированные загрузкой того же файла, пропускаются
+	def sweep(self, limit=1000):
+		from .models import StoredFile
+		with transaction.atomic():
+			names = list(StoredFile.objects.select_for_update(skip_locked=True).filter(refs__lte=0)
+				.order_by('name').values_list('name', flat=True)[:limit])
+			for name in names:
+				self.delete(name)
+		return len(names)
+
+
+def file_digest(path, chunk_size=1024*1024):
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+#Переводит уже загруженные файлы на имена по содержимому: одинаковые файлы
+#сливаются в один, ссылки строк и миниатюры переносятся, затем ссылки пересчитываются
+def dedupe_media(storage, dry_run=False, log=print):
+	from .models import stored_file_fields, recount_stored_files
+	from .thumbnails import thumbnail_name
+	names = set()
+	for model, f in stored_file_fields():
+		names.update(model.objects.exclude(**{f.name: ''}).exclude(**{f'{f.name}__isnull': True})
+			.order_by().values_list(f.name, flat=True).distinct())
+	seen = set()
+	stats = {'files': 0, 'moved': 0, 'merged': 0, 'missing': 0, 'freed_bytes': 0}
+	for name in sorted(names):
+		if is_content_name(name):
+			continue
+		stats['files'] += 1
+		path = storage.path(name)
+		if not os.path.isfile(path):
+			stats['missing'] += 1
+			log(f'Нет файла: {name}')
+			continue
+		new_name = content_name(file_digest(path), name)
+		new_path = storage.path(new_name)
+		if new_name in seen or os.path.exists(new_path):
+			stats['merged'] += 1
+			stats['freed_bytes'] += os.path.getsize(path)
+		else:
+			stats['moved'] += 1
+		seen.add(new_name)
+		if dry_run:
+			continue
+		if not os.path.exists(new_path):
+			os.makedirs(os.path.dirname(new_path), exist_ok=True)
+			try:
+				os.link(path, new_path)
+			except OSError:
+				shutil.copy2(path, new_path)
+		with transaction.atomic():
+			for model, f in stored_file_fields():
+				model.objects.filter(**{f.name: name}).update(**{f.name: new_name})
+		for size in settings.THUMBNAIL_SIZES:
+			thumb, new_thumb = storage.path(thumbnail_name(name, size)), storage.path(thumbnail_name(new_name, size))
+			if os.path.exists(thumb):
+				if os.path.exists(new_thumb):
+					os.remove(thumb)
+				else:
+					os.replace(thumb, new_thumb)
+		os.remove(path)
+	if not dry_run:
+		recount_stored_files()
+	return stats
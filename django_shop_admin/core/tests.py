@@ -1,3 +1,743 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import json
+import tempfile
+from PIL import Image
+from django.test import TestCase, SimpleTestCase, RequestFactory, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.conf import settings
+from django.http import HttpResponse
+from django.urls import resolve, reverse
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction
+from django.core.exceptions import ValidationError
+from psycopg2 import OperationalError
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.admin import helpers
+from django.contrib.admin.models import LogEntry, DELETION
+from django.contrib.contenttypes.models import ContentType
+from unittest import mock
+from .models import (Shop, Category, CategoryParent, CategoryClosure, Product, ProductImage,
+	rebuild_category_closure, add_product_categories, remove_product_categories, replace_product_categories,
+	bump_auth_version, bump_cache_version,
+	get_parent_category_choices, CATEGORY_CHOICES_VERSION_KEY, StoredFile, BackgroundJob)
+from .jobs import work, enqueue, run_action, cancel_jobs, STALE_TIMEOUT
+from .graph import find_cycle_edges, CategoryPaths
+from .views import parse_range
+from .storage import is_content_name
+from .thumbnails import thumbnail_name
+from .admin import ProductAdmin, CategoryAdmin, CategoryFilter
+from .search import search_products
+from .importing import ProductImporter, iter_rows
+from . import routers
+from .pooling import ConnectionPool
+from .permissions import CachedModelBackend, ShopAccess
 
 # Create your tests here.
+
+class FindCycleEdgesTest(SimpleTestCase):
+	def test_self_loop(self):
+		self.assertEqual(find_cycle_edges([], [(1, 1)]), [(1, 1)])
+
+	def test_two_cycle(self):
+		self.assertEqual(find_cycle_edges([(1, 2)], [(2, 1)]), [(2, 1)])
+		self.assertEqual(find_cycle_edges([], [(1, 2), (2, 1)]), [(1, 2), (2, 1)])
+
+	def test_cycle_through_existing_ancestor(self):
+		#4 - предок 2 через 3, ребро 5 -> 2 цикла не замыкает
+		self.assertEqual(find_cycle_edges([(2, 3), (3, 4)], [(5, 2), (4, 2)]), [(4, 2)])
+
+	def test_diamond_has_no_cycles(self):
+		self.assertEqual(find_cycle_edges([(2, 1), (3, 1)], [(4, 2), (4, 3)]), [])
+
+
+class CategoryPathsTest(SimpleTestCase):
+	#Ромб: D в B и C, B и C в A; E в A и в D
+	edges = [('D', 'B'), ('D', 'C'), ('B', 'A'), ('C', 'A'), ('E', 'D'), ('E', 'A')]
+	titles = [(k, k) for k in 'ABCDE']
+	e_paths = ['A / ', 'A / B / D / ', 'A / C / D / ']
+
+	def test_counts_and_paths(self):
+		self.assertEqual(list(CategoryPaths('A', self.edges, self.titles)), [])
+		self.assertEqual(len(CategoryPaths('A', self.edges, self.titles)), 0)
+		self.assertEqual(list(CategoryPaths('D', self.edges, self.titles)), ['A / B / ', 'A / C / '])
+		paths = CategoryPaths('E', self.edges, self.titles)
+		self.assertEqual(len(paths), 3)
+		self.assertEqual(paths.counts['D'], 2)
+		self.assertEqual(list(paths), self.e_paths)
+
+	def test_slices_and_indexes(self):
+		for memo_limit in (1000, 0):
+			paths = CategoryPaths('E', self.edges, self.titles)
+			paths.memo_limit = memo_limit
+			self.assertEqual(paths[1:], self.e_paths[1:])
+			self.assertEqual(paths[2:10], self.e_paths[2:])
+			self.assertEqual(paths[::2], self.e_paths[::2])
+			self.assertEqual([paths[i] for i in range(-3, 3)], self.e_paths * 2)
+			with self.assertRaises(IndexError):
+				paths[3]
+
+
+class CategoryClosureTest(TestCase):
+	def setUp(self):
+		self.a, self.b, self.c, self.d, self.e = (Category.objects.create(title=f'Категория {k}') for k in 'ABCDE')
+
+	#Сравнивает таблицу замыкания с пересчетом рекурсивным запросом по ребрам
+	def assert_closure(self):
+		with connection.cursor() as cursor:
+			cursor.execute(
+				f"WITH RECURSIVE up(descendant_id, ancestor_id, depth) AS ("
+				f" SELECT id, id, 0 FROM {Category._meta.db_table}"
+				f" UNION ALL"
+				f" SELECT up.descendant_id, cp.to_category_id, up.depth + 1 FROM {CategoryParent._meta.db_table} cp"
+				f" JOIN up ON cp.from_category_id = up.ancestor_id"
+				f") SELECT ancestor_id, descendant_id, MIN(depth) FROM up GROUP BY ancestor_id, descendant_id")
+			expected = set(cursor.fetchall())
+		self.assertEqual(set(CategoryClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth')), expected)
+
+	def build(self):
+		self.b.parents.add(self.a)
+		self.c.parents.add(self.b)
+		self.d.parents.add(self.c, self.a)
+		self.e.parents.add(self.d)
+		self.assert_closure()
+		self.assertEqual(CategoryClosure.objects.get(ancestor=self.a, descendant=self.e).depth, 2)
+
+	def test_add_remove_clear(self):
+		self.build()
+		self.c.parents.remove(self.b)
+		self.assert_closure()
+		self.d.parents.clear()
+		self.assert_closure()
+		self.a.category_set.add(self.c, self.d)
+		self.assert_closure()
+		CategoryParent.objects.get(from_category=self.d, to_category=self.a).delete()
+		self.assert_closure()
+		self.a.category_set.clear()
+		self.assert_closure()
+		rebuild_category_closure()
+		self.assert_closure()
+
+	def test_delete_category(self):
+		self.build()
+		self.c.delete()
+		self.assert_closure()
+		self.a.delete()
+		self.assert_closure()
+
+	def test_cycle_is_rejected(self):
+		self.build()
+		before = set(CategoryClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+		#Цикл через предков в таблице замыкания, в том числе с обратной стороны связи
+		for add in (lambda: self.a.parents.add(self.e), lambda: self.d.category_set.add(self.b),
+				lambda: CategoryParent.objects.create(from_category=self.c, to_category=self.e)):
+			with self.assertRaises(ValidationError), transaction.atomic():
+				add()
+		self.assertEqual(set(CategoryClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth')), before)
+
+
+class ProductChangelistQueriesTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+		cls.shop = Shop.objects.create(title='Тестовый магазин')
+		Product.objects.bulk_create(
+			Product(title=f'Продукт {i}', price=i, shop=cls.shop) for i in range(500))
+		ProductImage.objects.bulk_create(
+			ProductImage(image=f'images/products/{pk}/{i}.jpg', product_id=pk, position=i)
+			for pk in Product.objects.values_list('pk', flat=True) for i in range(2))
+
+	def setUp(self):
+		self.client.force_login(self.user)
+
+	def changelist_queries(self, per_page):
+		with mock.patch.object(ProductAdmin, 'list_per_page', per_page):
+			with CaptureQueriesContext(connection) as ctx:
+				response = self.client.get('/admin/core/product/')
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(len(response.context['cl'].result_list), per_page)
+		self.assertContains(response, self.shop.title)
+		return len(ctx.captured_queries)
+
+	def test_query_count_does_not_depend_on_page_size(self):
+		#Первый запрос заполняет кэш сессии и прав
+		self.changelist_queries(50)
+		small = self.changelist_queries(50)
+		large = self.changelist_queries(500)
+		self.assertEqual(small, large)
+		self.assertLessEqual(large, 15)
+
+
+class ParentCategoryChoicesTest(TestCase):
+	def test_choices_are_cached_until_categories_change(self):
+		bump_cache_version((CATEGORY_CHOICES_VERSION_KEY,))
+		parent, child = Category.objects.create(title='Родитель'), Category.objects.create(title='Потомок')
+		child.parents.add(parent)
+		self.assertEqual(get_parent_category_choices(), [(parent.pk, 'Родитель')])
+		with self.assertNumQueries(0):
+			get_parent_category_choices()
+		parent.title = 'Раздел'
+		parent.save()
+		self.assertEqual(get_parent_category_choices(), [(parent.pk, 'Раздел')])
+		child.parents.remove(parent)
+		self.assertEqual(get_parent_category_choices(), [])
+
+
+class ProductCategoryCountersTest(TestCase):
+	def test_removing_unlinked_items_keeps_counters(self):
+		shop = Shop.objects.create(title='Магазин')
+		linked, other = Product.objects.create(title='Продукт', price=1, shop=shop), Product.objects.create(
+			title='Другой', price=1, shop=shop)
+		category, unlinked = Category.objects.create(title='Категория'), Category.objects.create(title='Пустая')
+		linked.categories.add(category)
+		linked.categories.remove(unlinked)
+		category.products.remove(other)
+		self.assertEqual(list(Category.objects.order_by('pk').values_list('product_count', 'active_product_count')),
+			[(1, 1), (0, 0)])
+		category.products.remove(linked, other)
+		self.assertEqual(Category.objects.get(pk=category.pk).product_count, 0)
+
+
+class ProductCategoriesBulkTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		shop = Shop.objects.create(title='Магазин')
+		cls.p1, cls.p2, cls.other = (Product.objects.create(title=f'Продукт {i}', price=1, shop=shop, active=i != 2)
+			for i in range(1, 4))
+		cls.c1, cls.c2, cls.c3 = (Category.objects.create(title=f'Категория {i}') for i in range(1, 4))
+		cls.other.categories.add(cls.c1)
+		cls.queryset = Product.objects.filter(pk__in=(cls.p1.pk, cls.p2.pk))
+
+	def assert_state(self, links, counters):
+		self.assertEqual(set(Product.categories.through.objects.values_list('product_id', 'category_id')),
+			{(p.pk, c.pk) for p, c in links} | {(self.other.pk, self.c1.pk)})
+		self.assertEqual(list(Category.objects.order_by('pk').values_list('product_count', 'active_product_count')),
+			counters)
+
+	def test_duplicate_adds(self):
+		self.assertEqual(add_product_categories(self.queryset, [self.c1.pk, self.c1.pk, self.c2.pk]), 4)
+		self.assertEqual(add_product_categories(self.queryset, [self.c1.pk]), 0)
+		self.assert_state([(p, c) for p in (self.p1, self.p2) for c in (self.c1, self.c2)],
+			[(3, 2), (2, 1), (0, 0)])
+
+	def test_removing_unlinked_ids(self):
+		add_product_categories(self.queryset, [self.c2.pk])
+		self.assertEqual(remove_product_categories(self.queryset, [self.c1.pk, self.c3.pk]), 0)
+		self.assert_state([(self.p1, self.c2), (self.p2, self.c2)], [(1, 1), (2, 1), (0, 0)])
+		self.assertEqual(remove_product_categories(self.queryset, [self.c2.pk, self.c3.pk]), 2)
+		self.assert_state([], [(1, 1), (0, 0), (0, 0)])
+
+	def test_replace_with_overlapping_set(self):
+		add_product_categories(self.queryset, [self.c1.pk, self.c2.pk])
+		self.p1.categories.remove(self.c2)
+		self.assertEqual(replace_product_categories(self.queryset, [self.c2.pk, self.c3.pk]), (3, 2))
+		self.assert_state([(p, c) for p in (self.p1, self.p2) for c in (self.c2, self.c3)],
+			[(1, 1), (2, 1), (2, 1)])
+		self.assertEqual(replace_product_categories(self.queryset, [self.c2.pk, self.c3.pk]), (0, 0))
+
+
+class CategoryFilterTest(TestCase):
+	def test_manager_sees_categories_of_own_shops_once(self):
+		manager = User.objects.create_user('manager', password='password', is_staff=True)
+		shop, other = Shop.objects.create(title='Магазин'), Shop.objects.create(title='Другой')
+		shop.product_managers.add(manager)
+		first, second, foreign = (Category.objects.create(title=f'Категория {i}') for i in range(3))
+		for i in range(3):
+			Product.objects.create(title=f'Продукт {i}', price=1, shop=shop).categories.add(first, second)
+		Product.objects.create(title='Чужой', price=1, shop=other).categories.add(foreign, first)
+		request = RequestFactory().get('/')
+		request.user = manager
+		with CaptureQueriesContext(connection) as queries:
+			lookups = CategoryFilter(request, {}, Product, None).lookups(request, None)
+		self.assertEqual(lookups, [(first.pk, first.title), (second.pk, second.title)])
+		self.assertFalse(any('DISTINCT' in q['sql'] for q in queries.captured_queries))
+
+
+class KeysetPaginationTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+		shop = Shop.objects.create(title='Магазин')
+		#По 5 продуктов с одной ценой: ключ сортировки повторяется
+		Product.objects.bulk_create(Product(title=f'Продукт {i}', price=i // 5, shop=shop) for i in range(25))
+		Category.objects.bulk_create(Category(title=f'Категория {i:02}') for i in range(25))
+
+	def setUp(self):
+		self.client.force_login(self.user)
+
+	def changelist(self, url, query=''):
+		response = self.client.get(url + query)
+		self.assertEqual(response.status_code, 200)
+		return response.context['cl']
+
+	def walk(self, url, query, ordered):
+		pages, cl = [], self.changelist(url, query)
+		pages.append([o.pk for o in cl.result_list])
+		while cl.next_cursor_url:
+			cl = self.changelist(url, cl.next_cursor_url)
+			self.assertTrue(cl.keyset_mode)
+			pages.append([o.pk for o in cl.result_list])
+		self.assertEqual([pk for page in pages for pk in page], list(ordered.values_list('pk', flat=True)))
+		for page in reversed(pages[:-1]):
+			cl = self.changelist(url, cl.previous_cursor_url)
+			self.assertEqual([o.pk for o in cl.result_list], page)
+		return pages
+
+	def test_next_and_previous_cursors_with_ties(self):
+		with mock.patch.object(ProductAdmin, 'list_per_page', 10):
+			cl = self.changelist('/admin/core/product/')
+			query = f'?o={cl.list_display.index("price")}'
+			pages = self.walk('/admin/core/product/', query, Product.objects.order_by('price', '-pk'))
+		self.assertEqual([len(page) for page in pages], [10, 10, 5])
+
+	def test_unique_sort_field_is_keyset_tiebreaker(self):
+		with mock.patch.object(CategoryAdmin, 'list_per_page', 10):
+			pages = self.walk('/admin/core/category/', '', Category.objects.order_by('title'))
+		self.assertEqual(len(pages), 3)
+
+	def test_count_is_estimated_above_threshold(self):
+		with mock.patch('core.pagination.estimate_count', return_value=500):
+			self.assertEqual(self.changelist('/admin/core/product/').result_count_display, 25)
+		with mock.patch('core.pagination.estimate_count', return_value=50000):
+			self.assertEqual(self.changelist('/admin/core/product/').result_count_display, '~50.0K')
+			self.assertContains(self.client.get('/admin/core/product/'), '~50.0K')
+
+	def test_autocomplete_counts_exactly(self):
+		with mock.patch('core.pagination.estimate_count', return_value=50000):
+			response = self.client.get('/admin/autocomplete/', {'app_label': 'core', 'model_name': 'product',
+				'field_name': 'categories', 'term': 'Категория 1'})
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(len(response.json()['results']), 10)
+		self.assertFalse(response.json()['pagination']['more'])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ProductImagesFormTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+		cls.product = Product.objects.create(title='Продукт', price=1, shop=Shop.objects.create(title='Магазин'))
+		cls.category = Category.objects.create(title='Категория')
+		cls.images = [ProductImage.objects.create(image=f'images/products/{name}.jpg', product=cls.product)
+			for name in 'abc']
+
+	def setUp(self):
+		self.client.force_login(self.user)
+
+	def upload(self):
+		data = io.BytesIO()
+		Image.new('RGB', (2, 2)).save(data, 'PNG')
+		return SimpleUploadedFile('new.png', data.getvalue(), 'image/png')
+
+	def post(self, **data):
+		others = self.images[1:]
+		data = dict({'shop': self.product.shop_id, 'title': self.product.title, 'price': '1', 'amount': '0',
+			'active': 'on', 'images-TOTAL_FORMS': len(others), 'images-INITIAL_FORMS': len(others),
+			'categories': self.category.pk, 'images-MIN_NUM_FORMS': 0, 'images-MAX_NUM_FORMS': 1000},
+			**{f'images-{i}-id': image.pk for i, image in enumerate(others)},
+			**{f'images-{i}-product': self.product.pk for i in range(len(others))}, **data)
+		response = self.client.post(f'/admin/core/product/{self.product.pk}/change/', data)
+		self.assertEqual(response.status_code, 302)
+		return list(self.product.images.order_by('position').values_list('id', 'position'))
+
+	#Позиции, сдвинутые удалением фото, не перезаписываются сохранением другого фото формы
+	def test_delete_and_edit_keep_positions(self):
+		a, b, c = self.images
+		self.assertEqual(self.post(**{'images-0-DELETE': 'on', 'images-1-image': self.upload()}),
+			[(a.pk, 0), (c.pk, 1)])
+
+	def test_make_main_posts_only_order(self):
+		a, b, c = self.images
+		url = f'/admin/core/product/{self.product.pk}/images/reorder/'
+		response = self.client.get(f'/admin/core/product/{self.product.pk}/change/')
+		self.assertContains(response, '<form id="product-images-reorder-form" method="post" action="%s">' % url)
+		self.assertContains(response, f"value='{c.pk}' form='product-images-reorder-form'")
+		self.assertEqual(self.client.get(url).status_code, 405)
+		self.assertRedirects(self.client.post(url, {'order': c.pk}), f'/admin/core/product/{self.product.pk}/change/')
+		self.assertEqual(list(self.product.images.order_by('position').values_list('id', flat=True)),
+			[c.pk, a.pk, b.pk])
+
+	def test_clear_main_and_edit_keep_positions(self):
+		a, b, c = self.images
+		self.assertEqual(self.post(**{'main_image-clear': 'on', 'images-0-image': self.upload()}),
+			[(b.pk, 0), (c.pk, 1)])
+
+
+class ContentAddressedStorageTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.product = Product.objects.create(title='Продукт', price=1, shop=Shop.objects.create(title='Магазин'))
+
+	def setUp(self):
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		#MEDIA_ROOT еще не создан, как при новой установке
+		settings = override_settings(MEDIA_ROOT=os.path.join(root, 'media'))
+		settings.enable()
+		self.addCleanup(settings.disable)
+
+	def refs(self, name):
+		return StoredFile.objects.filter(name=name).values_list('refs', flat=True).first()
+
+	def write(self, name, data=b'data'):
+		path = default_storage.path(name)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, 'wb') as f:
+			f.write(data)
+		return path
+
+	def test_identical_uploads_share_file_and_count_refs(self):
+		a, b = (ProductImage.objects.create(product=self.product, image=ContentFile(b'same', name=f'{n}.JPG'))
+			for n in 'ab')
+		name = a.image.name
+		self.assertEqual(b.image.name, name)
+		self.assertTrue(is_content_name(name) and name.endswith('.jpg'))
+		self.assertEqual(self.refs(name), 2)
+		thumb = self.write(thumbnail_name(name, settings.THUMBNAIL_SIZES[0]))
+		a.delete()
+		default_storage.delete(name)
+		self.assertEqual(self.refs(name), 1)
+		self.assertTrue(default_storage.exists(name) and os.path.exists(thumb))
+		b.delete()
+		default_storage.delete(name)
+		self.assertIsNone(self.refs(name))
+		self.assertFalse(default_storage.exists(name) or os.path.exists(thumb))
+
+	def test_delete_removes_thumbnails_of_files_without_row(self):
+		name = 'images/products/1/legacy.jpg'
+		self.write(name)
+		thumbs = [self.write(thumbnail_name(name, size)) for size in settings.THUMBNAIL_SIZES]
+		default_storage.delete(name)
+		self.assertFalse(default_storage.exists(name) or any(os.path.exists(t) for t in thumbs))
+
+	def test_sweep_deletes_unreferenced_files(self):
+		image = ProductImage.objects.create(product=self.product, image=ContentFile(b'swept', name='a.png'))
+		name = image.image.name
+		ProductImage.objects.filter(pk=image.pk).delete()
+		self.assertEqual(self.refs(name), 0)
+		with mock.patch('builtins.print'):
+			call_command('runjobs', '--once')
+		self.assertFalse(default_storage.exists(name))
+		self.assertIsNone(self.refs(name))
+
+	def test_dedupemedia_merges_duplicates(self):
+		names = ['images/products/1/a.jpg', 'images/products/1/b.jpg']
+		for name in names:
+			self.write(name, b'duplicate')
+		ProductImage.objects.bulk_create(ProductImage(product=self.product, image=name, position=i)
+			for i, name in enumerate(names))
+		with mock.patch('builtins.print'):
+			call_command('dedupemedia')
+		new_names = set(self.product.images.values_list('image', flat=True))
+		self.assertEqual(len(new_names), 1)
+		name = new_names.pop()
+		self.assertTrue(is_content_name(name) and default_storage.exists(name))
+		self.assertFalse(any(default_storage.exists(n) for n in names))
+		self.assertEqual(self.refs(name), 2)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class BulkDeleteTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+		cls.shop, cls.other_shop = Shop.objects.create(title='Магазин'), Shop.objects.create(title='Другой')
+		cls.category = Category.objects.create(title='Категория')
+		cls.products = [Product.objects.create(title=f'Продукт {i}', price=1, shop=shop, active=i % 2 == 0)
+			for i, shop in enumerate((cls.shop, cls.shop, cls.other_shop))]
+		for product in cls.products:
+			product.categories.add(cls.category)
+			ProductImage.objects.create(product=product, image=ContentFile(b'same', name='a.jpg'))
+		cls.image_name = ProductImage.objects.values_list('image', flat=True).first()
+
+	def setUp(self):
+		self.client.force_login(self.user)
+
+	def assert_state(self, product_counts, refs):
+		self.assertEqual(Category.objects.values_list('product_count', 'active_product_count').get(pk=self.category.pk),
+			product_counts)
+		self.assertEqual(StoredFile.objects.get(name=self.image_name).refs, refs)
+
+	def logged(self, model):
+		return set(LogEntry.objects.filter(action_flag=DELETION, user=self.user,
+			content_type=ContentType.objects.get_for_model(model)).values_list('object_id', 'object_repr'))
+
+	def test_delete_products_action(self):
+		deleted = self.products[:2]
+		response = self.client.post(reverse('admin:core_product_changelist'), {'action': 'delete_products',
+			'apply': '1', helpers.ACTION_CHECKBOX_NAME: [p.pk for p in deleted]})
+		self.assertEqual(response.status_code, 302)
+		self.assertFalse(Product.objects.filter(pk__in=[p.pk for p in deleted]).exists())
+		self.assert_state((1, 1), 1)
+		self.assertEqual(self.logged(Product), {(str(p.pk), p.title) for p in deleted})
+
+	def test_delete_shop_view(self):
+		response = self.client.post(reverse('admin:core_shop_delete', args=(self.shop.pk,)), {'apply': '1'})
+		self.assertEqual(response.status_code, 302)
+		self.assertFalse(Shop.objects.filter(pk=self.shop.pk).exists())
+		self.assert_state((1, 1), 1)
+		#Как в стандартном удалении, продукты магазина в журнал не пишутся
+		self.assertEqual(self.logged(Shop), {(str(self.shop.pk), self.shop.title)})
+		self.assertFalse(self.logged(Product))
+
+
+class BackgroundJobTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.shop = Shop.objects.create(title='Магазин')
+		cls.products = [Product.objects.create(title=f'Продукт {i}', price=i, shop=cls.shop) for i in range(5)]
+
+	def active_ids(self):
+		return list(Product.objects.filter(active=True).order_by('id').values_list('id', flat=True))
+
+	def run_jobs(self):
+		work(once=True, chunk_size=2, log=lambda message: None)
+
+	def test_queryset_round_trip(self):
+		queryset = Product.objects.filter(shop=self.shop, price__gte=2).exclude(title='Продукт 3')
+		job = enqueue('set_active', queryset, 'Сделать неактивными', active=False)
+		job = BackgroundJob.objects.get(pk=job.pk)
+		self.assertEqual(set(job.get_queryset().values_list('id', flat=True)), set(queryset.values_list('id', flat=True)))
+
+	def test_enqueue_and_run(self):
+		job = enqueue('set_active', Product.objects.filter(shop=self.shop), 'Сделать неактивными', active=False)
+		self.assertEqual(job.status, BackgroundJob.PENDING)
+		self.run_jobs()
+		job.refresh_from_db()
+		self.assertEqual((job.status, job.total, job.processed, job.last_id),
+			(BackgroundJob.DONE, 5, 5, self.products[-1].pk))
+		self.assertEqual(self.active_ids(), [])
+		self.assertEqual(Shop.objects.get(pk=self.shop.pk).active_product_count, 0)
+
+	def test_cancel_mid_run(self):
+		job = enqueue('set_active', Product.objects.all(), 'Сделать неактивными', active=False)
+
+		#Отмена приходит во время первой порции и ждет ее окончания
+		def cancel_after(action, queryset, **params):
+			result = run_action(action, queryset, **params)
+			cancel_jobs(BackgroundJob.objects.filter(pk=job.pk))
+			return result
+
+		with mock.patch('core.jobs.run_action', side_effect=cancel_after):
+			self.run_jobs()
+		job.refresh_from_db()
+		self.assertEqual((job.status, job.processed), (BackgroundJob.CANCELLED, 2))
+		self.assertEqual(self.active_ids(), [p.pk for p in self.products[2:]])
+
+	def test_resume_after_crash(self):
+		job = enqueue('set_active', Product.objects.all(), 'Сделать неактивными', active=False)
+		#Обработчик упал после двух порций, оставив задание выполняющимся
+		Product.objects.filter(pk__lte=self.products[3].pk).update(active=False)
+		BackgroundJob.objects.filter(pk=job.pk).update(status=BackgroundJob.RUNNING, started_at=timezone.now(),
+			total=5, processed=4, last_id=self.products[3].pk, updated_at=timezone.now() - STALE_TIMEOUT * 2)
+		with mock.patch('core.jobs.run_action', side_effect=run_action) as action:
+			self.run_jobs()
+		self.assertEqual([list(c.args[1].values_list('id', flat=True)) for c in action.call_args_list],
+			[[self.products[4].pk]])
+		job.refresh_from_db()
+		self.assertEqual((job.status, job.processed), (BackgroundJob.DONE, 5))
+		self.assertEqual(self.active_ids(), [])
+
+	def test_running_job_is_not_taken_over(self):
+		job = enqueue('set_active', Product.objects.all(), 'Сделать неактивными', active=False)
+		BackgroundJob.objects.filter(pk=job.pk).update(status=BackgroundJob.RUNNING)
+		self.run_jobs()
+		self.assertEqual(len(self.active_ids()), 5)
+
+
+class ParseRangeTest(SimpleTestCase):
+	def test_parse_range(self):
+		for header, expected in (
+				('bytes=2-4', (2, 4)), ('bytes=5-100', (5, 9)), ('bytes=5-', (5, 9)), ('bytes=-3', (7, 9)),
+				('bytes=-20', (0, 9)), ('bytes=-0', False), ('bytes=10-', False), ('bytes=5-2', None),
+				('bytes=-', None), ('bytes=0-1,3-4', None), ('items=0-1', None)):
+			with self.subTest(header=header):
+				self.assertEqual(parse_range(header, 10), expected)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), MEDIA_SENDFILE=None)
+class MediaViewTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+		cls.manager = User.objects.create_user('manager', password='password', is_staff=True)
+		cls.manager.user_permissions.add(Permission.objects.get(codename='view_product'))
+		cls.stranger = User.objects.create_user('stranger', password='password', is_staff=True)
+		cls.stranger.user_permissions.add(Permission.objects.get(codename='view_product'))
+		shop, other = Shop.objects.create(title='Магазин'), Shop.objects.create(title='Другой')
+		shop.product_managers.add(cls.manager)
+		other.product_managers.add(cls.stranger)
+		product = Product.objects.create(title='Продукт', price=1, shop=shop)
+		image = ProductImage.objects.create(product=product, image=ContentFile(b'0123456789', name='a.txt'))
+		cls.url = reverse('media', args=(image.image.name,))
+
+	def get(self, user=None, url=None, **headers):
+		self.client.force_login(user or self.user)
+		return self.client.get(url or self.url, **headers)
+
+	def test_ranges(self):
+		response = self.get(HTTP_RANGE='bytes=2-4')
+		self.assertEqual((response.status_code, b''.join(response.streaming_content)), (206, b'234'))
+		self.assertEqual((response['Content-Range'], response['Content-Length']), ('bytes 2-4/10', '3'))
+		response = self.get(HTTP_RANGE='bytes=-3')
+		self.assertEqual((response.status_code, response['Content-Range']), (206, 'bytes 7-9/10'))
+		response = self.get(HTTP_RANGE='bytes=20-')
+		self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */10'))
+		#Несколько диапазонов не поддерживаются: файл отдается целиком
+		response = self.get(HTTP_RANGE='bytes=0-1,3-4')
+		self.assertEqual((response.status_code, b''.join(response.streaming_content)), (200, b'0123456789'))
+
+	def test_if_range(self):
+		etag = self.get()['ETag']
+		response = self.get(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE=etag)
+		self.assertEqual(response.status_code, 206)
+		response = self.get(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"0-0"')
+		self.assertEqual((response.status_code, b''.join(response.streaming_content)), (200, b'0123456789'))
+		self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+	def test_shop_permission(self):
+		self.assertEqual(self.get(self.manager).status_code, 200)
+		self.assertEqual(self.get(self.stranger).status_code, 403)
+		#Миниатюра проверяется по оригиналу
+		name = self.url[len(settings.MEDIA_URL):]
+		thumbnail = thumbnail_name(name, settings.THUMBNAIL_SIZES[0])
+		with open(default_storage.path(thumbnail), 'wb') as f:
+			f.write(b'thumbnail')
+		url = reverse('media', args=(thumbnail,))
+		self.assertEqual(self.get(self.manager, url).status_code, 200)
+		self.assertEqual(self.get(self.stranger, url).status_code, 403)
+		self.client.logout()
+		self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+class ProductSearchTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		shop = Shop.objects.create(title='Тестовый магазин')
+		cls.milk = Product.objects.create(title='Молоко', description='Свежее, фермерское', price=1, shop=shop)
+		cls.bread = Product.objects.create(title='Хлеб', description='Ржаной', price=1, shop=shop)
+
+	def search(self, term):
+		return list(search_products(Product.objects.all(), term))
+
+	def test_description_and_substring(self):
+		self.assertEqual(self.search('фермерские'), [self.milk])
+		self.assertEqual(self.search('оло'), [self.milk])
+
+	def test_numeric_term_is_id(self):
+		self.assertEqual(self.search(str(self.bread.pk)), [self.bread])
+
+
+class ProductImportTest(TestCase):
+	def test_wrong_value_types_are_row_errors(self):
+		Shop.objects.create(title='Магазин')
+		Category.objects.create(title='Категория')
+		lines = [{'title': 123, 'shop': 'Магазин', 'price': 1}, {'title': 'Продукт', 'shop': ['Магазин'], 'price': 1},
+			{'title': 'Продукт', 'shop': 'Магазин', 'price': 1, 'categories': 5},
+			{'title': 'Продукт', 'shop': 'Магазин', 'price': 1, 'categories': [{}], 'amount': [1]},
+			{'title': 'Продукт', 'shop': 'Магазин', 'price': 1, 'categories': ['Категория']}]
+		errors = []
+		importer = ProductImporter(on_error=lambda line, messages: errors.append(line))
+		rows = iter_rows(io.StringIO('\n'.join(json.dumps(line) for line in lines)), 'jsonl')
+		self.assertEqual(importer.run(rows), (1, 4))
+		self.assertEqual(errors, [1, 2, 3, 4])
+
+
+@override_settings(DATABASE_REPLICAS=('replica',))
+class ReplicaRoutingTest(TestCase):
+	databases = {'default', 'replica'}
+
+	def setUp(self):
+		routers._health.clear()
+
+	def read_database(self, method='GET', url='/admin/core/product/', session=None):
+		request = getattr(RequestFactory(), method.lower())(url)
+		request.session = {} if session is None else session
+		request.resolver_match = resolve(url)
+		view = lambda request: HttpResponse(Product.objects.all().db)
+
+		def get_response(request):
+			middleware.process_view(request, view, (), {})
+			return view(request)
+
+		middleware = routers.ReplicaRoutingMiddleware(get_response)
+		return middleware(request).content.decode(), request.session
+
+	def test_changelist_reads_from_replica(self):
+		self.assertEqual(self.read_database()[0], 'replica')
+		self.assertEqual(self.read_database(url='/admin/core/product/1/change/')[0], 'default')
+
+	def test_reads_after_write_stay_on_primary(self):
+		db, session = self.read_database('POST')
+		self.assertEqual(db, 'default')
+		self.assertEqual(self.read_database(session=session)[0], 'default')
+		session[routers.STICKY_SESSION_KEY] = 0
+		self.assertEqual(self.read_database(session=session)[0], 'replica')
+
+	def test_unhealthy_replica_falls_back_to_primary(self):
+		with mock.patch.object(routers, '_check_replica', return_value=False):
+			self.assertEqual(self.read_database()[0], 'default')
+
+
+class ConnectionPoolTest(SimpleTestCase):
+	def setUp(self):
+		self.pool = ConnectionPool('default', 'test', {'MAX_SIZE': 1, 'TIMEOUT': 0.05, 'CHECK_AFTER': 0})
+
+	def connect(self):
+		conn = mock.MagicMock(closed=0)
+		conn.get_transaction_status.return_value = 0
+		return conn
+
+	def test_connection_is_reused_and_size_is_bounded(self):
+		conn = self.pool.checkout(self.connect)
+		with self.assertRaises(OperationalError):
+			self.pool.checkout(self.connect)
+		self.pool.checkin(conn)
+		self.assertIs(self.pool.checkout(self.connect), conn)
+		metrics = self.pool.metrics()
+		self.assertEqual((metrics['checkouts'], metrics['created'], metrics['waits'], metrics['timeouts']), (3, 1, 1, 1))
+
+	def test_broken_connection_is_replaced(self):
+		conn = self.pool.checkout(self.connect)
+		self.pool.checkin(conn)
+		conn.closed = 1
+		self.assertIsNot(self.pool.checkout(self.connect), conn)
+		self.assertEqual(self.pool.metrics()['failed_checks'], 1)
+
+
+class CachedAuthTest(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.group = Group.objects.create(name='product managers')
+		cls.user = User.objects.create_user('manager', password='manager', is_staff=True)
+		cls.user.groups.add(cls.group)
+		cls.shop = Shop.objects.create(title='Магазин')
+		cls.shop.product_managers.add(cls.user)
+
+	def setUp(self):
+		#Откат транзакции теста не сбрасывает кэш
+		bump_auth_version()
+
+	def resolve(self):
+		user = CachedModelBackend().get_user(self.user.pk)
+		return user.has_perm('core.view_product'), ShopAccess(user).shop_ids
+
+	def test_warm_resolution_does_no_queries(self):
+		self.assertEqual(self.resolve(), (False, {self.shop.pk}))
+		with self.assertNumQueries(0):
+			self.assertEqual(self.resolve(), (False, {self.shop.pk}))
+
+	def test_changes_invalidate_cache(self):
+		self.resolve()
+		self.group.permissions.add(Permission.objects.get(codename='view_product'))
+		self.assertEqual(self.resolve(), (True, {self.shop.pk}))
+		other = Shop.objects.create(title='Другой')
+		self.user.managed_shops.add(other)
+		self.assertEqual(self.resolve(), (True, {self.shop.pk, other.pk}))
+		self.shop.product_managers.clear()
+		self.assertEqual(self.resolve(), (True, {other.pk}))
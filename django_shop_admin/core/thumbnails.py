@@ -0,0 +1,67 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def get_executor():
+	global _executor
+	if _executor is None:
+		_executor = ProcessPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS, initializer=django.setup)
+	return _executor
+
+
+def thumbnail_name(name, size):
+	base, dot, ext = name.rpartition('.')
+	return f'{base}_{size}.{ext}' if dot else f'{name}_{size}'
+
+
+#URL миниатюры, а пока она не создана - URL оригинала
+def thumbnail_url(name, size):
+	name = str(name)
+	thumb = thumbnail_name(name, size)
+	if default_storage.exists(thumb):
+		return default_storage.url(thumb)
+	return default_storage.url(name)
+
+
+def has_thumbnails(name):
+	return all(default_storage.exists(thumbnail_name(name, s)) for s in settings.THUMBNAIL_SIZES)
+
+
+#Выполняется в дочернем процессе
+def make_thumbnails(name):
+	with Image.open(default_storage.path(name)) as im:
+		im.load()
+		fmt = im.format
+		for size in settings.THUMBNAIL_SIZES:
+			thumb = im.copy()
+			thumb.thumbnail((size, size))
+			if fmt == 'JPEG' and thumb.mode not in ('RGB', 'L'):
+				thumb = thumb.convert('RGB')
+			target = default_storage.path(thumbnail_name(name, size))
+			thumb.save(target+'.tmp', format=fmt)
+			os.replace(target+'.tmp', target)
+	return name
+
+
+def _log_failure(future):
+	if future.exception() is not None:
+		logger.error('Не удалось создать миниатюры', exc_info=future.exception())
+
+
+def schedule_thumbnails(name):
+	if name and not has_thumbnails(name):
+		get_executor().submit(make_thumbnails, name).add_done_callback(_log_failure)
+
+
+def delete_thumbnails(name):
+	for size in settings.THUMBNAIL_SIZES:
+		default_storage.delete(thumbnail_name(name, size))
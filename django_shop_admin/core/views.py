@@ -1,3 +1,160 @@
-from django.shortcuts import render
+import os
+import re
+import mimetypes
+from urllib.parse import quote
+from django.conf import settings
+from django.core.exceptions import PermissionDenied, SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import Http404, HttpResponse, FileResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+from .models import Shop, ProductImage
+from .permissions import ShopAccess
 
-# Create your views here.
+# Отдача медиафайлов с проверкой прав. Сам файл отдает веб-сервер по заголовку
+# X-Accel-Redirect (nginx) или X-Sendfile (apache, lighttpd), если он задан в
+# MEDIA_SENDFILE, иначе - Django через FileResponse (wsgi.file_wrapper/sendfile).
+
+#Имена от shop_image_path_handler/product_image_path_handler, ContentAddressedStorage
+#и их миниатюры: содержимое файла под таким именем не меняется
+IMMUTABLE_NAME_RE = re.compile(r'/(?:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[0-9a-f]{64})'
+	r'(?:_\d+)?\.\w+$')
+
+THUMBNAIL_SUFFIX_RE = re.compile(r'_\d+(\.\w+)$')
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+#Файл может принадлежать нескольким продуктам и магазинам, достаточно доступа к одному
+def can_view_media(user, name):
+	if not (user.is_active and user.is_staff):
+		return False
+	if user.is_superuser:
+		return True
+	#Миниатюры лежат рядом с оригиналом, права проверяются по оригиналу
+	names = {name, THUMBNAIL_SUFFIX_RE.sub(r'\1', name)}
+	access = ShopAccess(user)
+	if user.has_perm('core.view_product') and access.filter_shops(
+			ProductImage.objects.filter(image__in=names), 'product__shop_id').exists():
+		return True
+	if user.has_perm('core.view_shop') and access.filter_shops(
+			Shop.objects.filter(imageUrl__in=names)).exists():
+		return True
+	return False
+
+
+def file_etag(stat):
+	return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+#Один диапазон байт (start, end) включительно, None - отдать файл целиком,
+#False - диапазон не пересекается с файлом
+def parse_range(header, size):
+	match = RANGE_RE.match(header.strip())
+	if not match or match[1] == match[2] == '':
+		return None
+	if match[1] == '':
+		length = int(match[2])
+		if not length:
+			return False
+		return max(size - length, 0), size - 1
+	start = int(match[1])
+	end = int(match[2]) if match[2] else None
+	if end is not None and end < start:
+		return None
+	if start >= size:
+		return False
+	return start, size - 1 if end is None else min(end, size - 1)
+
+
+#If-Range: диапазон отдается, только если файл не изменился
+def if_range_matches(request, etag, mtime):
+	value = request.META.get('HTTP_IF_RANGE')
+	if value is None:
+		return True
+	if value.startswith('"') or value.startswith('W/'):
+		return value == etag
+	date = parse_http_date_safe(value)
+	return date is not None and int(mtime) <= date
+
+
+class RangeFile:
+	#Файл, читаемый только в пределах диапазона
+	def __init__(self, file, start, length):
+		self.file = file
+		self.file.seek(start)
+		self.remaining = length
+
+	def read(self, size=-1):
+		if size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.file.read(size)
+		self.remaining -= len(data)
+		return data
+
+	def close(self):
+		self.file.close()
+
+
+def sendfile_response(name, path):
+	response = HttpResponse()
+	if settings.MEDIA_SENDFILE == 'x-accel-redirect':
+		response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + quote(name)
+	else:
+		response['X-Sendfile'] = path
+	#Тип и размер выставит веб-сервер
+	del response['Content-Type']
+	return response
+
+
+def file_response(request, path, stat):
+	response = None
+	header = request.META.get('HTTP_RANGE')
+	if header and request.method == 'GET' and if_range_matches(request, file_etag(stat), stat.st_mtime):
+		byte_range = parse_range(header, stat.st_size)
+		if byte_range is False:
+			response = HttpResponse(status=416)
+			response['Content-Range'] = f'bytes */{stat.st_size}'
+			return response
+		if byte_range is not None:
+			start, end = byte_range
+			response = FileResponse(RangeFile(open(path, 'rb'), start, end - start + 1), status=206)
+			response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+			response['Content-Length'] = end - start + 1
+	if response is None:
+		response = FileResponse(open(path, 'rb'))
+	content_type, encoding = mimetypes.guess_type(path)
+	response['Content-Type'] = content_type or 'application/octet-stream'
+	response['Accept-Ranges'] = 'bytes'
+	return response
+
+
+@require_safe
+def serve_media(request, name):
+	name = name.lstrip('/')
+	if not can_view_media(request.user, name):
+		if request.user.is_authenticated:
+			raise PermissionDenied
+		raise Http404
+	try:
+		path = default_storage.path(name)
+		stat = os.stat(path)
+	except (SuspiciousFileOperation, OSError):
+		raise Http404
+	if not os.path.isfile(path):
+		raise Http404
+	etag = file_etag(stat)
+	response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+	if response is None:
+		if settings.MEDIA_SENDFILE:
+			response = sendfile_response(name, path)
+		else:
+			response = file_response(request, path, stat)
+	response['ETag'] = etag
+	response['Last-Modified'] = http_date(stat.st_mtime)
+	if IMMUTABLE_NAME_RE.search(name):
+		patch_cache_control(response, private=True, max_age=settings.MEDIA_CACHE_MAX_AGE, immutable=True)
+	else:
+		patch_cache_control(response, private=True, no_cache=True)
+	return response
@@ -1,7 +1,8 @@
 from django import forms
-from django.contrib.admin.widgets import FilteredSelectMultiple
+from django.contrib.admin.widgets import AutocompleteSelectMultiple
 from django.utils.html import conditional_escape
 from django.utils.html import format_html
+from .thumbnails import thumbnail_url
 
 class ImageWidget(forms.widgets.ClearableFileInput):
 	template_name = "widgets/image_field.html"
@@ -20,13 +21,15 @@ class ImageWidget(forms.widgets.ClearableFileInput):
 			'height': self.height,
 			'object_fit': self.object_fit
 			})
+		if context['widget']['is_initial']:
+			context['widget']['thumbnail_url'] = thumbnail_url(value.name, max(self.width, self.height))
 		return context
 
 
-class FilteredSelectMultipleWithReadonlyMode(FilteredSelectMultiple):
+class AutocompleteSelectMultipleWithReadonlyMode(AutocompleteSelectMultiple):
 	def render(self, name, value, attrs=None, renderer=None):
 		if self.attrs.get('is_readonly'):
 			return format_html("<div class='readonly'>{}</div>", 
 				conditional_escape(", ".join(value)))
 		else:
-			return super(FilteredSelectMultipleWithReadonlyMode,self).render(name,value,attrs,renderer)
\ No newline at end of file
+			return super(AutocompleteSelectMultipleWithReadonlyMode,self).render(name,value,attrs,renderer)
\ No newline at end of file
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -39,15 +40,19 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'django_cleanup.apps.CleanupConfig',
 ]
 
 MIDDLEWARE = [
+    'core.instrumentation.ViewStatsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.profiling.ProfilingMiddleware',
+    'core.routers.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -76,17 +81,95 @@ WSGI_APPLICATION = 'django_shop_admin.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
+# core.backends.postgresql keeps a bounded per-process pool of connections (core.pooling):
+# a request checks a connection out on first query and returns it when it finishes, so
+# only pool misses pay for connection setup. Keep CONN_MAX_AGE at 0 with this backend
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'ENGINE': 'core.backends.postgresql',
         'NAME': 'djangoshop',
         'USER': 'djangoadmin',
         'PASSWORD': 'mypass',
         'HOST': '127.0.0.1',
         'PORT': '5432',
+        'POOL': {
+            'MAX_SIZE': 10,
+            'TIMEOUT': 10,
+            'MAX_IDLE': 300,
+            'MAX_LIFETIME': 3600,
+            'CHECK_AFTER': 5,
+        },
     }
 }
 
+# Read replicas used by core.routers for changelists, filter lookups, autocomplete,
+# category paths and export. The local replica alias is a second connection to the
+# same database (a mirror of default in tests): set DATABASE_REPLICAS = ('replica',)
+# to try routing locally, in production point the alias at a streaming replica
+
+DATABASES['replica'] = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['core.routers.ReplicaRouter']
+
+DATABASE_REPLICAS = ()
+
+DATABASE_REPLICA_VIEWS = (
+    'admin:core_product_changelist',
+    'admin:core_category_changelist',
+    'admin:core_shop_changelist',
+    'admin:autocomplete',
+    'admin:category-paths',
+)
+
+# Seconds after a modifying request during which the session reads from the primary
+
+DATABASE_REPLICA_STICKY_SECONDS = 10
+
+DATABASE_REPLICA_CHECK_INTERVAL = 30
+
+DATABASE_REPLICA_MAX_LAG = 30
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/ref/settings/#caches
+# Shared between worker processes, so version-keyed entries are invalidated everywhere.
+# Sessions and the auth cache keep about 5 entries per active user. In production set
+# MEMCACHED_LOCATION (e.g. '127.0.0.1:11211', requires pymemcache): memcached evicts
+# least recently used entries and does not scan anything on writes. The file-based
+# fallback lists its directory on every write to cull, so it is sized to cull rarely:
+# MAX_ENTRIES covers ~10000 active users, a cull removes 1/10 of entries at random
+
+MEMCACHED_LOCATION = os.environ.get('MEMCACHED_LOCATION')
+
+if MEMCACHED_LOCATION:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': MEMCACHED_LOCATION.split(','),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': BASE_DIR.joinpath('cache'),
+            'OPTIONS': {
+                'MAX_ENTRIES': 50000,
+                'CULL_FREQUENCY': 10,
+            },
+        }
+    }
+
+# Sessions are read from the cache and written through to the database
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# The session user, its permissions and managed shops are cached under a per-user
+# version bumped by signals in core.models on user, group, permission and shop manager changes
+
+AUTHENTICATION_BACKENDS = ['core.permissions.CachedModelBackend']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -134,7 +217,43 @@ MEDIA_ROOT = BASE_DIR.joinpath('media')
 
 IMAGES_DIR = 'images'
 
+# Uploaded images are stored once per content under a sha256 path and
+# deleted when the last Shop/ProductImage row referencing them goes
+
+DEFAULT_FILE_STORAGE = 'core.storage.ContentAddressedStorage'
+
+# Media files are served by core.views.serve_media after a permission check.
+# Set MEDIA_SENDFILE to 'x-accel-redirect' (nginx, internal location at
+# MEDIA_ACCEL_PREFIX aliased to MEDIA_ROOT) or 'x-sendfile' (apache, lighttpd)
+# to hand the file transfer over to the web server
+
+MEDIA_SENDFILE = None
+
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+MEDIA_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Sizes of image thumbnails generated in background processes
+
+THUMBNAIL_SIZES = (100, 300, 450)
+
+THUMBNAIL_WORKERS = 2
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Bulk admin actions on more products than the threshold are executed
+# by the runjobs worker in chunks of BACKGROUND_JOB_CHUNK_SIZE products
+
+BACKGROUND_JOB_THRESHOLD = 10000
+
+BACKGROUND_JOB_CHUNK_SIZE = 5000
+
+# Per-view request statistics are aggregated in each process and added
+# to the view_stats table every VIEW_STATS_FLUSH_INTERVAL seconds
+
+VIEW_STATS_FLUSH_INTERVAL = 60
+
+VIEW_STATS_SLOW_QUERIES = 5
@@ -15,9 +15,10 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
-from django.conf.urls.static import static
 from django.conf import settings
+from core.views import serve_media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    path(settings.MEDIA_URL.lstrip('/') + '<path:name>', serve_media, name='media'),
+]